@@ -2,6 +2,7 @@ import re
 import configparser
 from telebot import types
 from telebot.async_telebot import AsyncTeleBot
+import metrics
 
 def setup_bot(token, tooGoodToGo, logger, admin_ids):
     bot = AsyncTeleBot(token)
@@ -53,6 +54,8 @@ You do not need to enter a password._
 
 🚫 Use */blacklist* to manage your ignored stores.
 
+🗺️ With */area* you can get alerts for all stores around a place, if the bot runs area scans.
+
 _🌐 You can find more information about Too Good To Go_ [here](https://www.toogoodtogo.com/).
 
 *🌍 LET'S FIGHT food waste TOGETHER 🌎*
@@ -151,7 +154,8 @@ _🌐 You can find more information about Too Good To Go_ [here](https://www.too
             return
         logger.info(f"Received /settings command in chat {message.chat.id}")
         credentials = tooGoodToGo.find_credentials_by_telegramUserID(str(message.chat.id))
-        if credentials is None:
+        # Chats that only follow an area have settings but no login
+        if credentials is None and not tooGoodToGo.area_scanner.is_subscribed(str(message.chat.id)):
             await bot.send_message(chat_id=message.chat.id,
                                    text="🔑 You have to log in with your mail first!\nPlease enter */login email@example.com*\n*❗️️This is necessary if you want to use the bot❗️*",
                                    parse_mode="Markdown")
@@ -167,10 +171,9 @@ _🌐 You can find more information about Too Good To Go_ [here](https://www.too
             return
         logger.info(f"Toggling setting {call.data} in chat {call.message.chat.id}")
         settings = tooGoodToGo.users_settings_data[str(call.message.chat.id)][call.data]
-        tooGoodToGo.users_settings_data[str(call.message.chat.id)][call.data] = 0 if settings else 1
+        tooGoodToGo.set_user_setting(str(call.message.chat.id), call.data, 0 if settings else 1)
         await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                             reply_markup=inline_keyboard_markup(str(call.message.chat.id)))
-        tooGoodToGo.db.save_users_settings_data(tooGoodToGo.users_settings_data)
 
     @bot.callback_query_handler(func=lambda c: c.data == 'activate_all')
     async def activate_all(call: types.CallbackQuery):
@@ -178,9 +181,7 @@ _🌐 You can find more information about Too Good To Go_ [here](https://www.too
             await bot.answer_callback_query(call.id, text="You are not authorized to perform this action.")
             return
         logger.info(f"Activating all settings in chat {call.message.chat.id}")
-        for key in tooGoodToGo.users_settings_data[str(call.message.chat.id)].keys():
-            tooGoodToGo.users_settings_data[str(call.message.chat.id)][key] = 1
-        tooGoodToGo.db.save_users_settings_data(tooGoodToGo.users_settings_data)
+        tooGoodToGo.set_all_user_settings(str(call.message.chat.id), 1)
         await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                             reply_markup=inline_keyboard_markup(str(call.message.chat.id)))
 
@@ -190,9 +191,7 @@ _🌐 You can find more information about Too Good To Go_ [here](https://www.too
             await bot.answer_callback_query(call.id, text="You are not authorized to perform this action.")
             return
         logger.info(f"Disabling all settings in chat {call.message.chat.id}")
-        for key in tooGoodToGo.users_settings_data[str(call.message.chat.id)].keys():
-            tooGoodToGo.users_settings_data[str(call.message.chat.id)][key] = 0
-        tooGoodToGo.db.save_users_settings_data(tooGoodToGo.users_settings_data)
+        tooGoodToGo.set_all_user_settings(str(call.message.chat.id), 0)
         await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id,
                                             reply_markup=inline_keyboard_markup(str(call.message.chat.id)))
 
@@ -242,6 +241,49 @@ _🌐 You can find more information about Too Good To Go_ [here](https://www.too
         except ValueError:
             await bot.send_message(message.chat.id, "Please use the format: /remove_blacklist <store_id>")
 
+    @bot.message_handler(commands=['area'])
+    async def manage_area(message):
+        if not await check_authorization(message):
+            return
+        logger.info(f"Received /area command in chat {message.chat.id}")
+        chat_id = str(message.chat.id)
+        scanner = tooGoodToGo.area_scanner
+        if not scanner.enabled:
+            await bot.send_message(chat_id, "🗺️ Area scans are not enabled on this bot.")
+            return
+
+        usage = ("*/area <latitude> <longitude> [radius km]* to get alerts for all stores in an area\n"
+                 "*/area favorites* to follow your favourite stores through the area scans\n"
+                 "*/area off* to stop")
+        args = message.text.split()[1:]
+        if not args:
+            area = scanner.areas.get(chat_id)
+            stores = scanner.stores.get(chat_id, {})
+            status = f"📍 Area: {area[0]:.4f}, {area[1]:.4f} ({area[2]:g} km)\n" if area else "📍 No area set\n"
+            status += f"🏪 Following {len(stores)} stores\n\n"
+            await bot.send_message(chat_id, status + usage, parse_mode="Markdown")
+        elif args[0] == 'off':
+            tooGoodToGo.unsubscribe_areas(chat_id)
+            await bot.send_message(chat_id, "🗺️ Area alerts stopped.")
+        elif args[0] == 'favorites':
+            if tooGoodToGo.find_credentials_by_telegramUserID(chat_id) is None:
+                await bot.send_message(chat_id, "🔑 You have to log in with your mail first!\nPlease enter */login email@example.com*",
+                                       parse_mode="Markdown")
+                return
+            await tooGoodToGo.subscribe_favourite_stores(chat_id)
+        else:
+            try:
+                latitude, longitude = float(args[0]), float(args[1])
+                radius = float(args[2]) if len(args) > 2 else 5.0
+            except (ValueError, IndexError):
+                await bot.send_message(chat_id, usage, parse_mode="Markdown")
+                return
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and 0 < radius <= 30):
+                await bot.send_message(chat_id, "⚠️ Please use a valid position and a radius of at most 30 km.")
+                return
+            tooGoodToGo.subscribe_area(chat_id, latitude, longitude, radius)
+            await bot.send_message(chat_id, f"🗺️ You will get alerts for stores within {radius:g} km of {latitude:.4f}, {longitude:.4f}.")
+
     @bot.message_handler(commands=['generate_token'])
     async def generate_token(message):
         if not await check_authorization(message):
@@ -263,6 +305,14 @@ _🌐 You can find more information about Too Good To Go_ [here](https://www.too
         await bot.reply_to(message, response)
         logger.info(f"Admin {message.from_user.id} requested token list")
 
+    @bot.message_handler(commands=['stats'])
+    async def stats(message):
+        if not tooGoodToGo.is_admin(message.from_user.id):
+            await bot.reply_to(message, "This command is only available to admins.")
+            return
+        await bot.reply_to(message, metrics.summary(tooGoodToGo.shards.count if tooGoodToGo.shards else 0))
+        logger.info(f"Admin {message.from_user.id} requested stats")
+
     async def shutdown():
         logger.info("Shutting down Telegram bot...")
         await bot.close()
@@ -1,16 +1,27 @@
 import json
 import time
 from datetime import datetime, timezone, date, timedelta
-from threading import Thread, Event
 from telebot.async_telebot import AsyncTeleBot
 from telebot import types
-from tgtg import TgtgClient
 import tgtg
+from tgtg_async import AsyncTgtgClient
 from database import Database
+from poller import Poller
+from outbox import Outbox, Notification
+from session import UserSession, SessionPool
+from token_refresh import TokenRefresher
+from http_pool import SharedHTTPPool
+from shards import AREA_SCANS, ShardManager
+from leases import LeaseManager
+from snapshot import project_catalog, snapshot_changed
+from item_cache import ItemCache
+from user_index import UserIndex
+from area_scan import AreaScanner, item_location
+from metrics import MetricsServer
+from rate_limit import error_kind, request_budget
+import metrics
+from restock import RestockModel
 import asyncio
-from queue import Queue
-import queue
-import random
 from tgtg.exceptions import TgtgAPIError
 import os
 
@@ -19,28 +30,79 @@ tgtg.USER_AGENTS = [
     "TGTG/25.2.0 Dalvik/2.1.0 (Linux; U; Android 15; sdk_gphone64_x86_64 Build/AE3A.240806.043)",
 ]
 
+DEFAULT_SETTINGS = {'sold_out': 0, 'new_stock': 1, 'stock_reduced': 0, 'stock_increased': 0}
+
+class FetchCancelled(Exception):
+    """Raised inside a fetch when it was cancelled or timed out."""
+
 class TooGoodToGo:
-    def __init__(self, bot_token, logger, admin_ids):
-        self.bot = AsyncTeleBot(bot_token)
+    def __init__(self, bot_token, logger, admin_ids, shard=None):
+        # A poll shard (see shards.py) only polls; the bot and delivery stay in the main process
+        self.shard = shard
+        self.bot = AsyncTeleBot(bot_token) if shard is None else None
         self.logger = logger
         self.admin_ids = [str(id) for id in admin_ids]  # Ensure all admin IDs are strings
         
         # Get the project root directory
         project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        db_path = os.path.join(project_root, 'database', 'bargain_bites.db')
+        db_path = os.getenv('DATABASE_PATH') or os.path.join(project_root, 'database', 'bargain_bites.db')
         
         self.db = Database(db_path)
+        # Instances sharing the database each poll the users they hold a lease on (see leases.py)
+        self.leases = LeaseManager(self, logger) if shard is None and LeaseManager.configured() else None
+        if self.leases:
+            self.db.node = self.leases.node
+        elif shard is not None:
+            # Poll shards commit alerts under their instance's name
+            self.db.node = shard.node
         self.users_login_data = self.db.get_users_login_data()
         self.users_settings_data = self.db.get_users_settings_data()
-        self.available_items_favorites = self.db.get_available_items_favorites()
-        self.connected_clients = {}
-        self.client = TgtgClient
-        self.shutdown_flag = Event()
-        self.message_queue = Queue()
-        asyncio.create_task(self.process_message_queue())
-        asyncio.create_task(self.set_bot_commands())
-        self.thread = Thread(target=self.get_available_items_per_user)
-        self.thread.start()
+        self.user_index = UserIndex()
+        self.user_index.load(self.db, self.users_settings_data)
+        self.sessions = SessionPool()
+        self.http_pool = SharedHTTPPool()
+        self.api_url = os.getenv('TGTG_API_URL', tgtg.BASE_URL)
+        self.item_cache = ItemCache()
+        self.restock_model = RestockModel()
+        self.restock_model.load(self.db)
+        self.db.purge_stock_events(int(time.time()) - 30 * 24 * 3600)
+        self.area_scanner = AreaScanner(self, logger)
+        self.area_scanner.load(self.db)
+        self.shutdown_flag = asyncio.Event()
+        self.info_requests = {}
+        self.info_timeout = float(os.getenv('INFO_FETCH_TIMEOUT', 60))
+        self.metrics_server = MetricsServer(logger)
+        if shard is None:
+            self.outbox = Outbox(self.deliver_message, logger, self.db)
+            # With leases, pending alerts are taken over by the lease heartbeats instead
+            self.outbox.restore(pending=self.leases is None)
+            self.outbox.start()
+            metrics.OUTBOX_PENDING.set_function(self.outbox.size)
+            asyncio.create_task(self.set_bot_commands())
+        else:
+            # Alerts go to the delivery process, and each shard serves its metrics on the next ports
+            self.outbox = shard
+            if self.metrics_server.enabled():
+                self.metrics_server.port += 1 + shard.index
+        metrics.HTTP_REQUESTS.set_function(lambda: self.http_pool.requests)
+        metrics.HTTP_CONNECTIONS.set_function(lambda: self.http_pool.connections)
+        if self.metrics_server.enabled():
+            asyncio.create_task(self.metrics_server.start())
+        self.shards = ShardManager(self, logger) if shard is None and ShardManager.configured() else None
+        if self.shards:
+            self.poller = None
+            self.token_refresher = None
+            # The main process's share of the request budget, for /info and other fetches on demand
+            self.request_budget = request_budget(self.shards.count + 1)
+            self.shards.start()
+        else:
+            self.poller = Poller(self, logger)
+            self.request_budget = self.poller.budget
+            self.poller_task = asyncio.create_task(self.poller.run())
+            self.token_refresher = TokenRefresher(self, logger)
+            self.token_refresher_task = asyncio.create_task(self.token_refresher.run())
+        if self.leases:
+            self.leases.start()
         self.logger.info(f"TooGoodToGo initialized with admin IDs: {self.admin_ids}")
 
     async def set_bot_commands(self):
@@ -50,6 +112,7 @@ class TooGoodToGo:
             types.BotCommand("/relogin", "force a new login with your mail"),
             types.BotCommand("/settings", "set when you want to be notified"),
             types.BotCommand("/blacklist", "manage your ignored stores"),
+            types.BotCommand("/area", "get alerts for an area or your favourite stores"),
             types.BotCommand("/help", "short explanation"),
         ])
 
@@ -57,17 +120,175 @@ class TooGoodToGo:
         await self.bot.send_message(telegram_user_id, text=message, parse_mode="Markdown")
 
     async def send_message_with_link(self, telegram_user_id, message, item_id, store_id, store_name):
+        return await self.deliver_message(telegram_user_id, [(item_id, message, store_id, store_name)])
+
+    async def deliver_message(self, telegram_user_id, parts, message_id=None):
+        """
+        Show one or more alerts, given as (item_id, text, store_id, store_name), in one
+        message with a row of buttons per item. Edits message `message_id` if given,
+        otherwise sends a new one. Returns the message ID.
+        """
         keyboard = types.InlineKeyboardMarkup()
-        url_button = types.InlineKeyboardButton(text="Open in App", url=f"https://share.toogoodtogo.com/item/{item_id}")
-        ignore_button = types.InlineKeyboardButton(text="Ignore Store", callback_data=f"ignore_{store_id}_{store_name}")
-        keyboard.add(url_button, ignore_button)
-        await self.bot.send_message(telegram_user_id, text=message, reply_markup=keyboard, parse_mode="Markdown")
+        for item_id, text, store_id, store_name in parts:
+            url_button = types.InlineKeyboardButton(text="Open in App" if len(parts) == 1 else f"Open {store_name}",
+                                                    url=f"https://share.toogoodtogo.com/item/{item_id}")
+            ignore_button = types.InlineKeyboardButton(text="Ignore Store", callback_data=f"ignore_{store_id}_{store_name}")
+            keyboard.add(url_button, ignore_button)
+        message = "\n".join(text for _, text, _, _ in parts)
+        if message_id is None:
+            sent = await self.bot.send_message(telegram_user_id, text=message, reply_markup=keyboard, parse_mode="Markdown")
+            return sent.message_id
+        await self.bot.edit_message_text(message, chat_id=telegram_user_id, message_id=message_id,
+                                         reply_markup=keyboard, parse_mode="Markdown")
+        return message_id
 
     def add_user(self, telegram_user_id, credentials):
         self.users_login_data[telegram_user_id] = credentials
-        self.db.save_users_login_data(self.users_login_data)
-        self.users_settings_data[telegram_user_id] = {'sold_out': 0, 'new_stock': 1, 'stock_reduced': 0, 'stock_increased': 0}
-        self.db.save_users_settings_data(self.users_settings_data)
+        self.db.add_user(telegram_user_id, credentials)
+        self.users_settings_data[telegram_user_id] = dict(DEFAULT_SETTINGS)
+        self.user_index.set_settings(telegram_user_id, self.users_settings_data[telegram_user_id])
+        self.db.add_user_settings(telegram_user_id, self.users_settings_data[telegram_user_id])
+        self.wake_user(telegram_user_id)
+
+    def set_user_setting(self, user_id, key, value):
+        """Change one notification setting and persist only this user's row."""
+        self.users_settings_data[user_id][key] = value
+        self.user_index.set_settings(user_id, self.users_settings_data[user_id])
+        self.db.add_user_settings(user_id, self.users_settings_data[user_id])
+        self.wake_user(user_id)
+
+    def set_all_user_settings(self, user_id, value):
+        for key in self.users_settings_data[user_id].keys():
+            self.users_settings_data[user_id][key] = value
+        self.user_index.set_settings(user_id, self.users_settings_data[user_id])
+        self.db.add_user_settings(user_id, self.users_settings_data[user_id])
+        self.wake_user(user_id)
+
+    def wake_user(self, user_id):
+        """Poll a logged-in user soon, e.g. after their settings changed how often they are polled."""
+        if self.leases and not self.leases.owns(user_id):
+            self.leases.touch(user_id)
+        elif self.shards:
+            self.shards.notify_user(user_id, wake=True)
+        elif user_id in self.users_login_data and self.owns(user_id):
+            self.poller.scheduler.wake(user_id, time.time())
+
+    def user_changed(self, user_id):
+        """Let the poll shards, or the instance polling the user, know that their blacklist or login changed."""
+        if self.leases and not self.leases.owns(user_id):
+            self.leases.touch(user_id)
+        elif self.shards:
+            self.shards.notify_user(user_id, wake=False)
+
+    def areas_changed(self):
+        if self.leases and not self.leases.owns(AREA_SCANS):
+            self.leases.touch(AREA_SCANS)
+        elif self.shards:
+            self.shards.reload_areas()
+
+    def owns(self, user_id):
+        """True if this process polls `user_id`, which depends on poll shards and leases."""
+        if self.shard is not None:
+            return self.shard.owns(user_id)
+        return self.leases is None or self.leases.owns(user_id)
+
+    def owns_area_scans(self):
+        return self.owns(AREA_SCANS)
+
+    def adopt_users(self, gained=None, lost=()):
+        """
+        Schedule the users this process now owns, with the tokens their previous owner
+        last saved. Users it lost are dropped from the schedule when they come due, but
+        their sessions go now so that only their new owner refreshes their tokens.
+
+        Without `gained` every known user is looked at, as after the poll shards were
+        rebalanced. On a lease heartbeat only the users whose lease was gained or lost
+        are; `gained` may include users this process does not know yet, such as ones
+        who logged in on another instance.
+        """
+        candidates = list(self.users_login_data) if gained is None else [*gained, *lost]
+        now = time.time()
+        for user_id in candidates:
+            if not self.owns(user_id):
+                self.drop_session(user_id)
+            elif not self.poller.scheduler.is_scheduled(user_id):
+                self.reload_user(user_id, wake=False)
+                if user_id in self.users_login_data:
+                    self.poller.scheduler.schedule(user_id, now)
+
+    def leases_changed(self, gained, lost, touched):
+        """Take over the users this instance was just leased, and re-read the ones other instances changed."""
+        if AREA_SCANS in gained or AREA_SCANS in touched:
+            self.area_scanner.load(self.db)
+            if self.shards:
+                self.shards.reload_areas()
+        gained.discard(AREA_SCANS)
+        lost.discard(AREA_SCANS)
+        touched.discard(AREA_SCANS)
+        if self.shards:
+            self.shards.set_leases(self.leases.held, self.leases.valid_until)
+            for user_id in touched:
+                self.shards.notify_user(user_id, wake=True)
+        else:
+            self.adopt_users(gained, lost)
+            for user_id in touched - gained:
+                self.reload_user(user_id, wake=True)
+
+    def reload_user(self, user_id, wake):
+        """Re-read a user changed by another process: their login, settings and blacklist."""
+        credentials = self.db.find_credentials_by_telegramUserID(user_id)
+        if credentials != self.users_login_data.get(user_id):
+            self.drop_session(user_id)
+        if credentials is None:
+            self.users_login_data.pop(user_id, None)
+        else:
+            self.users_login_data[user_id] = credentials
+        settings = self.db.get_user_settings(user_id)
+        if settings is not None:
+            self.users_settings_data[user_id] = settings
+            self.user_index.set_settings(user_id, settings)
+        self.user_index.set_blacklist(user_id, [store_id for store_id, _ in self.db.get_blacklisted_stores(user_id)])
+        if wake:
+            self.wake_user(user_id)
+
+    def subscribe_area(self, chat_id, latitude, longitude, radius):
+        """Serve a chat from the shared scan of the area around (latitude, longitude)."""
+        # Area-only chats never log in, so they start with the default settings
+        if chat_id not in self.users_settings_data:
+            self.users_settings_data[chat_id] = dict(DEFAULT_SETTINGS)
+            self.user_index.set_settings(chat_id, self.users_settings_data[chat_id])
+            self.db.add_user_settings(chat_id, self.users_settings_data[chat_id])
+        self.db.set_area_subscription(chat_id, latitude, longitude, radius)
+        self.area_scanner.set_area(chat_id, latitude, longitude, radius)
+        self.areas_changed()
+
+    async def subscribe_favourite_stores(self, chat_id):
+        """Follow the stores of a chat's favourites through the shared area scans instead of its own polls."""
+        try:
+            favourite_items = await asyncio.wait_for(self.fetch_within_budget(chat_id), timeout=self.info_timeout)
+        except asyncio.TimeoutError:
+            await self.send_message(chat_id, "⌛ Too Good To Go is taking too long to respond. Please try again later.")
+            return
+        except Exception as e:
+            self.logger.error(f"Error fetching favourites to follow for chat {chat_id}: {e}")
+            await self.send_message(chat_id, "❌ An error occurred while fetching your favourites. Please try again later.")
+            return
+
+        stores = {}
+        for item in favourite_items:
+            location = item_location(item)
+            if location:
+                stores[item['store']['store_id']] = location
+        self.db.set_store_subscriptions(chat_id, stores)
+        self.area_scanner.set_stores(chat_id, stores)
+        self.areas_changed()
+        self.logger.info(f"Chat {chat_id} follows {len(stores)} favourite stores through area scans")
+        await self.send_message(chat_id, f"🗺️ Following {len(stores)} favourite stores through the shared area scans.")
+
+    def unsubscribe_areas(self, chat_id):
+        self.db.remove_subscriptions(chat_id)
+        self.area_scanner.remove(chat_id)
+        self.areas_changed()
 
     async def new_user(self, telegram_user_id, email, force_relogin=False):
         try:
@@ -76,12 +297,11 @@ class TooGoodToGo:
                 await self.send_message(telegram_user_id, "This chat is already logged in! To re-login, use /relogin")
                 return
 
-            # Remove existing client if any
-            if str(telegram_user_id) in self.connected_clients:
-                del self.connected_clients[str(telegram_user_id)]
+            # Remove existing session if any
+            self.drop_session(str(telegram_user_id))
 
-            client = TgtgClient(email=email)
-            credentials = client.get_credentials()
+            client = self.new_client(email=email)
+            credentials = await client.get_credentials()
             self.add_user(telegram_user_id, credentials)
             await self.send_message(telegram_user_id, "✅ You are now logged in!")
             self.logger.info(f"{'Re-logged' if force_relogin else 'New'} user added with ID: {telegram_user_id}")
@@ -94,110 +314,109 @@ class TooGoodToGo:
         # Remove existing credentials
         if str(telegram_user_id) in self.users_login_data:
             del self.users_login_data[str(telegram_user_id)]
-            self.db.save_users_login_data(self.users_login_data)
+            self.db.remove_user(str(telegram_user_id))
+            self.user_changed(str(telegram_user_id))
         
         # Perform new login
         await self.new_user(telegram_user_id, email, force_relogin=True)
 
     def find_credentials_by_telegramUserID(self, user_id):
+        # Poll shards and other instances rotate tokens of their own, the database has the current ones
+        if self.shards or self.leases:
+            return self.db.find_credentials_by_telegramUserID(user_id)
         return self.users_login_data.get(user_id)
 
-    def refresh_credentials(self, user_id):
+    def new_client(self, **kwargs):
+        """Create a TGTG client that uses the shared HTTP connection pool."""
+        return AsyncTgtgClient(self.http_pool.next_session(), url=self.api_url, **kwargs)
+
+    def drop_session(self, user_id):
+        self.sessions.pop(user_id, None)
+
+    async def refresh_credentials(self, user_id):
         """
         Attempt to refresh credentials for a specific user.
-        If refresh fails, remove the user from connected clients.
+        Returns the new session, or None if the refresh failed and the session was dropped.
         """
         try:
             user_credentials = self.find_credentials_by_telegramUserID(user_id)
             if not user_credentials:
                 self.logger.error(f"No credentials found for user {user_id}")
-                return False
+                return None
 
             # Try to refresh the client
-            new_client = TgtgClient(access_token=user_credentials["access_token"],
-                                    refresh_token=user_credentials["refresh_token"],
-                                    cookie=user_credentials["cookie"])
+            new_client = self.new_client(access_token=user_credentials["access_token"],
+                                         refresh_token=user_credentials["refresh_token"],
+                                         cookie=user_credentials["cookie"])
             
             # Get new credentials after refresh
-            new_credentials = new_client.get_credentials()
+            new_credentials = await new_client.get_credentials()
+            new_credentials['refreshed_at'] = time.time()
             
             # Update stored credentials
             self.users_login_data[user_id] = new_credentials
-            self.db.save_users_login_data(self.users_login_data)
+            self.db.save_users_login_data(self.users_login_data, [user_id])
             
-            # Update connected clients
-            self.connected_clients[user_id] = new_client
-            self.client = new_client
+            # Replace the user's session, keeping its backoff state and stats
+            session = self.sessions.use(user_id)
+            if session:
+                session.client = new_client
+                session.credentials = new_credentials
+            else:
+                session = UserSession(user_id, new_credentials, new_client)
+                self.sessions.add(session)
             
             self.logger.info(f"Successfully refreshed credentials for user {user_id}")
-            return True
+            return session
         
         except Exception as e:
             self.logger.error(f"Failed to refresh credentials for user {user_id}: {str(e)}")
-            # Remove from connected clients if refresh fails
-            if user_id in self.connected_clients:
-                del self.connected_clients[user_id]
-            return False
+            # Drop the session if refresh fails
+            self.drop_session(user_id)
+            return None
 
-    def connect(self, user_id):
+    async def connect(self, user_id):
+        """
+        Return the UserSession for `user_id`, creating its client on first use. Creating
+        a client makes no request, so there is no delay here: requests are paced by the
+        poller's request budget.
+        """
         try:
-            if user_id in self.connected_clients:
-                self.client = self.connected_clients[user_id]
-                return
+            session = self.sessions.use(user_id)
+            if session:
+                return session
                 
             user_credentials = self.find_credentials_by_telegramUserID(user_id)
             if not user_credentials:
                 raise Exception(f"No credentials found for user ID: {user_id}")
-                
-            # Add longer random delay to avoid rate limiting
-            time.sleep(random.uniform(10, 20))
-            
-            self.client = TgtgClient(access_token=user_credentials["access_token"],
-                                    refresh_token=user_credentials["refresh_token"],
-                                    cookie=user_credentials["cookie"])
-            self.connected_clients[user_id] = self.client
+
+            # A token refreshed recently (also before a restart) is reused without a refresh round trip
+            refreshed_at = user_credentials.get("refreshed_at")
+            client = self.new_client(access_token=user_credentials["access_token"],
+                                     refresh_token=user_credentials["refresh_token"],
+                                     cookie=user_credentials["cookie"],
+                                     last_time_token_refreshed=datetime.fromtimestamp(refreshed_at) if refreshed_at else None)
+            session = UserSession(user_id, user_credentials, client)
+            self.sessions.add(session)
+            return session
         
         except Exception as e:
-            # Only try to refresh if it's an authentication error
-            if "401" in str(e) or "unauthorized" in str(e).lower():
-                self.logger.warning(f"Authentication failed for user {user_id}, attempting refresh: {str(e)}")
-                if not self.refresh_credentials(user_id):
-                    self.logger.error(f"Could not refresh credentials for user {user_id}")
-                    raise
-            else:
-                self.logger.error(f"Connection failed for user {user_id}: {str(e)}")
-                raise
+            self.logger.error(f"Connection failed for user {user_id}: {str(e)}")
+            raise
 
-    def get_favourite_items(self):
-        max_retries = 3
-        base_delay = 10  # Increased base delay
-        
-        for attempt in range(max_retries):
-            try:
-                # Add random delay between attempts
-                if attempt > 0:
-                    delay = base_delay * (2 ** attempt) + random.uniform(5, 15)
-                    self.logger.warning(f"Retrying get_items after {delay:.2f} seconds...")
-                    time.sleep(delay)
-                
-                return self.client.get_items()
-                
-            except TgtgAPIError as e:
-                error_str = str(e).lower()
-                if "captcha" in error_str:
-                    if attempt == max_retries - 1:
-                        self.logger.error("Max retries reached for CAPTCHA")
-                        raise
-                    continue
-                elif "404" in error_str:
-                    self.logger.warning("Got 404 error, likely API endpoint issue")
-                    raise
-                else:
-                    self.logger.error(f"TGTG API error: {str(e)}")
-                    raise
-            except Exception as e:
-                self.logger.error(f"Unexpected error in get_favourite_items: {str(e)}")
-                raise
+    async def get_favourite_items(self, session):
+        # CAPTCHA and rate limit errors are not retried here: the poller's rate
+        # limiter slows everyone down instead, and the session's circuit breaker
+        # stops polling an account that keeps failing
+        try:
+            return await session.client.get_items()
+        except TgtgAPIError as e:
+            if "404" in str(e):
+                self.logger.warning("Got 404 error, likely API endpoint issue")
+            elif error_kind(e) != 'unauthorized':
+                # A 401 is refreshed and retried by fetch_user_items
+                self.logger.error(f"TGTG API error: {str(e)}")
+            raise
 
     def format_message(self, item, status=None):
         store_name = item['store']['store_name']
@@ -238,202 +457,234 @@ class TooGoodToGo:
         
         return message, item_id, store_id, store_name
 
+    def cached_message(self, item, entry, status=None):
+        """format_message, memoised on the item's cache entry so users sharing an item share the text."""
+        if entry.messages is None:
+            entry.messages = {}
+        message = entry.messages.get(status)
+        if message is None:
+            message = entry.messages[status] = self.format_message(item, status)
+        return message
+
     async def send_available_favourite_items_for_one_user(self, user_id):
+        # Only one /info fetch per chat at a time
+        if user_id in self.info_requests:
+            await self.send_message(user_id, "⏳ Still fetching your favourites, please wait a moment.")
+            return
+
+        cancel_event = asyncio.Event()
+        self.info_requests[user_id] = cancel_event
         try:
-            self.connect(user_id)
-            favourite_items = self.get_favourite_items()
-            available_items = [item for item in favourite_items if item['items_available'] > 0 and not self.db.is_store_blacklisted(user_id, item['store']['store_id'])]
+            favourite_items = await asyncio.wait_for(self.fetch_within_budget(user_id, cancel_event),
+                                                     timeout=self.info_timeout)
+            available_items = [item for item in favourite_items if item['items_available'] > 0 and not self.user_index.is_blacklisted(user_id, item['store']['store_id'])]
             
             if not available_items:
                 await self.send_message(user_id, "Currently all your favorites are sold out or ignored 😕")
                 return
 
             for item in available_items:
-                message, item_id, store_id, store_name = self.format_message(item)
+                message, item_id, store_id, store_name = self.cached_message(item, self.item_cache.lookup(item))
                 await self.send_message_with_link(user_id, message, item_id, store_id, store_name)
             
             self.logger.info(f"Sent available items for user ID: {user_id}")
+        except asyncio.TimeoutError:
+            cancel_event.set()
+            self.logger.warning(f"Fetching available items for user {user_id} timed out after {self.info_timeout:.0f} seconds")
+            await self.send_message(user_id, "⌛ Too Good To Go is taking too long to respond. Please try again later.")
+        except FetchCancelled:
+            self.logger.info(f"Fetching available items for user {user_id} was cancelled")
+        except asyncio.CancelledError:
+            cancel_event.set()
+            self.logger.info(f"Fetching available items for user {user_id} was cancelled")
+            raise
         except Exception as e:
             self.logger.error(f"Error sending available items: {e}")
             await self.send_message(user_id, "❌ An error occurred while fetching available items. Please try again later.")
+        finally:
+            self.info_requests.pop(user_id, None)
 
-    def get_available_items_per_user(self):
-        consecutive_errors = 0
-        max_consecutive_errors = 5
-        
-        while not self.shutdown_flag.is_set():
-            try:
-                # Reset consecutive errors on successful iteration
-                consecutive_errors = 0
-                
-                users_login_data = self.db.get_users_login_data()
-                available_items_favorites = self.db.get_available_items_favorites()
-                temp_available_items = {}
-                
-                # Shuffle users to distribute load and reduce predictability
-                user_keys = list(users_login_data.keys())
-                random.shuffle(user_keys)
-                
-                for key in user_keys:
-                    if self.shutdown_flag.is_set():
-                        break
-                    
-                    try:
-                        # Attempt to connect and get items
-                        self.connect(key)
-                        
-                        # Add random delay between user checks (increased from 10-20 to 20-40 seconds)
-                        time.sleep(random.uniform(20, 40))
-                        
-                        # Get available items
-                        available_items = self.get_favourite_items()
-                        
-                        # Process each available item
-                        for item in available_items:
-                            if self.shutdown_flag.is_set():
-                                break
-                            
-                            status = None
-                            item_id = item['item']['item_id']
-                            store_id = item['store']['store_id']
-                            
-                            # Skip blacklisted stores
-                            if self.db.is_store_blacklisted(key, store_id):
-                                continue
-                            
-                            status = None
-                            new_items_available = int(item['items_available'])
-                            
-                            # Check if this is a completely new item
-                            if item_id not in available_items_favorites:
-                                if new_items_available > 0:
-                                    status = "new_stock"
-                                    temp_available_items[item_id] = status
-                            # Check for changes in existing items
-                            elif item_id not in temp_available_items:
-                                old_items_available = int(available_items_favorites[item_id]['items_available'])
-                                
-                                # Determine status based on availability changes
-                                if new_items_available == 0 and old_items_available > 0:
-                                    status = "sold_out"
-                                elif old_items_available == 0 and new_items_available > 0:
-                                    status = "new_stock"
-                                elif old_items_available > new_items_available:
-                                    status = "stock_reduced"
-                                elif old_items_available < new_items_available:
-                                    status = "stock_increased"
-                                
-                                if status:
-                                    temp_available_items[item_id] = status
-                            
-                            # Update available items
-                            available_items_favorites[item_id] = item
-                            
-                            # Send notifications for changed items
-                            if item_id in temp_available_items:
-                                user_settings = self.db.get_user_settings(key)
-                                if user_settings and user_settings[temp_available_items[item_id]] == 1:
-                                    message, item_id, store_id, store_name = self.format_message(item, temp_available_items[item_id])
-                                    self.logger.info(f"{temp_available_items[item_id]} Telegram USER_ID: {key}\n{message}")
-                                    self.message_queue.put((key, message, item_id, store_id, store_name))
-                    
-                    except Exception as e:
-                        # Log individual user processing errors
-                        self.logger.error(f"Error processing user {key}: {str(e)}")
-                        consecutive_errors += 1
-                        
-                        # If too many consecutive errors, pause processing
-                        if consecutive_errors >= max_consecutive_errors:
-                            self.logger.critical(f"Reached max consecutive errors ({max_consecutive_errors}). Pausing processing.")
-                            break
-                        
-                        continue
-                
-                # Save updated available items
-                self.db.save_available_items_favorites(available_items_favorites)
-            
-            except Exception as err:
-                # Log unexpected global errors
-                self.logger.error(f"Unexpected error in get_available_items_per_user: {err}", exc_info=True)
-                consecutive_errors += 1
-                
-                # If too many consecutive errors, add a longer pause
-                if consecutive_errors >= max_consecutive_errors:
-                    self.logger.critical(f"Reached max consecutive errors ({max_consecutive_errors}). Adding extended pause.")
-                    time.sleep(3600)  # 1-hour pause
-                    consecutive_errors = 0
-            
-            # Add random jitter to the main loop delay (between 13 and 17 minutes)
-            if not self.shutdown_flag.is_set():
-                base_delay = 900  # 15 minutes base
-                jitter = random.uniform(-120, 120)  # ±2 minutes jitter
-                # Add small random noise for less predictability
-                noise = random.uniform(-10, 10)
-                total_delay = base_delay + jitter + noise
-                self.shutdown_flag.wait(timeout=total_delay)
-        
-        self.logger.info("Background thread has finished.")
+    async def fetch_within_budget(self, user_id, cancel_event=None):
+        """
+        fetch_user_items for a fetch outside the poller, like /info. It waits for the
+        shared request budget and reports pushback to it, so it counts like a poll.
+        Raises FetchCancelled if `cancel_event` is set while waiting.
+        """
+        budget = self.request_budget
+        acquire = asyncio.ensure_future(budget.acquire())
+        cancelled = asyncio.ensure_future((cancel_event or self.shutdown_flag).wait())
+        try:
+            done, _ = await asyncio.wait((acquire, cancelled), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            acquire.cancel()
+            cancelled.cancel()
+        if acquire not in done:
+            raise FetchCancelled()
+        try:
+            items = await self.fetch_user_items(user_id)
+        except Exception as e:
+            if budget.on_error(e):
+                self.logger.warning(f"TGTG is pushing back, lowering the request rate to {budget.rate * 60:.1f}/min")
+            raise
+        budget.on_success()
+        return items
 
-    async def process_message_queue(self):
-        while not self.shutdown_flag.is_set():
+    async def fetch_user_items(self, user_id):
+        """
+        Fetch a user's favourites through their session, backing the session off on failure.
+        A rejected access token (401) is refreshed and the fetch retried once.
+        """
+        session = await self.connect(user_id)
+        async with session.lock:
+            started = time.monotonic()
             try:
-                key, message, item_id, store_id, store_name = await asyncio.get_event_loop().run_in_executor(
-                    None, self.message_queue.get, True, 1.0
-                )
                 try:
-                    await self.send_message_with_link(key, message, item_id, store_id, store_name)
-                    self.logger.info(f"Message sent to user {key}")
-                except Exception as e:
-                    self.logger.error(f"Error sending message: {e}")
-                finally:
-                    self.message_queue.task_done()
-            except queue.Empty:
-                pass
+                    items = await self.get_favourite_items(session)
+                except TgtgAPIError as e:
+                    if error_kind(e) != 'unauthorized':
+                        raise
+                    self.logger.warning(f"Authentication failed for user {user_id}, attempting refresh: {str(e)}")
+                    refreshed = await self.refresh_credentials(user_id)
+                    if not refreshed:
+                        self.logger.error(f"Could not refresh credentials for user {user_id}")
+                        raise
+                    session = refreshed
+                    items = await self.get_favourite_items(session)
             except Exception as e:
-                self.logger.error(f"Unexpected error in process_message_queue: {e}", exc_info=True)
-                await asyncio.sleep(1)
+                metrics.TGTG_ERRORS.inc(kind=error_kind(e))
+                delay = session.record_failure()
+                if delay:
+                    self.logger.warning(f"Circuit for user {user_id} is open for {delay} seconds after {session.failures} failed fetch(es)")
+                raise
+            elapsed = time.monotonic() - started
+            metrics.FETCH_SECONDS.observe(elapsed)
+            session.record_success(elapsed)
+        self.save_session_credentials(session)
+        return items
+
+    def save_session_credentials(self, session):
+        """Persist a session's credentials, but only if its client rotated the tokens."""
+        credentials = session.current_credentials()
+        if credentials != session.credentials:
+            session.credentials = credentials
+            self.users_login_data[session.user_id] = credentials
+            self.db.save_users_login_data(self.users_login_data, [session.user_id])
+
+    def process_user_items(self, key, available_items, snapshots):
+        """
+        Diff a user's favourites against their own stored snapshot.
+        Returns the (Snapshot, catalog) pairs of items whose snapshot changed, the IDs
+        of items that are no longer among the user's favourites, the notifications to send
+        and the Snapshot of every item diffed, for the scheduler.
+        """
+        changed_items = []
+        notifications = []
+        seen_snapshots = []
+        seen_item_ids = set()
+        for item in available_items:
+            if self.shutdown_flag.is_set():
+                return changed_items, [], notifications, seen_snapshots
+
+            item_id = item['item']['item_id']
+            store_id = item['store']['store_id']
+            seen_item_ids.add(item_id)
+
+            # Skip blacklisted stores
+            if self.user_index.is_blacklisted(key, store_id):
+                continue
+
+            entry = self.item_cache.lookup(item)
+            snapshot = entry.snapshot
+            seen_snapshots.append(snapshot)
+            old = snapshots.get(item_id)
+            new_items_available = snapshot.items_available
+            status = None
+
+            # Check if this is a completely new item
+            if old is None:
+                if new_items_available > 0:
+                    status = "new_stock"
+            # Check for changes in existing items
+            else:
+                old_items_available = old.items_available
+
+                # Determine status based on availability changes
+                if new_items_available == 0 and old_items_available > 0:
+                    status = "sold_out"
+                elif old_items_available == 0 and new_items_available > 0:
+                    status = "new_stock"
+                elif old_items_available > new_items_available:
+                    status = "stock_reduced"
+                elif old_items_available < new_items_available:
+                    status = "stock_increased"
+
+            # Learn restock times from real transitions, not from items seen for the first time
+            if old is not None and status in ('new_stock', 'sold_out'):
+                self.restock_model.observe(item_id, store_id, status, snapshot.pickup_start, snapshot.pickup_end)
+
+            # Only changed snapshots are written back, each change gets a new version
+            if snapshot_changed(old, snapshot):
+                # The cached snapshot is shared, so the versioned copy is this user's own
+                snapshot = snapshot.next_version(old)
+                changed_items.append((snapshot, project_catalog(item)))
+
+            # Notify about changed items
+            if status and self.user_index.wants(key, status):
+                message, item_id, store_id, store_name = self.cached_message(item, entry, status)
+                self.logger.info(f"{status} Telegram USER_ID: {key}\n{message}")
+                notification_key = Notification.make_key(key, item_id, status, snapshot.version)
+                notifications.append(Notification(notification_key, key, message, item_id, store_id, store_name, status,
+                                                  expires_at=snapshot.pickup_end))
+
+        self.restock_model.set_user_stores(key, {item['store']['store_id'] for item in available_items})
+        removed_item_ids = [item_id for item_id in snapshots if item_id not in seen_item_ids]
+        return changed_items, removed_item_ids, notifications, seen_snapshots
 
     async def graceful_shutdown(self):
         """Gracefully shut down all components."""
         self.logger.info("Initiating graceful shutdown...")
         
-        # Set shutdown flag first
+        # Set shutdown flag first and abort in-flight /info fetches
         self.shutdown_flag.set()
+        for cancel_event in list(self.info_requests.values()):
+            cancel_event.set()
         
         try:
-            # Wait for background thread with a longer timeout
-            self.logger.info("Waiting for background thread to finish...")
-            self.thread.join(timeout=5)  # Reduced timeout to 5 seconds
-            if self.thread.is_alive():
-                self.logger.warning("Background thread did not terminate within the timeout period.")
+            if self.shards:
+                self.logger.info("Stopping poll shards...")
+                await self.shards.stop()
+            else:
+                self.poller.stop()
+                self.token_refresher.stop()
+                # Wait for the poller with a short timeout
+                self.logger.info("Waiting for poller to finish...")
+                try:
+                    await asyncio.wait_for(self.poller_task, timeout=5)
+                except asyncio.TimeoutError:
+                    self.logger.warning("Poller did not terminate within the timeout period.")
             
-            # Process remaining messages in queue without waiting
-            if not self.message_queue.empty():
-                self.logger.info("Clearing message queue...")
-                while not self.message_queue.empty():
-                    try:
-                        self.message_queue.get_nowait()
-                        self.message_queue.task_done()
-                    except queue.Empty:
-                        break
+            # Stop delivering notifications
+            undelivered = await self.outbox.stop()
+            if undelivered:
+                self.logger.info(f"{undelivered} undelivered notifications stay in the outbox for the next start")
+            
+            # Hand the users, and the undelivered alerts, over to the other instances
+            if self.leases:
+                await self.leases.stop()
             
             # Close bot and database connections
             self.logger.info("Closing connections...")
             try:
-                if hasattr(self.client, 'close') and callable(self.client.close):
-                    await self.client.close()
-                
-                # Close all connected clients
-                for client in self.connected_clients.values():
-                    if hasattr(client, 'close') and callable(client.close):
-                        await client.close()
+                await self.http_pool.close()
             except Exception as e:
                 self.logger.error(f"Error closing TGTG clients: {e}")
+            await self.metrics_server.stop()
             
             try:
-                if hasattr(self.bot, 'session') and self.bot.session:
-                    await self.bot.session.close()
-                await self.bot.close()
+                if self.bot:
+                    if hasattr(self.bot, 'session') and self.bot.session:
+                        await self.bot.session.close()
+                    await self.bot.close()
             except Exception as e:
                 self.logger.error(f"Error closing bot: {e}")
             
@@ -485,6 +736,8 @@ class TooGoodToGo:
             self.logger.warning(f"Unauthorized blacklist attempt by user {user_id}")
             return False
         self.db.add_blacklisted_store(user_id, store_id, store_name)
+        self.user_index.add_blacklisted(user_id, store_id)
+        self.user_changed(user_id)
         message = (f"Store '{store_name}' has been added to your blacklist.\n\n"
                    f"To view and manage your blacklist, use the /blacklist command. "
                    f"You can easily remove stores from your blacklist using the provided buttons.")
@@ -496,6 +749,8 @@ class TooGoodToGo:
             self.logger.warning(f"Unauthorized blacklist removal attempt by user {user_id}")
             return False
         self.db.remove_blacklisted_store(user_id, store_id)
+        self.user_index.remove_blacklisted(user_id, store_id)
+        self.user_changed(user_id)
         await self.send_message(user_id, f"Store '{store_name}' has been removed from your blacklist.")
         return True
 
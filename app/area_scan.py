@@ -0,0 +1,197 @@
+import math
+import os
+import time
+import metrics
+from rate_limit import error_kind
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def item_location(item):
+    """(latitude, longitude) of an item's store, or None if TGTG did not send one."""
+    location = item['store'].get('store_location', {}).get('location') or {}
+    if 'latitude' not in location or 'longitude' not in location:
+        return None
+    return location['latitude'], location['longitude']
+
+
+class AreaQuery:
+    """One TGTG area search, shared by every chat whose subscription it covers."""
+
+    __slots__ = ('latitude', 'longitude', 'radius', 'chats')
+
+    def __init__(self, latitude, longitude, radius):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+        self.chats = set()
+
+    def covers(self, latitude, longitude, radius=0.0):
+        return distance_km(self.latitude, self.longitude, latitude, longitude) + radius <= self.radius
+
+    def __repr__(self):
+        return f"({self.latitude}, {self.longitude}, {self.radius} km)"
+
+
+class AreaScanner:
+    """
+    Optional shared scan mode (SCAN_MODE=area). Chats subscribe to an area or to
+    single stores, and the scanner turns all subscriptions into as few TGTG area
+    searches as it can. The searches run through a small pool of service accounts
+    and their results are fanned out to every matching chat, so upstream requests
+    scale with the number of distinct areas instead of the number of chats.
+
+    Subscriptions are kept in memory; TooGoodToGo persists every change.
+    """
+
+    # A followed store is searched for with a small circle around it
+    store_radius = 1.0
+
+    def __init__(self, tgtg, logger):
+        self.tgtg = tgtg
+        self.logger = logger
+        self.enabled = os.getenv('SCAN_MODE', 'favorites').lower() == 'area'
+        self.grid = float(os.getenv('AREA_GRID', 0.01))
+        self.page_size = int(os.getenv('AREA_PAGE_SIZE', 100))
+        self.max_pages = int(os.getenv('AREA_MAX_PAGES', 5))
+        service_users = [user_id.strip() for user_id in os.getenv('AREA_SCAN_USERS', '').split(',') if user_id.strip()]
+        # Without explicit service accounts, the admins' logins run the searches
+        self.service_users = service_users or list(tgtg.admin_ids)
+        self.areas = {}
+        self.stores = {}
+        self._next_service_user = 0
+
+    def load(self, db):
+        self.areas = {chat_id: (latitude, longitude, radius)
+                      for chat_id, latitude, longitude, radius in db.get_area_subscriptions()}
+        self.stores = {}
+        for chat_id, store_id, latitude, longitude in db.get_store_subscriptions():
+            self.stores.setdefault(chat_id, {})[store_id] = (latitude, longitude)
+
+    def active(self):
+        """True if area mode is on and at least one service account is logged in."""
+        return self.enabled and any(user_id in self.tgtg.users_login_data for user_id in self.service_users)
+
+    def is_subscribed(self, chat_id):
+        return chat_id in self.areas or chat_id in self.stores
+
+    def set_area(self, chat_id, latitude, longitude, radius):
+        self.areas[chat_id] = (latitude, longitude, radius)
+
+    def set_stores(self, chat_id, stores):
+        """Follow `stores`, given as {store_id: (latitude, longitude)}."""
+        if stores:
+            self.stores[chat_id] = dict(stores)
+        else:
+            self.stores.pop(chat_id, None)
+
+    def remove(self, chat_id):
+        self.areas.pop(chat_id, None)
+        self.stores.pop(chat_id, None)
+
+    def _snap(self, latitude, longitude, radius):
+        """Round a circle onto the grid, growing it so the rounded circle still covers the original."""
+        snapped_latitude = round(round(latitude / self.grid) * self.grid, 6)
+        snapped_longitude = round(round(longitude / self.grid) * self.grid, 6)
+        slack = distance_km(latitude, longitude, snapped_latitude, snapped_longitude)
+        return AreaQuery(snapped_latitude, snapped_longitude, math.ceil(radius + slack))
+
+    def plan(self):
+        """
+        Build the area searches for this cycle. Nearby subscriptions land on the same
+        grid point and share one search, and searches inside a larger one are dropped.
+        """
+        queries = {}
+
+        def add(chat_id, latitude, longitude, radius):
+            query = self._snap(latitude, longitude, radius)
+            query = queries.setdefault((query.latitude, query.longitude, query.radius), query)
+            query.chats.add(chat_id)
+
+        for chat_id, (latitude, longitude, radius) in self.areas.items():
+            add(chat_id, latitude, longitude, radius)
+        for chat_id, stores in self.stores.items():
+            for latitude, longitude in stores.values():
+                add(chat_id, latitude, longitude, self.store_radius)
+
+        merged = []
+        for query in sorted(queries.values(), key=lambda query: query.radius, reverse=True):
+            container = next((larger for larger in merged
+                              if larger.covers(query.latitude, query.longitude, query.radius)), None)
+            if container:
+                container.chats |= query.chats
+            else:
+                merged.append(query)
+        return merged
+
+    async def _service_session(self):
+        """Round robin over the logged-in service accounts that are not backing off."""
+        candidates = [user_id for user_id in self.service_users if user_id in self.tgtg.users_login_data]
+        for _ in range(len(candidates)):
+            user_id = candidates[self._next_service_user % len(candidates)]
+            self._next_service_user += 1
+            session = self.tgtg.sessions.get(user_id)
+            if session and session.in_backoff():
+                continue
+            return await self.tgtg.connect(user_id)
+        raise Exception("No service account available for area scans")
+
+    async def fetch_page(self, query, page):
+        """Fetch one page of an area search through the next service account."""
+        session = await self._service_session()
+        async with session.lock:
+            started = time.monotonic()
+            try:
+                items = await session.client.get_items(favorites_only=False, latitude=query.latitude,
+                                                       longitude=query.longitude, radius=query.radius,
+                                                       page_size=self.page_size, page=page)
+            except Exception as e:
+                metrics.TGTG_ERRORS.inc(kind=error_kind(e))
+                delay = session.record_failure()
+                if delay:
+                    self.logger.warning(f"Circuit for service account {session.user_id} is open for {delay} seconds after {session.failures} failed fetch(es)")
+                raise
+            elapsed = time.monotonic() - started
+            metrics.FETCH_SECONDS.observe(elapsed)
+            session.record_success(elapsed)
+        self.tgtg.save_session_credentials(session)
+        return items
+
+    def _matches(self, chat_id, store_id, location):
+        stores = self.stores.get(chat_id)
+        if stores and store_id in stores:
+            return True
+        area = self.areas.get(chat_id)
+        return area is not None and location is not None and distance_km(area[0], area[1], *location) <= area[2]
+
+    def fan_out(self, queries, results):
+        """
+        Map every chat served by `queries` to the items of its searches that match
+        its subscription. `results` holds the items of each search that succeeded.
+        Chats that depend on a failed search are left out for this cycle, so a missing
+        page is never mistaken for items that disappeared.
+        """
+        failed = set()
+        for query in queries:
+            if query not in results:
+                failed |= query.chats
+
+        matched = {chat_id: {} for query in queries for chat_id in query.chats if chat_id not in failed}
+        for query in queries:
+            chats = [chat_id for chat_id in query.chats if chat_id in matched]
+            for item in results.get(query, ()):
+                store_id = item['store']['store_id']
+                location = item_location(item)
+                for chat_id in chats:
+                    if self._matches(chat_id, store_id, location):
+                        matched[chat_id][item['item']['item_id']] = item
+        if failed:
+            self.logger.warning(f"Skipping {len(failed)} chat(s) this cycle because an area search failed")
+        return {chat_id: list(items.values()) for chat_id, items in matched.items()}
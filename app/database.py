@@ -1,103 +1,639 @@
 import sqlite3
 import json
+import logging
+import os
 import threading
+import time
 import secrets
 import string
+from concurrent.futures import Future
+from queue import Queue, Empty
+import metrics
+from snapshot import Snapshot, project_item
 
-class Database:
-    _local = threading.local()
+logger = logging.getLogger(__name__)
+
+# Bump this and add a step to create_tables() whenever the schema changes
+SCHEMA_VERSION = 7
+
+# Applied to every connection. WAL lets readers run while the writer commits.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=67108864',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+_STOP = object()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long each statement takes, per kind of connection."""
+
+    connection = 'read'
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, connection=self.connection)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, connection=self.connection)
+
+
+class WriteCursor(TimedCursor):
+    connection = 'write'
+
+
+def open_connection(db_file):
+    conn = sqlite3.connect(db_file)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class _WriteJob:
+    __slots__ = ('func', 'urgent', 'future')
+
+    def __init__(self, func, urgent):
+        self.func = func
+        self.urgent = urgent
+        self.future = Future()
 
+
+class DatabaseWriter(threading.Thread):
+    """
+    Owns the only write connection. Queued mutations are grouped into one
+    transaction every `flush_interval` seconds; urgent jobs (callers waiting
+    on the result) flush the batch immediately.
+    """
+
+    def __init__(self, db_file, flush_interval=0.05, max_batch=500):
+        super().__init__(name='db-writer', daemon=True)
+        self.db_file = db_file
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.jobs = Queue()
+        self.transactions = 0
+        self.writes = 0
+
+    def submit(self, func, urgent=False):
+        if not self.is_alive():
+            raise sqlite3.ProgrammingError("Database writer is not running")
+        job = _WriteJob(func, urgent)
+        self.jobs.put(job)
+        return job.future
+
+    def stop(self):
+        if self.is_alive():
+            self.jobs.put(_STOP)
+            self.join()
+
+    def run(self):
+        conn = open_connection(self.db_file)
+        conn.isolation_level = None  # transactions are managed explicitly
+        cursor = conn.cursor(WriteCursor)
+        running = True
+        while running:
+            batch = [self.jobs.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not _STOP and not batch[-1].urgent and len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.jobs.get(timeout=remaining) if remaining > 0 else self.jobs.get_nowait())
+                except Empty:
+                    break
+            if batch[-1] is _STOP:
+                batch.pop()
+                running = False
+            if batch:
+                self._commit(cursor, batch)
+        conn.close()
+
+    def _commit(self, cursor, batch):
+        results = []
+        started = time.perf_counter()
+        try:
+            cursor.execute('BEGIN')
+            for job in batch:
+                # A failing job only rolls back its own changes
+                cursor.execute('SAVEPOINT job')
+                try:
+                    results.append((job, job.func(cursor), None))
+                    cursor.execute('RELEASE job')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO job')
+                    cursor.execute('RELEASE job')
+                    results.append((job, None, e))
+            cursor.execute('COMMIT')
+        except Exception as e:
+            logger.error(f"Database write transaction failed: {e}")
+            if cursor.connection.in_transaction:
+                cursor.execute('ROLLBACK')
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        self.transactions += 1
+        self.writes += len(batch)
+        metrics.DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started)
+        for job, result, error in results:
+            if error is not None:
+                if not job.urgent:
+                    logger.error(f"Database write failed: {error}")
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+
+class Database:
     def __init__(self, db_file):
         self.db_file = db_file
-        self._connect()
+        self._local = threading.local()
+        self._writer = DatabaseWriter(db_file, float(os.getenv('DB_FLUSH_INTERVAL', 0.05)))
+        self._writer.start()
+        self._write(self.create_tables, wait=True)
+        # The instance outbox rows are written for, when several share the database
+        self.node = None
 
     def _connect(self):
-        if not hasattr(self._local, 'conn') or self._local.conn is None:
-            self._local.conn = sqlite3.connect(self.db_file)
-            self._local.cursor = self._local.conn.cursor()
-        self.create_tables()
+        """Open this thread's read connection on first use."""
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = open_connection(self.db_file)
+            self._local.cursor = self._local.conn.cursor(TimedCursor)
 
-    def create_tables(self):
-        self._local.cursor.execute('''
+    def _write(self, func, wait=False):
+        """
+        Queue `func(cursor)` on the writer thread. With `wait`, block until it is
+        committed and return its result; otherwise return the pending Future.
+        """
+        future = self._writer.submit(func, urgent=wait)
+        return future.result() if wait else future
+
+    def barrier(self):
+        """A Future that completes once every write queued before it is committed."""
+        return self._write(lambda cursor: None)
+
+    def _schema_version(self, cursor):
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        cursor.execute('SELECT version FROM schema_version')
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def create_tables(self, cursor):
+        version = self._schema_version(cursor)
+        if version >= SCHEMA_VERSION:
+            return
+        if version < 1:
+            self._create_base_tables(cursor)
+        if version < 2:
+            self._migrate_item_snapshots(cursor)
+        if version < 3:
+            self._create_outbox(cursor)
+        if version < 4:
+            self._create_subscriptions(cursor)
+        if version < 5:
+            self._create_stock_events(cursor)
+        if version < 6:
+            self._create_sent_messages(cursor)
+        if version < 7:
+            self._create_leases(cursor)
+        cursor.execute('DELETE FROM schema_version')
+        cursor.execute('INSERT INTO schema_version VALUES (?)', (SCHEMA_VERSION,))
+
+    def _create_base_tables(self, cursor):
+        cursor.execute('''
         CREATE TABLE IF NOT EXISTS users_login_data
         (user_id TEXT PRIMARY KEY, credentials TEXT)
         ''')
-        self._local.cursor.execute('''
+        cursor.execute('''
         CREATE TABLE IF NOT EXISTS users_settings_data
         (user_id TEXT PRIMARY KEY, settings TEXT)
         ''')
-        self._local.cursor.execute('''
+        cursor.execute('''
         CREATE TABLE IF NOT EXISTS available_items_favorites
         (item_id TEXT PRIMARY KEY, item_data TEXT)
         ''')
-        self._local.cursor.execute('''
+        cursor.execute('''
         CREATE TABLE IF NOT EXISTS blacklisted_stores
         (user_id TEXT, store_id TEXT, store_name TEXT,
         PRIMARY KEY (user_id, store_id))
         ''')
-        self._local.cursor.execute('''
+        cursor.execute('''
         CREATE TABLE IF NOT EXISTS private_access
         (token TEXT PRIMARY KEY, user_id TEXT UNIQUE, first_name TEXT)
         ''')
-        self._local.cursor.execute('''
+        cursor.execute('''
 CREATE TABLE IF NOT EXISTS admin_users
 (user_id TEXT PRIMARY KEY)
 ''')
-        self._local.conn.commit()
+
+    def _migrate_item_snapshots(self, cursor):
+        """
+        v2: replace the shared available_items_favorites JSON blobs with normalized
+        stores/items tables and a per-user snapshot of the fields the diff needs.
+        """
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stores
+        (store_id TEXT PRIMARY KEY, store_name TEXT, address TEXT)
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS items
+        (item_id TEXT PRIMARY KEY, store_id TEXT NOT NULL, item_name TEXT, price_minor INTEGER)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_items_store ON items (store_id)')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_item_snapshots
+        (user_id TEXT NOT NULL, item_id TEXT NOT NULL, items_available INTEGER NOT NULL,
+        price_minor INTEGER, pickup_start INTEGER, pickup_end INTEGER, updated_at INTEGER NOT NULL,
+        PRIMARY KEY (user_id, item_id)) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_item ON user_item_snapshots (item_id)')
+
+        cursor.execute('SELECT item_data FROM available_items_favorites')
+        projected = []
+        for (item_data,) in cursor.fetchall():
+            try:
+                projected.append(project_item(json.loads(item_data)))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping unreadable item during migration: {e}")
+        cursor.executemany('INSERT OR REPLACE INTO stores VALUES (?, ?, ?)',
+                           {(item['store_id'], item['store_name'], item['address']) for item in projected})
+        cursor.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+                           [(item['item_id'], item['store_id'], item['item_name'], item['price_minor']) for item in projected])
+
+        # The old snapshot was shared by everyone, so seed each user with it. This keeps
+        # the first cycle after the upgrade quiet; rows for items a user does not have
+        # are pruned on that user's next poll.
+        cursor.execute('SELECT user_id FROM users_login_data')
+        now = int(time.time())
+        for (user_id,) in cursor.fetchall():
+            cursor.executemany('''
+            INSERT OR REPLACE INTO user_item_snapshots
+            (user_id, item_id, items_available, price_minor, pickup_start, pickup_end, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(user_id, item['item_id'], item['items_available'], item['price_minor'],
+                   item['pickup_start'], item['pickup_end'], now) for item in projected])
+        cursor.execute('DROP TABLE available_items_favorites')
+
+    def _create_outbox(self, cursor):
+        """
+        v3: persistent notification outbox. Snapshots get a version that is bumped on
+        every change, so (chat, item, status, version) identifies one alert.
+        """
+        cursor.execute('ALTER TABLE user_item_snapshots ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox
+        (idempotency_key TEXT PRIMARY KEY, chat_id TEXT NOT NULL, item_id TEXT, store_id TEXT,
+        store_name TEXT, text TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+        expires_at INTEGER, created_at INTEGER NOT NULL, updated_at INTEGER NOT NULL)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_state ON outbox (state, created_at)')
+
+    def _create_subscriptions(self, cursor):
+        """v4: area and store subscriptions for the shared area scan mode."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS area_subscriptions
+        (chat_id TEXT PRIMARY KEY, latitude REAL NOT NULL, longitude REAL NOT NULL, radius REAL NOT NULL)
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS store_subscriptions
+        (chat_id TEXT NOT NULL, store_id TEXT NOT NULL, latitude REAL NOT NULL, longitude REAL NOT NULL,
+        PRIMARY KEY (chat_id, store_id)) WITHOUT ROWID
+        ''')
+
+    def _create_stock_events(self, cursor):
+        """v5: history of new_stock and sold_out transitions, used to learn restock times."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_events
+        (item_id TEXT NOT NULL, store_id TEXT NOT NULL, event TEXT NOT NULL, occurred_at INTEGER NOT NULL,
+        pickup_start INTEGER, pickup_end INTEGER)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_stock_events_time ON stock_events (occurred_at)')
+
+    def _create_sent_messages(self, cursor):
+        """
+        v6: the Telegram messages alerts were delivered in, one row per item shown in
+        a message, so later changes can edit them in place. Outbox rows get their status.
+        """
+        cursor.execute('ALTER TABLE outbox ADD COLUMN status TEXT')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sent_messages
+        (chat_id TEXT NOT NULL, message_id INTEGER NOT NULL, item_id TEXT NOT NULL, position INTEGER NOT NULL,
+        text TEXT NOT NULL, store_id TEXT, store_name TEXT, sent_at INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, message_id, item_id)) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sent_messages_time ON sent_messages (sent_at)')
+
+    def _create_leases(self, cursor):
+        """
+        v7: leases on users and heartbeats of the instances holding them, for running
+        several instances on one database (see leases.py). Outbox rows get the instance
+        that delivers them.
+        """
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leases
+        (user_id TEXT PRIMARY KEY, node TEXT NOT NULL, expires_at REAL NOT NULL, touched INTEGER NOT NULL DEFAULT 0)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_leases_node ON leases (node)')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS nodes
+        (node TEXT PRIMARY KEY, expires_at REAL NOT NULL)
+        ''')
+        cursor.execute('ALTER TABLE outbox ADD COLUMN node TEXT')
+
+    def _upsert_json_rows(self, table, data, keys):
+        """Queue an upsert of `data[key]` for each of `keys` (all of `data` if None)."""
+        keys = data.keys() if keys is None else keys
+        rows = [(key, json.dumps(data[key])) for key in keys if key in data]
+        if rows:
+            return self._write(lambda cursor: cursor.executemany(f'INSERT OR REPLACE INTO {table} VALUES (?, ?)', rows))
 
     def get_users_login_data(self):
         self._connect()
         self._local.cursor.execute('SELECT * FROM users_login_data')
         return {row[0]: json.loads(row[1]) for row in self._local.cursor.fetchall()}
 
-    def save_users_login_data(self, data):
+    def get_user_ids(self):
+        """IDs of every logged-in user."""
         self._connect()
-        for user_id, credentials in data.items():
-            self._local.cursor.execute('INSERT OR REPLACE INTO users_login_data VALUES (?, ?)',
-                                (user_id, json.dumps(credentials)))
-        self._local.conn.commit()
+        self._local.cursor.execute('SELECT user_id FROM users_login_data')
+        return [row[0] for row in self._local.cursor.fetchall()]
+
+    def save_users_login_data(self, data, user_ids=None):
+        return self._upsert_json_rows('users_login_data', data, user_ids)
 
     def get_users_settings_data(self):
         self._connect()
         self._local.cursor.execute('SELECT * FROM users_settings_data')
         return {row[0]: json.loads(row[1]) for row in self._local.cursor.fetchall()}
 
-    def save_users_settings_data(self, data):
+    def save_users_settings_data(self, data, user_ids=None):
+        return self._upsert_json_rows('users_settings_data', data, user_ids)
+
+    @staticmethod
+    def _snapshot_row(user_id, snapshot, updated_at):
+        return (user_id, snapshot.item_id, snapshot.items_available, snapshot.price_minor,
+                snapshot.pickup_start, snapshot.pickup_end, updated_at, snapshot.version)
+
+    @staticmethod
+    def _upsert_catalog(cursor, items):
+        """Upsert (snapshot, (store_name, address, item_name)) pairs into the stores and items tables."""
+        cursor.executemany('INSERT OR REPLACE INTO stores VALUES (?, ?, ?)',
+                           {(snapshot.store_id, store_name, address) for snapshot, (store_name, address, _) in items})
+        cursor.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+                           [(snapshot.item_id, snapshot.store_id, item_name, snapshot.price_minor)
+                            for snapshot, (_, _, item_name) in items])
+
+    def get_user_snapshots(self, user_id):
+        """Return {item_id: Snapshot} for every item last seen in this user's favourites."""
+        self._connect()
+        self._local.cursor.execute('''
+        SELECT s.item_id, i.store_id, s.items_available, s.price_minor, s.pickup_start, s.pickup_end, s.version
+        FROM user_item_snapshots s LEFT JOIN items i ON i.item_id = s.item_id WHERE s.user_id = ?
+        ''', (user_id,))
+        # Built row by row off the cursor, without an intermediate list of tuples
+        return {row[0]: Snapshot(*row) for row in self._local.cursor}
+
+    def save_user_snapshots(self, user_id, changed_items, removed_item_ids=(), notifications=()):
+        """
+        Queue one transaction that upserts this user's changed items, given as
+        (Snapshot, (store_name, address, item_name)) pairs, drops items no longer in
+        their favourites and records the resulting notifications in the outbox. Writing both together
+        means a crash can never save a snapshot while losing its alerts.
+        The future resolves to the set of idempotency keys that were not already queued.
+        """
+        if not changed_items and not removed_item_ids and not notifications:
+            return None
+        now = int(time.time())
+        rows = [self._snapshot_row(user_id, snapshot, now) for snapshot, _ in changed_items]
+        removed = [(user_id, item_id) for item_id in removed_item_ids]
+        outbox_rows = [(n.key, n.chat_id, n.item_id, n.store_id, n.store_name, n.text, n.status, n.expires_at, now, now,
+                        self.node) for n in notifications]
+
+        def write(cursor):
+            self._upsert_catalog(cursor, changed_items)
+            cursor.executemany('INSERT OR REPLACE INTO user_item_snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            cursor.executemany('DELETE FROM user_item_snapshots WHERE user_id = ? AND item_id = ?', removed)
+            inserted = set()
+            for row in outbox_rows:
+                cursor.execute('''
+                INSERT OR IGNORE INTO outbox
+                (idempotency_key, chat_id, item_id, store_id, store_name, text, status, state, expires_at, created_at,
+                updated_at, node)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?, ?)
+                ''', row)
+                if cursor.rowcount:
+                    inserted.add(row[0])
+            return inserted
+
+        return self._write(write)
+
+    def get_user_stores(self):
+        """(user_id, store_id) for every store in a user's last seen favourites."""
         self._connect()
-        for user_id, settings in data.items():
-            self._local.cursor.execute('INSERT OR REPLACE INTO users_settings_data VALUES (?, ?)',
-                                (user_id, json.dumps(settings)))
-        self._local.conn.commit()
+        self._local.cursor.execute('''
+        SELECT DISTINCT s.user_id, i.store_id FROM user_item_snapshots s JOIN items i ON i.item_id = s.item_id
+        ''')
+        return self._local.cursor.fetchall()
 
-    def get_available_items_favorites(self):
+    def get_pickup_windows(self, now):
+        """(user_id, pickup_start, pickup_end) of every snapshot whose pickup window has not ended."""
         self._connect()
-        self._local.cursor.execute('SELECT * FROM available_items_favorites')
-        return {row[0]: json.loads(row[1]) for row in self._local.cursor.fetchall()}
+        self._local.cursor.execute('''
+        SELECT user_id, pickup_start, pickup_end FROM user_item_snapshots
+        WHERE pickup_start IS NOT NULL AND pickup_end >= ?
+        ''', (now,))
+        return self._local.cursor.fetchall()
+
+    def record_stock_events(self, events):
+        """Queue (item_id, store_id, event, occurred_at, pickup_start, pickup_end) rows."""
+        if events:
+            return self._write(lambda cursor: cursor.executemany('INSERT INTO stock_events VALUES (?, ?, ?, ?, ?, ?)', events))
 
-    def save_available_items_favorites(self, data):
+    def get_restock_times(self, since):
         self._connect()
-        for item_id, item_data in data.items():
-            self._local.cursor.execute('INSERT OR REPLACE INTO available_items_favorites VALUES (?, ?)',
-                                (item_id, json.dumps(item_data)))
-        self._local.conn.commit()
+        self._local.cursor.execute('''
+        SELECT store_id, occurred_at, pickup_start, pickup_end FROM stock_events WHERE event = 'new_stock' AND occurred_at >= ?
+        ''', (since,))
+        return self._local.cursor.fetchall()
 
-    def add_blacklisted_store(self, user_id, store_id, store_name):
+    def purge_stock_events(self, older_than):
+        return self._write(lambda cursor: cursor.execute('DELETE FROM stock_events WHERE occurred_at < ?', (older_than,)))
+
+    def get_pending_notifications(self):
         self._connect()
-        self._local.cursor.execute('INSERT OR REPLACE INTO blacklisted_stores VALUES (?, ?, ?)',
-                            (user_id, store_id, store_name))
-        self._local.conn.commit()
+        self._local.cursor.execute('''
+        SELECT idempotency_key, chat_id, item_id, store_id, store_name, text, status, attempts, expires_at
+        FROM outbox WHERE state = 'pending' ORDER BY created_at
+        ''')
+        return self._local.cursor.fetchall()
 
-    def remove_blacklisted_store(self, user_id, store_id):
+    def claim_notifications(self, node, keep):
+        """
+        Take over the pending outbox rows of every instance not in `keep`, for `node`
+        to deliver. Returns them oldest first, like get_pending_notifications().
+        """
+        def write(cursor):
+            cursor.execute('''
+            UPDATE outbox SET node = ?
+            WHERE state = 'pending' AND (node IS NULL OR node NOT IN (SELECT value FROM json_each(?)))
+            RETURNING idempotency_key, chat_id, item_id, store_id, store_name, text, status, attempts, expires_at, created_at
+            ''', (node, json.dumps(list(keep))))
+            return [row[:-1] for row in sorted(cursor.fetchall(), key=lambda row: row[-1])]
+
+        return self._write(write, wait=True)
+
+    def ack_notifications(self, acks):
+        """Record the outcome of delivered notifications, given as (key, state, attempts) tuples."""
+        now = int(time.time())
+        rows = [(state, attempts, now, key) for key, state, attempts in acks]
+        return self._write(lambda cursor: cursor.executemany(
+            'UPDATE outbox SET state = ?, attempts = ?, updated_at = ? WHERE idempotency_key = ?', rows))
+
+    def expire_notifications(self, now):
+        """Mark pending notifications whose pickup window has ended as expired."""
+        return self._write(lambda cursor: cursor.execute('''
+        UPDATE outbox SET state = 'expired', updated_at = ?
+        WHERE state = 'pending' AND expires_at IS NOT NULL AND expires_at <= ?
+        ''', (now, now)).rowcount, wait=True)
+
+    def purge_notifications(self, older_than):
+        """Delete finished outbox rows last touched before `older_than`."""
+        return self._write(lambda cursor: cursor.execute(
+            "DELETE FROM outbox WHERE state != 'pending' AND updated_at < ?", (older_than,)))
+
+    def record_sent_message(self, chat_id, message_id, parts, sent_at):
+        """Queue the items shown in one Telegram message, given as (item_id, text, store_id, store_name) tuples."""
+        rows = [(chat_id, message_id, item_id, position, text, store_id, store_name, sent_at)
+                for position, (item_id, text, store_id, store_name) in enumerate(parts)]
+        return self._write(lambda cursor: cursor.executemany(
+            'INSERT OR REPLACE INTO sent_messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows))
+
+    def get_sent_messages(self, since):
+        """Items of the messages sent since `since`, grouped by message and in display order."""
         self._connect()
-        self._local.cursor.execute('DELETE FROM blacklisted_stores WHERE user_id = ? AND store_id = ?',
-                            (user_id, store_id))
-        self._local.conn.commit()
+        self._local.cursor.execute('''
+        SELECT chat_id, message_id, item_id, text, store_id, store_name, sent_at FROM sent_messages
+        WHERE sent_at >= ? ORDER BY sent_at, chat_id, message_id, position
+        ''', (since,))
+        return self._local.cursor.fetchall()
+
+    def purge_sent_messages(self, older_than):
+        return self._write(lambda cursor: cursor.execute('DELETE FROM sent_messages WHERE sent_at < ?', (older_than,)))
+
+    def get_area_subscriptions(self):
+        self._connect()
+        self._local.cursor.execute('SELECT chat_id, latitude, longitude, radius FROM area_subscriptions')
+        return self._local.cursor.fetchall()
+
+    def set_area_subscription(self, chat_id, latitude, longitude, radius):
+        self._write(lambda cursor: cursor.execute('INSERT OR REPLACE INTO area_subscriptions VALUES (?, ?, ?, ?)',
+                                                  (chat_id, latitude, longitude, radius)), wait=True)
+
+    def get_store_subscriptions(self):
+        self._connect()
+        self._local.cursor.execute('SELECT chat_id, store_id, latitude, longitude FROM store_subscriptions')
+        return self._local.cursor.fetchall()
+
+    def set_store_subscriptions(self, chat_id, stores):
+        """Replace the stores a chat follows, given as {store_id: (latitude, longitude)}."""
+        rows = [(chat_id, store_id, latitude, longitude) for store_id, (latitude, longitude) in stores.items()]
+
+        def write(cursor):
+            cursor.execute('DELETE FROM store_subscriptions WHERE chat_id = ?', (chat_id,))
+            cursor.executemany('INSERT INTO store_subscriptions VALUES (?, ?, ?, ?)', rows)
+
+        self._write(write, wait=True)
+
+    def remove_subscriptions(self, chat_id):
+        def write(cursor):
+            cursor.execute('DELETE FROM area_subscriptions WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM store_subscriptions WHERE chat_id = ?', (chat_id,))
+
+        self._write(write, wait=True)
+
+    def renew_leases(self, node, ttl):
+        """
+        Mark `node` alive for `ttl` seconds and extend its leases. Returns the users it
+        holds, the nodes that are alive and the held users touched since the last call.
+        """
+        def write(cursor):
+            now = time.time()
+            cursor.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?)', (node, now + ttl))
+            cursor.execute('DELETE FROM nodes WHERE expires_at < ?', (now - 24 * 3600,))
+            cursor.execute('UPDATE leases SET expires_at = ? WHERE node = ?', (now + ttl, node))
+            cursor.execute('UPDATE leases SET touched = 0 WHERE node = ? AND touched = 1 RETURNING user_id', (node,))
+            touched = [row[0] for row in cursor.fetchall()]
+            cursor.execute('SELECT user_id FROM leases WHERE node = ?', (node,))
+            held = [row[0] for row in cursor.fetchall()]
+            cursor.execute('SELECT node FROM nodes WHERE expires_at > ?', (now,))
+            live = [row[0] for row in cursor.fetchall()]
+            return held, live, touched
+
+        return self._write(write, wait=True)
+
+    def claim_leases(self, node, user_ids, ttl, limit):
+        """Lease up to `limit` of `user_ids` that nobody holds an unexpired lease on to `node`. Returns them."""
+        def write(cursor):
+            now = time.time()
+            claimed = []
+            for user_id in user_ids:
+                cursor.execute('''
+                INSERT INTO leases (user_id, node, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET node = excluded.node, expires_at = excluded.expires_at, touched = 0
+                WHERE leases.expires_at <= ?
+                ''', (user_id, node, now + ttl, now))
+                if cursor.rowcount:
+                    claimed.append(user_id)
+                    if len(claimed) >= limit:
+                        break
+            return claimed
+
+        return self._write(write, wait=True)
+
+    def release_leases(self, node, user_ids):
+        rows = [(user_id, node) for user_id in user_ids]
+        self._write(lambda cursor: cursor.executemany('DELETE FROM leases WHERE user_id = ? AND node = ?', rows), wait=True)
+
+    def touch_lease(self, user_id):
+        """Flag a user so that the node holding their lease re-reads them."""
+        return self._write(lambda cursor: cursor.execute('UPDATE leases SET touched = 1 WHERE user_id = ?', (user_id,)))
+
+    def remove_node(self, node):
+        """Drop a node's heartbeat and leases."""
+        def write(cursor):
+            cursor.execute('DELETE FROM leases WHERE node = ?', (node,))
+            cursor.execute('DELETE FROM nodes WHERE node = ?', (node,))
+
+        self._write(write, wait=True)
+
+    def add_blacklisted_store(self, user_id, store_id, store_name):
+        self._write(lambda cursor: cursor.execute('INSERT OR REPLACE INTO blacklisted_stores VALUES (?, ?, ?)',
+                                                  (user_id, store_id, store_name)), wait=True)
+
+    def remove_blacklisted_store(self, user_id, store_id):
+        self._write(lambda cursor: cursor.execute('DELETE FROM blacklisted_stores WHERE user_id = ? AND store_id = ?',
+                                                  (user_id, store_id)), wait=True)
 
     def get_blacklisted_stores(self, user_id):
         self._connect()
         self._local.cursor.execute('SELECT store_id, store_name FROM blacklisted_stores WHERE user_id = ?', (user_id,))
         return self._local.cursor.fetchall()
 
+    def get_all_blacklisted_stores(self):
+        self._connect()
+        self._local.cursor.execute('SELECT user_id, store_id FROM blacklisted_stores')
+        return self._local.cursor.fetchall()
+
     def is_store_blacklisted(self, user_id, store_id):
         self._connect()
         self._local.cursor.execute('SELECT 1 FROM blacklisted_stores WHERE user_id = ? AND store_id = ?',
@@ -105,16 +641,16 @@ CREATE TABLE IF NOT EXISTS admin_users
         return bool(self._local.cursor.fetchone())
 
     def add_user(self, telegram_user_id, credentials):
-        self._connect()
-        self._local.cursor.execute('INSERT OR REPLACE INTO users_login_data VALUES (?, ?)',
-                            (telegram_user_id, json.dumps(credentials)))
-        self._local.conn.commit()
+        row = (telegram_user_id, json.dumps(credentials))
+        return self._write(lambda cursor: cursor.execute('INSERT OR REPLACE INTO users_login_data VALUES (?, ?)', row))
+
+    def remove_user(self, telegram_user_id):
+        return self._write(lambda cursor: cursor.execute('DELETE FROM users_login_data WHERE user_id = ?',
+                                                         (telegram_user_id,)))
 
     def add_user_settings(self, telegram_user_id, settings):
-        self._connect()
-        self._local.cursor.execute('INSERT OR REPLACE INTO users_settings_data VALUES (?, ?)',
-                            (telegram_user_id, json.dumps(settings)))
-        self._local.conn.commit()
+        row = (telegram_user_id, json.dumps(settings))
+        return self._write(lambda cursor: cursor.execute('INSERT OR REPLACE INTO users_settings_data VALUES (?, ?)', row))
 
     def find_credentials_by_telegramUserID(self, user_id):
         self._connect()
@@ -131,9 +667,7 @@ CREATE TABLE IF NOT EXISTS admin_users
     def generate_token(self):
         alphabet = string.ascii_letters + string.digits
         token = ''.join(secrets.choice(alphabet) for _ in range(32))
-        self._connect()
-        self._local.cursor.execute('INSERT INTO private_access (token) VALUES (?)', (token,))
-        self._local.conn.commit()
+        self._write(lambda cursor: cursor.execute('INSERT INTO private_access (token) VALUES (?)', (token,)), wait=True)
         return token
 
     def validate_token(self, token):
@@ -142,10 +676,9 @@ CREATE TABLE IF NOT EXISTS admin_users
         return bool(self._local.cursor.fetchone())
 
     def authorize_user(self, token, user_id, first_name):
-        self._connect()
-        self._local.cursor.execute('UPDATE private_access SET user_id = ?, first_name = ? WHERE token = ?', (user_id, first_name, token))
-        self._local.conn.commit()
-        return self._local.cursor.rowcount > 0
+        rowcount = self._write(lambda cursor: cursor.execute('UPDATE private_access SET user_id = ?, first_name = ? WHERE token = ?',
+                                                             (user_id, first_name, token)).rowcount, wait=True)
+        return rowcount > 0
 
     def is_user_authorized(self, user_id):
         self._connect()
@@ -158,7 +691,9 @@ CREATE TABLE IF NOT EXISTS admin_users
         return self._local.cursor.fetchall()
 
     def close(self):
-        if hasattr(self._local, 'conn') and self._local.conn:
+        # Stopping the writer flushes every queued write first
+        self._writer.stop()
+        if getattr(self._local, 'conn', None):
             self._local.conn.close()
             self._local.conn = None
             self._local.cursor = None
@@ -0,0 +1,72 @@
+import itertools
+import os
+import aiohttp
+
+
+class SharedHTTPPool:
+    """
+    One bounded keep-alive connection pool shared by every TGTG client. Clients
+    send their own Cookie and authorization headers, so they can all share one
+    aiohttp session and reuse the same few TLS connections to the TGTG API
+    instead of holding one idle pool each. At most `max_size` connections are
+    open per session; further requests wait for a free one.
+
+    TGTG_PROXIES may list HTTP(S) or SOCKS proxy URLs; each proxy gets its own
+    session (through aiohttp_socks) and new clients are assigned one in turn.
+    """
+
+    def __init__(self):
+        self.max_size = int(os.getenv('TGTG_POOL_SIZE', 10))
+        self.timeout = aiohttp.ClientTimeout(total=float(os.getenv('TGTG_REQUEST_TIMEOUT', 30)), connect=10)
+        self.proxies = [proxy.strip() for proxy in os.getenv('TGTG_PROXIES', '').split(',') if proxy.strip()]
+        self._proxy_cycle = itertools.cycle(self.proxies) if self.proxies else None
+        self._sessions = {}
+        self.requests = 0
+        self.connections = 0
+
+    def next_proxy(self):
+        """The next proxy URL in the rotation, or None without proxies."""
+        return next(self._proxy_cycle) if self._proxy_cycle else None
+
+    async def _on_request(self, session, context, params):
+        self.requests += 1
+
+    async def _on_connection(self, session, context, params):
+        self.connections += 1
+
+    def session(self, proxy=None):
+        """The shared aiohttp session for `proxy` (None for direct connections), created on first use."""
+        session = self._sessions.get(proxy)
+        if session is None or session.closed:
+            if proxy:
+                # Only needed with proxies, and handles both HTTP and SOCKS ones
+                from aiohttp_socks import ProxyConnector
+                connector = ProxyConnector.from_url(proxy, limit=self.max_size)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.max_size)
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self._on_request)
+            trace.on_connection_create_end.append(self._on_connection)
+            # Cookies are sent per client, a shared cookie jar would leak them between users
+            session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                            cookie_jar=aiohttp.DummyCookieJar(), trace_configs=[trace])
+            self._sessions[proxy] = session
+        return session
+
+    def next_session(self):
+        """The shared session of the next proxy in the rotation."""
+        return self.session(self.next_proxy())
+
+    def counts(self):
+        """(requests, connections) made through the pool so far."""
+        return self.requests, self.connections
+
+    def stats(self):
+        requests, connections = self.counts()
+        reused = 1 - connections / requests if requests else 0.0
+        return f"HTTP pool: {requests} requests over {connections} new connections ({reused:.0%} reused)"
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
@@ -0,0 +1,76 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import date
+import metrics
+from snapshot import project_snapshot
+
+
+class CachedItem:
+    __slots__ = ('fingerprint', 'day', 'expires_at', 'snapshot', 'messages')
+
+    def __init__(self, fingerprint, day, expires_at, snapshot):
+        self.fingerprint = fingerprint
+        self.day = day
+        self.expires_at = expires_at
+        self.snapshot = snapshot
+        # Formatted message tuples by status, created on first use
+        self.messages = None
+
+
+class ItemCache:
+    """
+    Process-wide cache of item snapshots and their formatted messages, keyed by
+    item_id. Users who favourite the same store get the same item back from TGTG,
+    so the first fetch fills the entry and every other user's diff and notifications
+    reuse it. An entry is refreshed as soon as the item's stock, price or pickup
+    window changes, after `ttl` seconds, or when the day changes (messages say
+    "Today"/"Tomorrow"). The least recently used entries are evicted past `max_size`.
+    """
+
+    def __init__(self):
+        self.ttl = float(os.getenv('ITEM_CACHE_TTL', 120))
+        self.max_size = int(os.getenv('ITEM_CACHE_SIZE', 5000))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def fingerprint(item):
+        # Hashed rather than kept as a tuple, which would hold both pickup strings per entry
+        pickup = item.get('pickup_interval') or {}
+        return hash((item['items_available'], item['item'].get('price_including_taxes', {}).get('minor_units'),
+                     pickup.get('start'), pickup.get('end')))
+
+    def lookup(self, item):
+        """Return the current entry for `item`, refreshing it if the item changed or the entry expired."""
+        item_id = item['item']['item_id']
+        fingerprint = self.fingerprint(item)
+        now = time.monotonic()
+        today = date.today()
+        entry = self.entries.get(item_id)
+        if entry is not None and entry.fingerprint == fingerprint and entry.expires_at > now and entry.day == today:
+            self.hits += 1
+            metrics.ITEM_CACHE_LOOKUPS.inc(result='hit')
+            self.entries.move_to_end(item_id)
+            return entry
+
+        self.misses += 1
+        metrics.ITEM_CACHE_LOOKUPS.inc(result='miss')
+        entry = CachedItem(fingerprint, today, now + self.ttl, project_snapshot(item))
+        self.entries[item_id] = entry
+        self.entries.move_to_end(item_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        """Summary of the lookups since the last call, which resets the counters."""
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        summary = f"Item cache: {len(self.entries)} entries, {lookups} lookups, {hit_rate:.0%} hit rate"
+        self.hits = self.misses = 0
+        return summary
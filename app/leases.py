@@ -0,0 +1,143 @@
+import asyncio
+import math
+import os
+import random
+import socket
+import time
+import metrics
+from shards import AREA_SCANS
+
+
+def node_id():
+    """This instance's name in the leases table: NODE_ID, or the host name and process id."""
+    return os.getenv('NODE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseManager:
+    """
+    Optional lease-based ownership of users (LEASES), so several instances on one
+    host can share one database without polling a user twice. The leases live in
+    the database's leases table, next to the logins, snapshots and outbox the
+    instances share anyway; SQLite's WAL mode rules out network filesystems, so
+    this does not stretch across machines. Every heartbeat the
+    instance renews its leases, hands back what it holds above its fair share of
+    the live instances, and claims up to `batch` users that nobody holds, which
+    includes the users of an instance that stopped heartbeating.
+
+    An instance stops polling a user a third of the lease time before its lease
+    could expire, and checks again before it commits alerts, so a user is never
+    diffed by two instances at once. Alerts are delivered by the instance that
+    committed them; the pending ones of an instance that died are taken over by
+    whichever instance notices first.
+    """
+
+    # Claims that filled a batch are followed up quickly instead of a heartbeat later
+    claim_interval = 1.0
+
+    def __init__(self, tgtg, logger):
+        self.tgtg = tgtg
+        self.logger = logger
+        self.node = node_id()
+        self.db = tgtg.db
+        self.ttl = float(os.getenv('LEASE_TTL', 60))
+        self.interval = self.ttl / 3
+        self.batch = int(os.getenv('LEASE_BATCH', 500))
+        self.held = set()
+        self.live = []
+        self.valid_until = 0.0
+        self.restored = False
+        self.task = None
+        self._stop = asyncio.Event()
+        metrics.LEASES_HELD.set_function(lambda: len(self.held))
+        metrics.LIVE_INSTANCES.set_function(lambda: len(self.live))
+
+    @staticmethod
+    def configured():
+        return os.getenv('LEASES', '').lower() in ('1', 'true', 'yes', 'on')
+
+    def owns(self, user_id):
+        return user_id in self.held and time.time() < self.valid_until
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        self.logger.info(f"Sharing users with other instances as {self.node}")
+
+    async def run(self):
+        while not self._stop.is_set():
+            delay = self.interval
+            try:
+                if await self.beat():
+                    delay = self.claim_interval
+            except Exception as err:
+                self.logger.error(f"Lease heartbeat failed: {err}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def beat(self):
+        """One heartbeat. Returns True if there are more users to claim than fitted in the batch."""
+        started = time.time()
+        previous = self.held
+        # After a lapse the users were dropped from the schedule when they came due, so all are new again
+        lapsed = started >= self.valid_until
+        held, self.live, touched = await asyncio.to_thread(self.db.renew_leases, self.node, self.ttl)
+        self.valid_until = started + self.ttl - self.interval
+        self.held = set(held)
+
+        users = set(await asyncio.to_thread(self.db.get_user_ids))
+        users.add(AREA_SCANS)
+        share = math.ceil(len(users) / max(1, len(self.live)))
+        # Logged-out users, then whatever is above this instance's share once others joined
+        surplus = self.held - users
+        kept = sorted(self.held - surplus)
+        if len(kept) > share:
+            surplus.update(random.sample(kept, len(kept) - share))
+        if surplus:
+            # Stop polling them before anyone else can claim them
+            self.held -= surplus
+            await asyncio.to_thread(self.db.release_leases, self.node, surplus)
+
+        more = False
+        wanted = min(self.batch, share - len(self.held))
+        if wanted > 0:
+            free = list(users - self.held)
+            random.shuffle(free)
+            claimed = await asyncio.to_thread(self.db.claim_leases, self.node, free, self.ttl, wanted)
+            self.held.update(claimed)
+            more = len(claimed) == wanted and len(self.held) < share
+            if claimed:
+                self.logger.info(f"Claimed {len(claimed)} user(s), holding {len(self.held)} "
+                                 f"of {len(users)} with {len(self.live)} instance(s)")
+
+        # On the first heartbeat that includes this node's own rows from before a restart
+        keep = self.live if self.restored else [node for node in self.live if node != self.node]
+        rows = await asyncio.to_thread(self.db.claim_notifications, self.node, keep)
+        self.restored = True
+        if rows:
+            self.tgtg.outbox.requeue(rows)
+        gained = set(self.held) if lapsed else self.held - previous
+        self.tgtg.leases_changed(gained, previous - self.held, set(touched))
+        return more
+
+    def touch(self, user_id):
+        """Have the instance holding `user_id` re-read them once the pending writes are committed."""
+        asyncio.create_task(self._touch(user_id))
+
+    async def _touch(self, user_id):
+        try:
+            # Queued behind the user's pending writes, so the flag is only seen once they are committed
+            await asyncio.wrap_future(self.db.touch_lease(user_id))
+        except Exception as err:
+            self.logger.error(f"Could not flag user {user_id} for the instance polling them: {err}")
+
+    async def stop(self):
+        """Stop heartbeating and hand every user back."""
+        self._stop.set()
+        if self.task:
+            await self.task
+        self.held = set()
+        try:
+            await asyncio.to_thread(self.db.remove_node, self.node)
+        except Exception as err:
+            self.logger.error(f"Could not release leases: {err}")
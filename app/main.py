@@ -5,6 +5,7 @@ import asyncio
 from dotenv import load_dotenv
 from Telegram import setup_bot
 from TooGoodToGo import TooGoodToGo
+from webhook import WebhookServer
 import signal
 
 # Get the project root directory (one level up from app directory)
@@ -63,6 +64,9 @@ logger.info(f"Loaded admin IDs: {admin_ids}")
 if not admin_ids:
     logger.warning("No admin IDs configured. Admin-only features will be unavailable.")
 
+# How Telegram updates reach the bot: long polling (default) or a webhook server
+bot_mode = os.getenv('BOT_MODE', 'polling').lower()
+
 # Setup TooGoodToGo handler
 tgtg_handler = None
 
@@ -118,7 +122,10 @@ async def main():
     print("Bot is now running. Press Ctrl+C to stop.")
     
     try:
-        await bot.polling(non_stop=True, timeout=60)
+        if bot_mode == 'webhook':
+            await WebhookServer(bot, logger).run()
+        else:
+            await bot.polling(non_stop=True, timeout=60)
     except asyncio.CancelledError:
         logger.info("Bot polling was cancelled")
     except Exception as e:
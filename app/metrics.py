@@ -0,0 +1,242 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+# Latency buckets in seconds, from a quick SQLite read to a slow poll behind the request budget
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = []
+
+
+class Metric:
+    """
+    Base of the metric types. Values are kept per combination of label values and
+    are safe to update from the database threads. A metric can instead read its
+    single value from a function when scraped, see set_function().
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.function = None
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def set_function(self, function):
+        """Read the value from `function()` on every scrape instead of storing it."""
+        self.function = function
+
+    def value(self, **labels):
+        if self.function is not None:
+            return self.function()
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        """(suffix, labels, value) of every sample, for the text format."""
+        if self.function is not None:
+            return [('', {}, self.function())]
+        with self._lock:
+            return [('', dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per bucket counts (the last one is +Inf), sum and count
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        state = self.values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def mean(self, **labels):
+        state = self.values.get(self._key(labels))
+        return state[1] / state[2] if state else None
+
+    def quantile(self, q, **labels):
+        """Estimate the q-quantile by interpolating within its bucket, like PromQL's histogram_quantile."""
+        state = self.values.get(self._key(labels))
+        if not state:
+            return None
+        counts, _, total = state
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self.values.items():
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', {**labels, 'le': str(bound)}, cumulative))
+                samples.append(('_sum', labels, total))
+                samples.append(('_count', labels, count))
+        return samples
+
+
+POLLS = Counter('bargainbites_polls_total', "User polls by outcome (ok, error, skipped)", ('result',))
+POLL_SECONDS = Histogram('bargainbites_poll_seconds', "Duration of one user poll, from waiting for the request budget to the saved snapshot")
+FETCH_SECONDS = Histogram('bargainbites_fetch_seconds', "Latency of fetching one user's favourites from TGTG")
+TGTG_ERRORS = Counter('bargainbites_tgtg_errors_total', "Failed TGTG requests by class", ('kind',))
+POLL_LAG = Gauge('bargainbites_poll_lag_seconds', "How far the most overdue user is behind its poll deadline")
+SCHEDULED_USERS = Gauge('bargainbites_scheduled_users', "Users waiting in the poll scheduler")
+REQUEST_RATE = Gauge('bargainbites_tgtg_request_rate', "Current TGTG request budget per minute")
+HTTP_REQUESTS = Counter('bargainbites_tgtg_http_requests_total', "Requests made through the shared TGTG HTTP pool")
+HTTP_CONNECTIONS = Counter('bargainbites_tgtg_http_connections_total', "Connections opened by the shared TGTG HTTP pool")
+ITEM_CACHE_LOOKUPS = Counter('bargainbites_item_cache_lookups_total', "Item cache lookups by result (hit, miss)", ('result',))
+OUTBOX_PENDING = Gauge('bargainbites_outbox_pending', "Notifications waiting in the outbox")
+ALERT_QUEUE_SECONDS = Histogram('bargainbites_alert_queue_seconds', "Time from an alert entering the outbox to its delivery")
+TELEGRAM_SEND_SECONDS = Histogram('bargainbites_telegram_send_seconds', "Latency of one Telegram send or edit call")
+TELEGRAM_CALLS = Counter('bargainbites_telegram_calls_total', "Telegram calls by result (sent, edited, rate_limited, retried, failed)", ('result',))
+DB_QUERY_SECONDS = Histogram('bargainbites_db_query_seconds', "SQLite statement time by connection (read, write)", ('connection',))
+DB_TRANSACTION_SECONDS = Histogram('bargainbites_db_transaction_seconds', "Duration of one batched write transaction")
+LEASES_HELD = Gauge('bargainbites_leases_held', "Users this instance holds a lease on, when instances share the work")
+LIVE_INSTANCES = Gauge('bargainbites_live_instances', "Instances with a current heartbeat in the lease store")
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for suffix, labels, value in metric.samples():
+            lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def _seconds(value):
+    return '-' if value is None else f"{value:.2f}s"
+
+
+def summary(shards=0):
+    """
+    A short human-readable overview for the admin /stats command. With `shards` poll
+    shards, it only covers the main process, which is said up front.
+    """
+    lookups = ITEM_CACHE_LOOKUPS.value(result='hit') + ITEM_CACHE_LOOKUPS.value(result='miss')
+    hit_rate = ITEM_CACHE_LOOKUPS.value(result='hit') / lookups if lookups else 0.0
+    requests, connections = HTTP_REQUESTS.value(), HTTP_CONNECTIONS.value()
+    errors = ', '.join(f"{key[0]} {count}" for key, count in sorted(TGTG_ERRORS.values.items())) or 'none'
+    telegram = ', '.join(f"{key[0]} {count}" for key, count in sorted(TELEGRAM_CALLS.values.items())) or 'none'
+    lines = []
+    if shards:
+        lines.append(f"Main process only: polling, TGTG and item cache numbers are kept by the {shards} poll "
+                     f"shard(s), each serving its own metrics on METRICS_PORT + 1 + its index")
+    return '\n'.join(lines + [
+        f"Polls: {POLLS.value(result='ok')} ok, {POLLS.value(result='error')} failed, "
+        f"{POLLS.value(result='skipped')} skipped",
+        f"Scheduled users: {SCHEDULED_USERS.value()}, most overdue by {_seconds(POLL_LAG.value())}",
+        f"Poll duration p50/p95: {_seconds(POLL_SECONDS.quantile(0.5))} / {_seconds(POLL_SECONDS.quantile(0.95))}",
+        f"TGTG fetch p50/p95: {_seconds(FETCH_SECONDS.quantile(0.5))} / {_seconds(FETCH_SECONDS.quantile(0.95))}",
+        f"TGTG request rate: {REQUEST_RATE.value():.1f}/min, errors: {errors}",
+        f"HTTP pool: {requests} requests over {connections} connections",
+        f"Item cache hit rate: {hit_rate:.0%} of {lookups} lookups",
+        f"Outbox: {OUTBOX_PENDING.value()} pending, queue time p50/p95: "
+        f"{_seconds(ALERT_QUEUE_SECONDS.quantile(0.5))} / {_seconds(ALERT_QUEUE_SECONDS.quantile(0.95))}",
+        f"Telegram calls: {telegram}, send p95: {_seconds(TELEGRAM_SEND_SECONDS.quantile(0.95))}",
+        f"Database: read {_seconds(DB_QUERY_SECONDS.mean(connection='read'))} avg over "
+        f"{DB_QUERY_SECONDS.count(connection='read')} statements, write transaction p95 "
+        f"{_seconds(DB_TRANSACTION_SECONDS.quantile(0.95))} over {DB_TRANSACTION_SECONDS.count()}",
+    ])
+
+
+class MetricsServer:
+    """
+    Serves the metrics in Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics.
+    Off unless METRICS_PORT is set; it listens on localhost by default.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.host = os.getenv('METRICS_HOST', '127.0.0.1')
+        self.port = int(os.getenv('METRICS_PORT', 0))
+        self.runner = None
+
+    def enabled(self):
+        return self.port > 0
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.logger.info(f"Metrics served on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request):
+        return web.Response(body=render().encode(), headers={'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,382 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+import aiohttp
+from telebot.asyncio_helper import ApiTelegramException, RequestTimeout
+import metrics
+from rate_limit import TokenBucket
+
+# Telegram allows about one message per second in a private chat and 20 per minute in a group
+PRIVATE_CHAT_RATE = 1.0
+GROUP_CHAT_RATE = 20 / 60
+
+# Changes that update the alert already in the chat; new stock always gets a new message, edits do not notify
+EDITABLE_STATUSES = ('sold_out', 'stock_reduced', 'stock_increased')
+
+
+class Notification:
+    __slots__ = ('key', 'chat_id', 'text', 'item_id', 'store_id', 'store_name', 'status', 'expires_at', 'attempts',
+                 'queued_at')
+
+    def __init__(self, key, chat_id, text, item_id, store_id, store_name, status=None, expires_at=None, attempts=0):
+        self.key = key
+        self.chat_id = chat_id
+        self.text = text
+        self.item_id = item_id
+        self.store_id = store_id
+        self.store_name = store_name
+        self.status = status
+        self.expires_at = expires_at
+        self.attempts = attempts
+        self.queued_at = None
+
+    @staticmethod
+    def make_key(chat_id, item_id, status, version):
+        """Idempotency key: one alert per chat, item, status and snapshot version."""
+        return f"{chat_id}:{item_id}:{status}:{version}"
+
+
+class SentMessage:
+    """A delivered Telegram message and the items it shows, as {item_id: (text, store_id, store_name)} in display order."""
+
+    __slots__ = ('chat_id', 'message_id', 'parts', 'sent_at')
+
+    def __init__(self, chat_id, message_id, sent_at, parts=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.sent_at = sent_at
+        self.parts = parts if parts is not None else {}
+
+
+class Outbox:
+    """
+    Delivers notifications to Telegram as fast as its limits allow. Each chat has
+    its own queue and token bucket, a global bucket caps messages per second, and
+    up to `concurrency` sends run at once. A chat is only handed to a sender when
+    its bucket has a token, so one busy chat never blocks the others. Rate-limit
+    (429) and transient errors are retried, honouring Telegram's retry_after.
+
+    Each Telegram call delivers as much as it can. Only the newest pending alert
+    per item is kept, changes to an item whose message is younger than
+    `edit_window` edit that message in place, and new alerts that are due
+    together go out as one digest of up to `digest_size` items.
+
+    Notifications are persisted in the database's outbox table before they get
+    here. Delivery outcomes are acknowledged in batches, and whatever is still
+    pending on startup is delivered again unless its pickup window has ended.
+    """
+
+    max_attempts = 5
+    ack_interval = 1.0
+    ack_batch_size = 100
+    prune_interval = 300
+    # How long stop() lets sends already in flight finish
+    stop_timeout = 10
+    retention = 7 * 24 * 3600
+    # Telegram lets bots edit their messages for 48 hours
+    edit_window = 24 * 3600
+    digest_size = 10
+
+    def __init__(self, send, logger, db):
+        self.send = send
+        self.logger = logger
+        self.db = db
+        self.concurrency = int(os.getenv('TELEGRAM_SEND_CONCURRENCY', 8))
+        messages_per_second = float(os.getenv('TELEGRAM_MESSAGES_PER_SECOND', 25))
+        self.global_bucket = TokenBucket(messages_per_second, capacity=messages_per_second)
+        self.chat_buckets = {}
+        self.pending = {}
+        self.busy = set()
+        self.ready = asyncio.Queue()
+        self.tasks = []
+        self.delivering = set()
+        self.stopping = False
+        self.acks = []
+        self.messages = {}
+        self.sent = 0
+        self.failed = 0
+        self.merged = 0
+        self.edited = 0
+        self.calls = 0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._sender()) for _ in range(self.concurrency)]
+        self.tasks.append(asyncio.create_task(self._ack_loop()))
+
+    async def stop(self):
+        """
+        Stop the senders and flush acknowledgements. Sends already in flight get up to
+        `stop_timeout` seconds to finish, so a message Telegram accepted is acknowledged
+        instead of sent again on the next start. Returns how many notifications are left
+        pending; they stay in the database for the next start.
+        """
+        self.stopping = True
+        busy = [task for task in self.tasks if task in self.delivering]
+        for task in self.tasks:
+            if task not in self.delivering:
+                task.cancel()
+        if busy:
+            _, late = await asyncio.wait(busy, timeout=self.stop_timeout)
+            if late:
+                self.logger.warning(f"{len(late)} Telegram send(s) did not finish in time, they are sent again on the next start")
+                for task in late:
+                    task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.flush_acks()
+        return self.size()
+
+    def restore(self, pending=True):
+        """
+        Re-queue notifications that were still pending when the bot last stopped. Without
+        `pending` only the cleanup runs, and pending rows are left to requeue(), as
+        when several instances share the outbox (see leases.py).
+        """
+        now = int(time.time())
+        expired = self.db.expire_notifications(now)
+        if expired:
+            self.logger.info(f"Dropped {expired} pending notifications whose pickup window has ended")
+        self.db.purge_notifications(now - self.retention)
+        self._load_messages(now)
+        return self.requeue(self.db.get_pending_notifications()) if pending else 0
+
+    def requeue(self, rows):
+        """Queue outbox rows, as returned by Database.get_pending_notifications()."""
+        for key, chat_id, item_id, store_id, store_name, text, status, attempts, expires_at in rows:
+            self.put(Notification(key, chat_id, text, item_id, store_id, store_name, status, expires_at, attempts))
+        if rows:
+            self.logger.info(f"Restored {len(rows)} pending notifications from the outbox")
+        return len(rows)
+
+    def _load_messages(self, now):
+        """Remember the messages that can still be edited."""
+        self.db.purge_sent_messages(now - self.edit_window)
+        messages = {}
+        for chat_id, message_id, item_id, text, store_id, store_name, sent_at in self.db.get_sent_messages(now - self.edit_window):
+            message = messages.get((chat_id, message_id))
+            if message is None:
+                message = messages[(chat_id, message_id)] = SentMessage(chat_id, message_id, sent_at)
+            message.parts[item_id] = (text, store_id, store_name)
+            # Rows come oldest first, so every item ends up with the last message it was shown in
+            self.messages[(chat_id, item_id)] = message
+
+    def prune_messages(self):
+        """Forget messages that are too old to edit."""
+        cutoff = time.time() - self.edit_window
+        for key in [key for key, message in self.messages.items() if message.sent_at < cutoff]:
+            del self.messages[key]
+
+    def stats(self):
+        """Delivery counters since the last call, as a log line."""
+        line = (f"Outbox: {self.sent} alert(s) in {self.calls} Telegram call(s), {self.edited} as edits, "
+                f"{self.merged} superseded, {self.failed} failed, {self.size()} pending")
+        self.sent = self.failed = self.merged = self.edited = self.calls = 0
+        return line
+
+    def size(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    def put(self, notification):
+        notification.queued_at = notification.queued_at or time.monotonic()
+        self.pending.setdefault(notification.chat_id, deque()).append(notification)
+        self._schedule(notification.chat_id)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = GROUP_CHAT_RATE if str(chat_id).startswith('-') else PRIVATE_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate)
+        return bucket
+
+    def _schedule(self, chat_id, delay=0.0):
+        """Hand the chat to a sender once its bucket has a token (and `delay` has passed)."""
+        if chat_id in self.busy:
+            return
+        self.busy.add(chat_id)
+        delay = max(delay, self._chat_bucket(chat_id).wait_time())
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, chat_id)
+        else:
+            self.ready.put_nowait(chat_id)
+
+    async def _sender(self):
+        while not self.stopping:
+            chat_id = await self.ready.get()
+            queue = self.pending.get(chat_id)
+            retry_delay = None
+            try:
+                if queue:
+                    await self.global_bucket.acquire()
+                    # Take the chat's token only now, so time spent waiting on the global bucket does not count
+                    await self._chat_bucket(chat_id).acquire()
+                    # Alerts queued while waiting for the tokens are coalesced too
+                    batch, message = self._take_batch(chat_id, queue)
+                    if batch:
+                        # Marked from taking the batch on, so stop() waits for the send instead of cancelling it
+                        task = asyncio.current_task()
+                        self.delivering.add(task)
+                        try:
+                            retry_delay = await self._deliver(chat_id, batch, message)
+                        finally:
+                            self.delivering.discard(task)
+                        if retry_delay is not None:
+                            # Put them back at the front so the chat's messages stay in order
+                            queue.extendleft(reversed(batch))
+            except Exception as e:
+                # One bad batch must not take a sender down with it
+                self.logger.error(f"Error delivering notifications to chat {chat_id}: {e}", exc_info=True)
+            finally:
+                self.busy.discard(chat_id)
+                if queue:
+                    self._schedule(chat_id, retry_delay or 0.0)
+                else:
+                    self.pending.pop(chat_id, None)
+
+    def _ack(self, notification, state):
+        self.acks.append((notification.key, state, notification.attempts))
+        if len(self.acks) >= self.ack_batch_size:
+            self.flush_acks()
+
+    def flush_acks(self):
+        if self.acks:
+            acks, self.acks = self.acks, []
+            self.db.ack_notifications(acks)
+
+    async def _ack_loop(self):
+        # Pruning runs here rather than in the poller, which poll shards keep in other processes
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.ack_interval)
+            self.flush_acks()
+            if time.monotonic() - last_prune >= self.prune_interval:
+                last_prune = time.monotonic()
+                self.prune_messages()
+
+    def _take_batch(self, chat_id, queue):
+        """
+        Take from the chat's queue what one Telegram call delivers. Returns the
+        notifications and the SentMessage to edit, or None to send a new message.
+        New alerts go first, as one digest; otherwise the changes shown in one
+        existing message become one edit. The rest stays queued. The batch is
+        empty when every queued notification had expired.
+        """
+        now = time.time()
+        latest = {}
+        alerts = set()
+        for notification in queue:
+            if notification.expires_at is not None and notification.expires_at <= now:
+                self.logger.info(f"Dropping expired notification for chat {chat_id}")
+                self._ack(notification, 'expired')
+                continue
+            previous = latest.pop(notification.item_id, None)
+            if previous is not None:
+                self.merged += 1
+                self._ack(previous, 'merged')
+            if notification.status not in EDITABLE_STATUSES:
+                alerts.add(notification.item_id)
+            latest[notification.item_id] = notification
+        queue.clear()
+
+        fresh = []
+        edits = {}
+        for item_id, notification in latest.items():
+            message = self.messages.get((chat_id, item_id))
+            # An item whose new stock was superseded before it went out still deserves a notifying message
+            if message is None or item_id in alerts or message.sent_at < now - self.edit_window:
+                fresh.append(notification)
+            else:
+                edits.setdefault(message, []).append(notification)
+
+        message = None
+        if fresh:
+            batch = fresh[:self.digest_size]
+        elif edits:
+            message, batch = next(iter(edits.items()))
+        else:
+            return [], None
+        taken = {id(notification) for notification in batch}
+        queue.extend(notification for notification in latest.values() if id(notification) not in taken)
+        return batch, message
+
+    async def _deliver(self, chat_id, batch, message=None):
+        """Send a batch as one new message, or as an edit of `message`. Returns a delay in seconds if it should be retried."""
+        parts = dict(message.parts) if message else {}
+        for notification in batch:
+            parts[notification.item_id] = (notification.text, notification.store_id, notification.store_name)
+        rows = [(item_id, text, store_id, store_name) for item_id, (text, store_id, store_name) in parts.items()]
+        message_id = message.message_id if message else None
+        try:
+            self.calls += 1
+            with metrics.TELEGRAM_SEND_SECONDS.time():
+                message_id = await self.send(chat_id, rows, message_id)
+        except ApiTelegramException as e:
+            if message is not None and e.error_code == 400:
+                if 'not modified' not in str(e.description):
+                    # Deleted by the user or no longer editable: deliver the change as a new message instead
+                    self.logger.info(f"Could not edit message {message.message_id} in chat {chat_id}, sending a new one: {e.description}")
+                    metrics.TELEGRAM_CALLS.inc(result='retried')
+                    for notification in batch:
+                        self.messages.pop((chat_id, notification.item_id), None)
+                    return 0.0
+            elif e.error_code == 429:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                self.logger.warning(f"Telegram rate limit hit for chat {chat_id}, retrying after {retry_after} seconds")
+                metrics.TELEGRAM_CALLS.inc(result='rate_limited')
+                return self._retry(batch, retry_after)
+            elif e.error_code >= 500:
+                self.logger.warning(f"Telegram error for chat {chat_id}: {e}")
+                metrics.TELEGRAM_CALLS.inc(result='retried')
+                return self._retry(batch)
+            else:
+                self.logger.error(f"Error sending message to chat {chat_id}: {e}")
+                metrics.TELEGRAM_CALLS.inc(result='failed')
+                return self._fail(batch)
+        except (RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(f"Network error sending message to chat {chat_id}: {e}")
+            metrics.TELEGRAM_CALLS.inc(result='retried')
+            return self._retry(batch)
+        except Exception as e:
+            self.logger.error(f"Error sending message: {e}")
+            metrics.TELEGRAM_CALLS.inc(result='failed')
+            return self._fail(batch)
+
+        if message is not None:
+            # Edited in place, so the other items shown in the message see the new text too
+            message.parts = parts
+            self.edited += len(batch)
+            metrics.TELEGRAM_CALLS.inc(result='edited')
+            self.logger.info(f"Message {message_id} edited for user {chat_id}")
+        else:
+            message = SentMessage(chat_id, message_id, time.time(), parts)
+            metrics.TELEGRAM_CALLS.inc(result='sent')
+            if len(batch) > 1:
+                self.logger.info(f"Digest of {len(batch)} alerts sent to user {chat_id}")
+            else:
+                self.logger.info(f"Message sent to user {chat_id}")
+        now = time.monotonic()
+        for notification in batch:
+            self.messages[(chat_id, notification.item_id)] = message
+            self._ack(notification, 'sent')
+            metrics.ALERT_QUEUE_SECONDS.observe(now - notification.queued_at)
+        self.db.record_sent_message(chat_id, message_id, rows, int(message.sent_at))
+        self.sent += len(batch)
+        return None
+
+    def _fail(self, batch):
+        self.failed += len(batch)
+        for notification in batch:
+            self._ack(notification, 'failed')
+        return None
+
+    def _retry(self, batch, retry_after=None):
+        attempts = max(notification.attempts for notification in batch) + 1
+        for notification in batch:
+            notification.attempts = attempts
+        if attempts >= self.max_attempts:
+            self.logger.error(f"Giving up on message to chat {batch[0].chat_id} after {attempts} attempts")
+            return self._fail(batch)
+        if retry_after is not None:
+            return float(retry_after)
+        return min(2 ** attempts, 60) + random.uniform(0, 1)
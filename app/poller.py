@@ -0,0 +1,218 @@
+import asyncio
+import os
+import random
+import time
+import metrics
+from rate_limit import request_budget
+from scheduler import PollScheduler
+from shards import AREA_SCANS
+
+
+class Poller:
+    """
+    Polls the favourites of every logged-in user with a pool of asyncio workers.
+    TGTG requests run on the event loop through the shared HTTP pool, and all
+    workers share one adaptive request budget: it stays bounded however many
+    users there are and slows down whenever TGTG pushes back. Users whose own
+    fetches keep failing are isolated by their session's circuit breaker.
+
+    There are no fixed cycles: users wait in a PollScheduler ordered by when they
+    are due, and a free worker always takes the most overdue one, so a user whose
+    store is about to drop is never stuck behind everyone else. In area mode the
+    shared area searches run alongside on the base interval.
+    """
+
+    def __init__(self, tgtg, logger):
+        self.tgtg = tgtg
+        self.logger = logger
+        self.workers = int(os.getenv('POLL_WORKERS', 4))
+        # Poll shards split the request budget with the main process's /info fetches, so it holds for the whole deployment
+        self.budget = request_budget(tgtg.shard.count + 1 if tgtg.shard else 1)
+        self.interval = float(os.getenv('POLL_INTERVAL', 900))
+        self.tick = float(os.getenv('POLL_TICK', 30))
+        self.jitter = float(os.getenv('POLL_JITTER', 5))
+        self.report_interval = 300
+        self.scheduler = PollScheduler(tgtg)
+        self.scheduler.load(tgtg.db, [user_id for user_id in tgtg.users_login_data if tgtg.owns(user_id)])
+        self.polled = 0
+        self._stop = asyncio.Event()
+        metrics.POLL_LAG.set_function(self.lag)
+        metrics.SCHEDULED_USERS.set_function(lambda: len(self.scheduler))
+        metrics.REQUEST_RATE.set_function(lambda: self.budget.rate * 60)
+
+    def stop(self):
+        self._stop.set()
+
+    async def _sleep(self, delay):
+        """Sleep for `delay` seconds, waking up early on stop. Returns True if stopped."""
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=max(0, delay))
+        except asyncio.TimeoutError:
+            pass
+        return self._stop.is_set()
+
+    async def run(self):
+        tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        tasks.append(asyncio.create_task(self._area_loop()))
+        last_report = time.monotonic()
+        while not await self._sleep(self.tick):
+            try:
+                self.tgtg.db.record_stock_events(self.tgtg.restock_model.drain())
+            except Exception as err:
+                self.logger.error(f"Error recording stock events: {err}")
+
+            if time.monotonic() - last_report >= self.report_interval:
+                last_report = time.monotonic()
+                self.logger.info(f"Polled {self.polled} user(s) in the last {self.report_interval} seconds, "
+                                 f"{len(self.scheduler)} scheduled, request rate {self.budget.rate * 60:.1f}/min "
+                                 f"after {self.budget.pushbacks} pushback(s)")
+                self.budget.pushbacks = 0
+                self.logger.info(self.tgtg.item_cache.stats())
+                self.logger.info(self.tgtg.http_pool.stats())
+                self.logger.info(self.tgtg.outbox.stats())
+                self.polled = 0
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tgtg.db.record_stock_events(self.tgtg.restock_model.drain())
+        self.logger.info("Poller has finished.")
+
+    def lag(self):
+        """Seconds the most overdue user is behind its deadline, 0 if nobody is overdue."""
+        deadline = self.scheduler.next_deadline()
+        return max(0.0, time.time() - deadline) if deadline is not None else 0.0
+
+    def _jittered(self, interval):
+        # ±15% jitter, close to the old ±2 minutes around 15 minutes
+        return time.time() + interval * random.uniform(0.85, 1.15)
+
+    async def _worker(self):
+        while not self._stop.is_set():
+            now = time.time()
+            key = self.scheduler.pop_due(now)
+            if key is None:
+                deadline = self.scheduler.next_deadline()
+                wait = self.tick if deadline is None else deadline - now
+                if await self._sleep(min(self.tick, max(wait, 0.5))):
+                    return
+                continue
+            try:
+                await self._poll_user(key)
+            finally:
+                self.scheduler.finish(key)
+
+    async def _poll_user(self, key):
+        # Logged-out users, and users another poll shard took over, are simply not rescheduled
+        if key not in self.tgtg.users_login_data or not self.tgtg.owns(key):
+            return
+
+        # In area mode, subscribed chats are served by the shared area searches instead
+        scanner = self.tgtg.area_scanner
+        if scanner.active() and scanner.is_subscribed(key):
+            self.scheduler.schedule(key, self._jittered(self.interval))
+            return
+
+        session = self.tgtg.sessions.get(key)
+        if session and session.in_backoff():
+            self.logger.info(f"Skipping user {key}, circuit open after {session.failures} failed fetch(es)")
+            metrics.POLLS.inc(result='skipped')
+            self.scheduler.schedule(key, time.time() + session.backoff_until - time.monotonic())
+            return
+
+        try:
+            # Small random offset so workers do not hit the API in lockstep
+            if await self._sleep(random.uniform(self.jitter / 5, self.jitter)):
+                return
+            started = time.perf_counter()
+            await self.budget.acquire()
+
+            available_items = await self.tgtg.fetch_user_items(key)
+            self.budget.on_success()
+            await self._apply(key, available_items)
+            self.polled += 1
+            metrics.POLLS.inc(result='ok')
+            metrics.POLL_SECONDS.observe(time.perf_counter() - started)
+        except Exception as e:
+            if self._stop.is_set():
+                return
+            metrics.POLLS.inc(result='error')
+            self._record_error(f"Error processing user {key}: {str(e)}", e)
+        finally:
+            self.scheduler.reschedule(key)
+
+    async def _apply(self, key, available_items, owner_key=None):
+        """
+        Diff fetched items against the chat's snapshot and queue the resulting notifications.
+        `owner_key` is what this process must still own for that, the chat itself by default.
+        """
+        # A fetch can outlast the ownership of its user, and then the new owner diffs it
+        if not self.tgtg.owns(owner_key or key):
+            return
+        snapshots = await asyncio.to_thread(self.tgtg.db.get_user_snapshots, key)
+        changed_items, removed_item_ids, notifications, seen = self.tgtg.process_user_items(key, available_items,
+                                                                                          snapshots)
+        self.scheduler.observe(key, seen, bool(changed_items or removed_item_ids))
+        future = self.tgtg.db.save_user_snapshots(key, changed_items, removed_item_ids, notifications)
+        if future is not None:
+            # Only hand over alerts once they are committed, and never ones already queued
+            new_keys = await asyncio.wrap_future(future)
+            for notification in notifications:
+                if notification.key in new_keys:
+                    self.tgtg.outbox.put(notification)
+
+    def _record_error(self, message, error):
+        self.logger.error(message)
+        if self.budget.on_error(error):
+            self.logger.warning(f"TGTG is pushing back, lowering the request rate to {self.budget.rate * 60:.1f}/min")
+
+    async def _area_loop(self):
+        while not self._stop.is_set():
+            if self.tgtg.area_scanner.active() and self.tgtg.owns_area_scans():
+                try:
+                    await self.scan_areas()
+                except Exception as err:
+                    self.logger.error(f"Unexpected error in area scan: {err}", exc_info=True)
+            if await self._sleep(self._jittered(self.interval) - time.time()):
+                return
+
+    async def scan_areas(self):
+        """Run every shared area search and fan the results out to the subscribed chats."""
+        scanner = self.tgtg.area_scanner
+        queries = scanner.plan()
+        results = {}
+        limit = asyncio.Semaphore(self.workers)
+
+        async def scan(query):
+            async with limit:
+                await self._scan_area(query, results)
+
+        await asyncio.gather(*(scan(query) for query in queries))
+        if self._stop.is_set():
+            return
+
+        matched = scanner.fan_out(queries, results)
+        self.logger.info(f"{len(queries)} area search(es) served {len(matched)} chat(s)")
+        for chat_id, items in matched.items():
+            try:
+                await self._apply(chat_id, items, AREA_SCANS)
+            except Exception as e:
+                self.logger.error(f"Error processing area results for chat {chat_id}: {str(e)}")
+
+    async def _scan_area(self, query, results):
+        """Fetch every page of one shared area search into `results`."""
+        scanner = self.tgtg.area_scanner
+        items = []
+        try:
+            for page in range(1, scanner.max_pages + 1):
+                if await self._sleep(random.uniform(self.jitter / 5, self.jitter)):
+                    return
+                await self.budget.acquire()
+                batch = await scanner.fetch_page(query, page)
+                self.budget.on_success()
+                items.extend(batch)
+                if len(batch) < scanner.page_size:
+                    break
+            results[query] = items
+        except Exception as e:
+            if self._stop.is_set():
+                return
+            self._record_error(f"Error scanning area {query}: {str(e)}", e)
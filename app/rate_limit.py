@@ -0,0 +1,127 @@
+import asyncio
+import os
+import time
+from http import HTTPStatus
+import aiohttp
+from tgtg.exceptions import TgtgAPIError
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second. Tokens are reserved up
+    front, so concurrent callers queue up fairly without holding a lock.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available, without taking it."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self):
+        """Take one token and return how many seconds until it may be used."""
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds` seconds."""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+
+
+# Error kinds that mean TGTG wants fewer requests
+PUSHBACK_KINDS = ('timeout', 'captcha', 'rate_limited', 'server')
+
+
+def error_kind(error):
+    """Classify a failed TGTG request: timeout, captcha, rate_limited, server, unauthorized, not_found, network or other."""
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    if not isinstance(error, TgtgAPIError):
+        return 'network' if isinstance(error, aiohttp.ClientError) else 'other'
+    status = error.args[0] if error.args else None
+    if status == HTTPStatus.FORBIDDEN:
+        return 'captcha'
+    if status == HTTPStatus.TOO_MANY_REQUESTS:
+        return 'rate_limited'
+    if isinstance(status, int) and status >= 500:
+        return 'server'
+    if "captcha" in str(error).lower():
+        return 'captcha'
+    if status == HTTPStatus.UNAUTHORIZED:
+        return 'unauthorized'
+    if status == HTTPStatus.NOT_FOUND:
+        return 'not_found'
+    return 'other'
+
+
+def is_pushback(error):
+    """True if `error` means TGTG wants fewer requests: a CAPTCHA, 403, 429, 5xx or a timeout."""
+    return error_kind(error) in PUSHBACK_KINDS
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate follows upstream pushback (AIMD): every pushback error
+    halves the rate, down to `min_rate`, and every successful request adds a
+    twentieth of `max_rate` back, so the rate recovers on its own within a few
+    dozen requests. A burst of errors from requests that were already in flight
+    only counts once per `cooldown` seconds.
+    """
+
+    decrease_factor = 0.5
+    cooldown = 30
+
+    def __init__(self, max_rate, min_rate):
+        super().__init__(max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase = max_rate / 20
+        self.last_decrease = float('-inf')
+        self.pushbacks = 0
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.set_rate(min(self.max_rate, self.rate + self.increase))
+
+    def on_error(self, error):
+        """Slow down if `error` is upstream pushback. Returns True if the rate was lowered."""
+        if not is_pushback(error):
+            return False
+        self.pushbacks += 1
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown or self.rate <= self.min_rate:
+            return False
+        self.last_decrease = now
+        self.set_rate(max(self.min_rate, self.rate * self.decrease_factor))
+        return True
+
+
+def request_budget(shares=1):
+    """
+    One process's AdaptiveRateLimiter out of POLL_REQUESTS_PER_MINUTE and
+    POLL_MIN_REQUESTS_PER_MINUTE, split into `shares` equal parts so that the
+    processes together stay within the budget.
+    """
+    return AdaptiveRateLimiter(float(os.getenv('POLL_REQUESTS_PER_MINUTE', 20)) / 60 / shares,
+                               float(os.getenv('POLL_MIN_REQUESTS_PER_MINUTE', 2)) / 60 / shares)
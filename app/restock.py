@@ -0,0 +1,148 @@
+import os
+import time
+from datetime import date
+from statistics import median_low
+
+SLOT_SECONDS = 15 * 60
+DAY_SECONDS = 24 * 3600
+
+
+def time_of_day(timestamp):
+    """Seconds since local midnight; stores restock by their local clock."""
+    local = time.localtime(timestamp)
+    return local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+
+
+class RestockModel:
+    """
+    Learns when each store restocks from the recorded new_stock transitions and
+    turns that into a poll interval per user: dense around the expected drops of
+    the user's stores, sparse the rest of the day, and the base interval while a
+    store has no history yet.
+
+    A drop is counted in its 15 minute slot of the day. A slot becomes a restock
+    window once drops were seen in it on `min_days` different days within the last
+    `history_days`; polling is dense from one slot before to one slot after it.
+
+    Each drop also records the pickup window it came with. Once a store's drops
+    carried one on `min_days` different days, its typical pickup time of day is
+    learned, so the scheduler can poll more often ahead of pickup even while the
+    store is sold out and its snapshot shows no pickup window.
+    """
+
+    history_days = 14
+    min_days = 2
+
+    def __init__(self):
+        self.base_interval = float(os.getenv('POLL_INTERVAL', 900))
+        self.dense_interval = float(os.getenv('POLL_DENSE_INTERVAL', 120))
+        self.sparse_interval = float(os.getenv('POLL_SPARSE_INTERVAL', 3600))
+        self.drops = {}
+        self.windows = {}
+        self.pickups = {}
+        self.pickup_windows = {}
+        self.user_stores = {}
+        self.item_states = {}
+        self.pending_events = []
+
+    def load(self, db):
+        since = int(time.time()) - self.history_days * 24 * 3600
+        for store_id, occurred_at, pickup_start, pickup_end in db.get_restock_times(since):
+            self._add_drop(store_id, occurred_at)
+            self._add_pickup(store_id, occurred_at, pickup_start, pickup_end)
+        self.user_stores = {}
+        for user_id, store_id in db.get_user_stores():
+            self.user_stores.setdefault(user_id, set()).add(store_id)
+
+    def set_user_stores(self, user_id, store_ids):
+        self.user_stores[user_id] = set(store_ids)
+
+    def observe(self, item_id, store_id, event, pickup_start=None, pickup_end=None, now=None):
+        """
+        Record a new_stock or sold_out transition. Several users see the same
+        transition of a shared item, so only a change of the item's last event counts.
+        """
+        if self.item_states.get(item_id) == event:
+            return
+        self.item_states[item_id] = event
+        now = int(now or time.time())
+        self.pending_events.append((item_id, store_id, event, now, pickup_start, pickup_end))
+        if event == 'new_stock':
+            self._add_drop(store_id, now)
+            self._add_pickup(store_id, now, pickup_start, pickup_end)
+
+    def drain(self):
+        """Return and clear the events observed since the last call."""
+        events, self.pending_events = self.pending_events, []
+        return events
+
+    def _add_drop(self, store_id, occurred_at):
+        slot = time_of_day(occurred_at) // SLOT_SECONDS
+        day = date.fromtimestamp(occurred_at).toordinal()
+        slots = self.drops.setdefault(store_id, {})
+        slots.setdefault(slot, set()).add(day)
+
+        oldest = day - self.history_days
+        for slot_days in slots.values():
+            slot_days.difference_update([old_day for old_day in slot_days if old_day < oldest])
+        self.windows[store_id] = sorted(slot for slot, slot_days in slots.items() if len(slot_days) >= self.min_days)
+
+    def _add_pickup(self, store_id, occurred_at, pickup_start, pickup_end):
+        if pickup_start is None or pickup_end is None or pickup_end <= pickup_start:
+            return
+        day = date.fromtimestamp(occurred_at).toordinal()
+        days = self.pickups.setdefault(store_id, {})
+        days[day] = (time_of_day(pickup_start), min(pickup_end - pickup_start, DAY_SECONDS))
+
+        oldest = day - self.history_days
+        for old_day in [old_day for old_day in days if old_day < oldest]:
+            del days[old_day]
+        if len(days) >= self.min_days:
+            self.pickup_windows[store_id] = (median_low(start for start, _ in days.values()),
+                                             median_low(duration for _, duration in days.values()))
+        else:
+            self.pickup_windows.pop(store_id, None)
+
+    def expects_pickup(self, user_id, now, horizon):
+        """Whether a learned pickup window of one of the user's stores opens within `horizon` seconds or is open."""
+        seconds = time_of_day(now)
+        for store_id in self.user_stores.get(user_id, ()):
+            window = self.pickup_windows.get(store_id)
+            if window is None:
+                continue
+            start, duration = window
+            if (seconds - (start - horizon)) % DAY_SECONDS < horizon + duration:
+                return True
+        return False
+
+    def seconds_to_window(self, store_id, now):
+        """Seconds until the store's next restock window (0 inside one), or None without history."""
+        windows = self.windows.get(store_id)
+        if not windows:
+            return None
+        seconds = time_of_day(now)
+        soonest = DAY_SECONDS
+        for slot in windows:
+            start = (slot - 1) * SLOT_SECONDS
+            since_start = (seconds - start) % DAY_SECONDS
+            if since_start < 3 * SLOT_SECONDS:
+                return 0
+            soonest = min(soonest, DAY_SECONDS - since_start)
+        return soonest
+
+    def poll_interval(self, user_id, now=None):
+        """Seconds until the user should be polled again."""
+        now = now or time.time()
+        store_ids = self.user_stores.get(user_id)
+        if not store_ids:
+            return self.base_interval
+        waits = [self.seconds_to_window(store_id, now) for store_id in store_ids]
+        learned = [wait for wait in waits if wait is not None]
+        if not learned:
+            return self.base_interval
+        soonest = min(learned)
+        if soonest == 0:
+            return self.dense_interval
+        # Stores without history can drop at any time, so they keep the base interval
+        longest = self.sparse_interval if len(learned) == len(waits) else self.base_interval
+        return max(self.dense_interval, min(longest, soonest))
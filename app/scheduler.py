@@ -0,0 +1,124 @@
+import heapq
+import os
+import random
+import time
+
+
+class PollScheduler:
+    """
+    Decides who to poll next. Users sit in a min-heap keyed by the time they are
+    due, so taking the most urgent user or rescheduling one is O(log n). The
+    interval after each poll is derived from:
+
+    - the restock model's interval for the user's stores,
+    - upcoming pickup windows in the user's snapshot, or the stores' learned
+      pickup times while they are sold out, since stock moves fastest shortly
+      before and during pickup,
+    - how often the user's favourites changed on recent polls,
+    - the user's settings: a user with every alert off is barely polled.
+
+    Rescheduling a user leaves its old heap entry behind; entries that no longer
+    match `deadlines` are skipped when popped and dropped when the heap is compacted.
+
+    A popped user is in flight until it is rescheduled or finished. Waking a user
+    in flight does not schedule a second, concurrent poll; it is polled again right
+    after the current poll instead.
+    """
+
+    pickup_horizon = 2 * 3600
+    change_weight = 0.2
+
+    def __init__(self, tgtg):
+        self.tgtg = tgtg
+        self.idle_interval = float(os.getenv('POLL_IDLE_INTERVAL', 6 * 3600))
+        self.heap = []
+        self.deadlines = {}
+        self.in_flight = set()
+        self.repoll = set()
+        self.change_rates = {}
+        self.pickups = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def load(self, db, user_ids):
+        """Schedule every user right away and read their pickup windows from the stored snapshots."""
+        now = time.time()
+        for user_id, pickup_start, pickup_end in db.get_pickup_windows(int(now)):
+            self.pickups.setdefault(user_id, []).append((pickup_start, pickup_end))
+        for user_id in user_ids:
+            self.schedule(user_id, now)
+
+    def schedule(self, user_id, deadline):
+        self.deadlines[user_id] = deadline
+        heapq.heappush(self.heap, (deadline, user_id))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, user_id) for user_id, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, user_id):
+        self.deadlines.pop(user_id, None)
+
+    def is_scheduled(self, user_id):
+        """True if the user waits in the schedule or is being polled."""
+        return user_id in self.deadlines or user_id in self.in_flight
+
+    def wake(self, user_id, now):
+        """Poll the user at `now`, or right after the poll in flight if there is one."""
+        if user_id in self.in_flight:
+            self.repoll.add(user_id)
+        else:
+            self.schedule(user_id, now)
+
+    def finish(self, user_id):
+        """The user's poll is over, whether or not it was rescheduled."""
+        self.in_flight.discard(user_id)
+        self.repoll.discard(user_id)
+
+    def next_deadline(self):
+        """Deadline of the most urgent user, or None if nobody is scheduled."""
+        while self.heap:
+            deadline, user_id = self.heap[0]
+            if self.deadlines.get(user_id) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        """Take the most overdue user whose deadline has passed, or None."""
+        deadline = self.next_deadline()
+        if deadline is None or deadline > now:
+            return None
+        _, user_id = heapq.heappop(self.heap)
+        del self.deadlines[user_id]
+        self.in_flight.add(user_id)
+        return user_id
+
+    def observe(self, user_id, snapshots, changed):
+        """Update a user's pickup windows and change rate after a successful poll."""
+        self.pickups[user_id] = [(snapshot.pickup_start, snapshot.pickup_end) for snapshot in snapshots
+                                 if snapshot.pickup_start is not None and snapshot.pickup_end is not None]
+        rate = self.change_rates.get(user_id, 0.0)
+        self.change_rates[user_id] = rate + self.change_weight * ((1.0 if changed else 0.0) - rate)
+
+    def interval(self, user_id, now):
+        if not self.tgtg.user_index.settings.get(user_id):
+            return self.idle_interval
+        interval = self.tgtg.restock_model.poll_interval(user_id, now)
+        if (any(start - self.pickup_horizon <= now < end for start, end in self.pickups.get(user_id, ()))
+                or self.tgtg.restock_model.expects_pickup(user_id, now, self.pickup_horizon)):
+            interval *= 0.5
+        # Users whose favourites keep changing are polled up to twice as often
+        interval *= 1 - 0.5 * self.change_rates.get(user_id, 0.0)
+        return max(self.tgtg.restock_model.dense_interval, interval)
+
+    def reschedule(self, user_id):
+        """Schedule the user's next poll, with ±15% jitter so polls do not fall on a fixed grid."""
+        now = time.time()
+        self.in_flight.discard(user_id)
+        if user_id in self.repoll:
+            # Woken while this poll ran
+            self.repoll.discard(user_id)
+            self.schedule(user_id, now)
+            return
+        self.schedule(user_id, now + self.interval(user_id, now) * random.uniform(0.85, 1.15))
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class UserSession:
+    """
+    Everything needed to talk to TGTG on behalf of one chat: its own client,
+    credentials, circuit breaker and fetch statistics. Sessions are handed
+    explicitly through the fetch path so concurrent polls never share a client.
+
+    The circuit breaker isolates broken accounts: after `failure_threshold`
+    failed fetches in a row the circuit opens and the user is not polled until
+    it half-opens again. The next poll is then a trial; if it fails too, the
+    circuit reopens for twice as long, and a success closes it.
+    """
+
+    failure_threshold = 3
+    base_backoff = 60
+    max_backoff = 3600
+
+    def __init__(self, user_id, credentials, client):
+        self.user_id = user_id
+        self.credentials = credentials
+        self.client = client
+        # One request at a time per client, so a token refresh never races a fetch
+        self.lock = asyncio.Lock()
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.fetches = 0
+        self.errors = 0
+        self.last_fetch_at = None
+        self.last_fetch_duration = None
+        self.last_used = time.monotonic()
+        # Spreads the proactive refreshes of sessions created at the same time
+        self.refresh_jitter = random.random()
+
+    def in_backoff(self):
+        return time.monotonic() < self.backoff_until
+
+    def record_success(self, duration):
+        self.fetches += 1
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.last_fetch_at = time.time()
+        self.last_fetch_duration = duration
+
+    def record_failure(self):
+        """Count a failed fetch. Returns the seconds the circuit opens for, or 0 while it stays closed."""
+        self.errors += 1
+        self.failures += 1
+        if self.failures < self.failure_threshold:
+            return 0
+        delay = min(self.base_backoff * 2 ** (self.failures - self.failure_threshold), self.max_backoff)
+        self.backoff_until = time.monotonic() + delay
+        return delay
+
+    def token_age(self):
+        """Seconds since the client last refreshed its access token, or None before its first call."""
+        refreshed = getattr(self.client, 'last_time_token_refreshed', None)
+        if refreshed is None:
+            return None
+        return (datetime.now() - refreshed).total_seconds()
+
+    def current_credentials(self):
+        """The client's credentials as stored in the database, including when the token was refreshed."""
+        credentials = {
+            'access_token': self.client.access_token,
+            'refresh_token': self.client.refresh_token,
+            'cookie': self.client.cookie,
+        }
+        refreshed = getattr(self.client, 'last_time_token_refreshed', None)
+        if refreshed is not None:
+            credentials['refreshed_at'] = refreshed.timestamp()
+        return credentials
+
+
+class SessionPool:
+    """
+    The UserSessions of recently active users, least recently used first.
+    Sessions idle for longer than `idle_timeout` and, past `max_size`, the least
+    recently used ones are dropped, so the pool does not keep a client for every
+    user who ever logged in. A session that is in use is never evicted. Clients
+    hold no connections of their own, those belong to the shared HTTP pool.
+    """
+
+    def __init__(self):
+        self.max_size = int(os.getenv('SESSION_POOL_SIZE', 1000))
+        self.idle_timeout = float(os.getenv('SESSION_IDLE_TIMEOUT', 7200))
+        self.sessions = OrderedDict()
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def values(self):
+        return list(self.sessions.values())
+
+    def get(self, user_id):
+        return self.sessions.get(user_id)
+
+    def use(self, user_id):
+        """Return the user's session, marking it as the most recently used, or None."""
+        session = self.sessions.get(user_id)
+        if session is not None:
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(user_id)
+        return session
+
+    def add(self, session):
+        self.sessions[session.user_id] = session
+        self.sessions.move_to_end(session.user_id)
+        for user_id, oldest in list(self.sessions.items()):
+            if len(self.sessions) <= self.max_size:
+                break
+            if not oldest.lock.locked():
+                self._evict(user_id)
+
+    def pop(self, user_id, default=None):
+        return self.sessions.pop(user_id, default)
+
+    def evict_idle(self):
+        """Drop sessions that have not been used for `idle_timeout` seconds. Returns how many."""
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [user_id for user_id, session in self.sessions.items()
+                if session.last_used < cutoff and not session.lock.locked()]
+        for user_id in idle:
+            self._evict(user_id)
+        return len(idle)
+
+    def _evict(self, user_id):
+        del self.sessions[user_id]
@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from outbox import Notification
+
+# Pseudo user whose owner runs the shared area scans, so exactly one shard does
+AREA_SCANS = '__area_scans__'
+
+
+def owner(user_id, shards):
+    """
+    The shard of `shards` that owns `user_id`, by rendezvous hashing: every shard
+    scores every user and the highest score wins. When a shard stops or starts
+    only the users it owns move, everyone else stays where they are.
+    """
+    return max(shards, key=lambda shard: hashlib.blake2b(f"{shard}:{user_id}".encode(), digest_size=8).digest())
+
+
+class ShardChannel:
+    """
+    The poll shard's end of the IPC channel. It takes the place of the outbox in
+    a shard: alerts are already committed to the database's outbox table by the
+    shard, and are handed to the delivery process in one message per poll.
+    """
+
+    def __init__(self, index, count, events, logger, node=None):
+        self.index = index
+        self.count = count
+        self.events = events
+        self.logger = logger
+        # The lease node of the instance, which the shard's outbox rows belong to
+        self.node = node
+        self.shards = None
+        # With leases (see leases.py), the users this instance holds and until when
+        self.leased = None
+        self.lease_until = 0.0
+        self.buffer = []
+        self.forwarded = 0
+
+    def owns(self, user_id):
+        # Nobody is owned until the delivery process has told the shard who is alive
+        if self.shards is None:
+            return False
+        if self.leased is not None and (user_id not in self.leased or time.time() >= self.lease_until):
+            return False
+        return owner(user_id, self.shards) == self.index
+
+    def put(self, notification):
+        if not self.buffer:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.buffer.append((notification.key, notification.chat_id, notification.text, notification.item_id,
+                            notification.store_id, notification.store_name, notification.status,
+                            notification.expires_at))
+
+    def flush(self):
+        if self.buffer:
+            self.events.put(('notifications', self.index, self.buffer))
+            self.forwarded += len(self.buffer)
+            self.buffer = []
+
+    def size(self):
+        return len(self.buffer)
+
+    def stats(self):
+        line = f"Shard {self.index}: handed {self.forwarded} alert(s) to the delivery process"
+        self.forwarded = 0
+        return line
+
+    async def stop(self):
+        self.flush()
+        return 0
+
+
+def run_shard(index, count, control, events, node=None):
+    """Entry point of a poll shard process."""
+    # Shutdown is coordinated by the delivery process, not by the terminal's Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Console only: the main process owns the rotating log file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', force=True)
+    logger = logging.getLogger(f"shard-{index}")
+    try:
+        asyncio.run(_serve_shard(index, count, control, events, logger, node))
+    except Exception as e:
+        logger.error(f"Poll shard {index} failed: {e}", exc_info=True)
+        raise
+
+
+async def _serve_shard(index, count, control, events, logger, node):
+    from TooGoodToGo import TooGoodToGo
+    from leases import LeaseManager
+
+    channel = ShardChannel(index, count, events, logger, node)
+    if LeaseManager.configured():
+        channel.leased = set()
+    tgtg = TooGoodToGo(None, logger, [], shard=channel)
+    events.put(('ready', index, os.getpid()))
+    while True:
+        message = await asyncio.to_thread(control.get)
+        if message[0] == 'stop':
+            break
+        if message[0] == 'owners':
+            channel.shards = message[1]
+            tgtg.adopt_users()
+        elif message[0] == 'leases':
+            previous = channel.leased
+            # Users whose lease lapsed fell out of the schedule, so they are taken over again too
+            valid = previous if time.time() < channel.lease_until else set()
+            channel.leased = set(message[1])
+            channel.lease_until = message[2]
+            tgtg.adopt_users(channel.leased - valid, previous - channel.leased)
+        elif message[0] == 'user':
+            tgtg.reload_user(message[1], wake=message[2])
+        elif message[0] == 'areas':
+            tgtg.area_scanner.load(tgtg.db)
+    await tgtg.shutdown()
+
+
+class ShardManager:
+    """
+    Optional sharded polling (POLL_SHARDS > 0). The poller runs in that many
+    worker processes, each with its own event loop, HTTP pool and database
+    writer, so JSON decoding, diffing and SQLite writes spread over CPU cores.
+    Users are partitioned by rendezvous hashing over the shards that are alive;
+    the process that owns the Telegram bot delivers every shard's alerts and
+    tells the shards about logins and settings changes.
+
+    A shard that exits is restarted, and until it is back its users move to the
+    others. Alerts a shard committed just before it died are delivered on the
+    next restart of the bot, like any other alert left in the outbox.
+    """
+
+    check_interval = 5
+    stop_timeout = 10
+
+    def __init__(self, tgtg, logger):
+        self.tgtg = tgtg
+        self.logger = logger
+        self.count = int(os.getenv('POLL_SHARDS', 0))
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue()
+        self.processes = {}
+        self.controls = {}
+        self.live = set()
+        self.leases = None
+        self.tasks = []
+        self._stop = asyncio.Event()
+
+    @staticmethod
+    def configured():
+        return int(os.getenv('POLL_SHARDS', 0)) > 0
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        self.tasks = [asyncio.create_task(self._receive()), asyncio.create_task(self._supervise())]
+        self.logger.info(f"Polling with {self.count} shard processes")
+
+    def _spawn(self, index):
+        control = self.context.Queue()
+        process = self.context.Process(target=run_shard, args=(index, self.count, control, self.events, self.tgtg.db.node),
+                                       name=f"poll-shard-{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.controls[index] = control
+
+    def _broadcast(self, message):
+        for index in self.live:
+            self.controls[index].put(message)
+
+    def _rebalance(self):
+        self._broadcast(('owners', sorted(self.live)))
+        if self.leases:
+            self._broadcast(self.leases)
+
+    def set_leases(self, held, valid_until):
+        """Pass the users this instance holds a lease on, and until when, on to the shards."""
+        self.leases = ('leases', sorted(held), valid_until)
+        self._broadcast(self.leases)
+
+    async def _receive(self):
+        while True:
+            message = await asyncio.to_thread(self.events.get)
+            if message is None:
+                return
+            if message[0] == 'notifications':
+                for fields in message[2]:
+                    self.tgtg.outbox.put(Notification(*fields))
+            elif message[0] == 'ready':
+                self.logger.info(f"Poll shard {message[1]} is ready (pid {message[2]})")
+                self.live.add(message[1])
+                self._rebalance()
+
+    async def _supervise(self):
+        while not self._stop.is_set():
+            for index, process in list(self.processes.items()):
+                if process.is_alive():
+                    continue
+                self.logger.warning(f"Poll shard {index} exited with code {process.exitcode}, restarting it")
+                if index in self.live:
+                    self.live.discard(index)
+                    self._rebalance()
+                self._spawn(index)
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def notify_user(self, user_id, wake):
+        """Have the shards re-read a user's login, settings and blacklist once the pending writes are committed."""
+        loop = asyncio.get_running_loop()
+        self.tgtg.db.barrier().add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._broadcast, ('user', user_id, wake)))
+
+    def reload_areas(self):
+        loop = asyncio.get_running_loop()
+        self.tgtg.db.barrier().add_done_callback(lambda _: loop.call_soon_threadsafe(self._broadcast, ('areas',)))
+
+    async def stop(self):
+        self._stop.set()
+        for control in self.controls.values():
+            control.put(('stop',))
+        for index, process in self.processes.items():
+            await asyncio.to_thread(process.join, self.stop_timeout)
+            if process.is_alive():
+                self.logger.warning(f"Poll shard {index} did not stop in time, terminating it")
+                process.terminate()
+        self.live.clear()
+        self.events.put(None)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,85 @@
+import time
+from datetime import datetime
+
+
+def parse_pickup_time(value):
+    """Convert a TGTG pickup timestamp (like 2024-05-01T16:00:00Z) to epoch seconds."""
+    # An order of magnitude faster than strptime, and every poll parses two per item
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+
+def project_item(item):
+    """Reduce a TGTG item to the store, item and snapshot columns we persist."""
+    store = item['store']
+    pickup = item.get('pickup_interval') or {}
+    return {
+        'item_id': item['item']['item_id'],
+        'store_id': store['store_id'],
+        'store_name': store['store_name'],
+        'address': store.get('store_location', {}).get('address', {}).get('address_line'),
+        'item_name': item['item'].get('name'),
+        'items_available': int(item['items_available']),
+        'price_minor': item['item'].get('price_including_taxes', {}).get('minor_units'),
+        'pickup_start': parse_pickup_time(pickup['start']) if 'start' in pickup else None,
+        'pickup_end': parse_pickup_time(pickup['end']) if 'end' in pickup else None,
+    }
+
+
+class Snapshot:
+    """
+    What the diff keeps of an item: its ids, stock, price in minor units, pickup
+    window in epoch seconds, a hash of those four, and the user's version of it
+    that alert keys are built from. Names and addresses are left out, they are
+    only needed to format alerts. It takes about half the memory of the projected
+    dict and a ninth of the TGTG item, see benchmarks/bench_snapshots.py.
+    """
+
+    __slots__ = ('item_id', 'store_id', 'items_available', 'price_minor', 'pickup_start', 'pickup_end', 'digest',
+                 'version')
+
+    def __init__(self, item_id, store_id, items_available, price_minor, pickup_start, pickup_end, version=0):
+        self.item_id = item_id
+        self.store_id = store_id
+        self.items_available = items_available
+        self.price_minor = price_minor
+        self.pickup_start = pickup_start
+        self.pickup_end = pickup_end
+        # Only ever compared within one process, so Python's own hash will do; it is never stored
+        self.digest = hash((items_available, price_minor, pickup_start, pickup_end))
+        self.version = version
+
+    def next_version(self, old):
+        """
+        A copy versioned past `old`, the user's previous snapshot of the item (or None).
+        Versions are the time of the change in milliseconds, bumped by one if that is not
+        past `old`. Every change takes a poll of its own, so versions stay behind the clock,
+        and an item that drops out of the favourites and comes back in a later poll never
+        reuses a version, and with it an alert key, that it had before its row was deleted.
+        """
+        version = max((old.version if old else 0) + 1, time.time_ns() // 1_000_000)
+        return Snapshot(self.item_id, self.store_id, self.items_available, self.price_minor, self.pickup_start,
+                        self.pickup_end, version)
+
+    def __repr__(self):
+        return (f"Snapshot({self.item_id!r}, {self.store_id!r}, {self.items_available}, {self.price_minor}, "
+                f"{self.pickup_start}, {self.pickup_end}, version={self.version})")
+
+
+def project_snapshot(item):
+    """Read the Snapshot fields straight off a TGTG item, without copying anything else."""
+    pickup = item.get('pickup_interval') or {}
+    return Snapshot(item['item']['item_id'], item['store']['store_id'], int(item['items_available']),
+                    item['item'].get('price_including_taxes', {}).get('minor_units'),
+                    parse_pickup_time(pickup['start']) if 'start' in pickup else None,
+                    parse_pickup_time(pickup['end']) if 'end' in pickup else None)
+
+
+def project_catalog(item):
+    """The (store_name, address, item_name) of a TGTG item, for the stores and items tables."""
+    store = item['store']
+    return (store['store_name'], store.get('store_location', {}).get('address', {}).get('address_line'),
+            item['item'].get('name'))
+
+
+def snapshot_changed(old, new):
+    return old is None or old.digest != new.digest
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import random
+from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import urljoin
+
+import aiohttp
+import tgtg
+from tgtg import (API_ITEM_ENDPOINT, AUTH_BY_EMAIL_ENDPOINT, AUTH_POLLING_ENDPOINT, BASE_URL,
+                  DEFAULT_ACCESS_TOKEN_LIFETIME, DEFAULT_APK_VERSION, MAX_POLLING_TRIES, POLLING_WAIT_TIME,
+                  REFRESH_ENDPOINT)
+from tgtg.exceptions import TgtgAPIError, TgtgLoginError, TgtgPollingError
+
+
+class AsyncTgtgClient:
+    """
+    Async counterpart of tgtg.TgtgClient for the calls the bot makes: email login
+    with polling, token refresh and get_items. It runs on the event loop over a
+    shared aiohttp session, so a poll in flight costs a coroutine instead of a
+    thread. It keeps the attribute names of TgtgClient (access_token, cookie,
+    last_time_token_refreshed, ...) and raises the same exceptions, so sessions
+    and error handling work with either client.
+
+    Connection errors, timeouts and 5xx responses are retried with exponential
+    backoff; everything else (401, 403 CAPTCHA, 429) is left to the caller.
+    """
+
+    max_retries = 3
+    retry_delay = 1.0
+
+    def __init__(self, http, url=BASE_URL, email=None, access_token=None, refresh_token=None, cookie=None,
+                 user_agent=None, language="en-GB", last_time_token_refreshed=None,
+                 access_token_lifetime=DEFAULT_ACCESS_TOKEN_LIFETIME, device_type="ANDROID"):
+        self.http = http
+        self.base_url = url
+        self.email = email
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.cookie = cookie
+        self.last_time_token_refreshed = last_time_token_refreshed
+        self.access_token_lifetime = access_token_lifetime
+        self.device_type = device_type
+        # No Play Store lookup of the latest app version; tgtg.USER_AGENTS is kept up to date instead
+        self.user_agent = user_agent or random.choice(tgtg.USER_AGENTS).format(DEFAULT_APK_VERSION)
+        self.language = language
+
+    @property
+    def _headers(self):
+        headers = {
+            "accept": "application/json",
+            "Accept-Encoding": "gzip",
+            "accept-language": self.language,
+            "content-type": "application/json; charset=utf-8",
+            "user-agent": self.user_agent,
+        }
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        if self.access_token:
+            headers["authorization"] = f"Bearer {self.access_token}"
+        return headers
+
+    @property
+    def _already_logged(self):
+        return bool(self.access_token and self.refresh_token)
+
+    async def _post(self, path, payload):
+        """POST `payload` to the API. Returns (status, body, headers) of the final attempt."""
+        url = urljoin(self.base_url, path)
+        for attempt in range(self.max_retries):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+            try:
+                async with self.http.post(url, json=payload, headers=self._headers) as response:
+                    body = await response.read()
+                    if response.status < 500 or attempt == self.max_retries - 1:
+                        return response.status, body, response.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.max_retries - 1:
+                    raise
+
+    def _set_tokens(self, data, headers):
+        self.access_token = data["access_token"]
+        self.refresh_token = data["refresh_token"]
+        self.last_time_token_refreshed = datetime.now()
+        # A refresh may not set a cookie, and without one the stored credentials could not log in again
+        cookies = headers.getall("Set-Cookie", [])
+        if cookies:
+            # requests joins repeated headers the same way, so stored cookies look the same for both clients
+            self.cookie = ", ".join(cookies)
+
+    async def get_credentials(self):
+        await self.login()
+        return {
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token,
+            "cookie": self.cookie,
+        }
+
+    async def _refresh_token(self):
+        if (self.last_time_token_refreshed
+                and (datetime.now() - self.last_time_token_refreshed).total_seconds() <= self.access_token_lifetime):
+            return
+
+        status, body, headers = await self._post(REFRESH_ENDPOINT, {"refresh_token": self.refresh_token})
+        if status != HTTPStatus.OK:
+            raise TgtgAPIError(status, body)
+        self._set_tokens(json.loads(body), headers)
+
+    async def login(self):
+        if not (self.email or self.access_token and self.refresh_token and self.cookie):
+            raise TypeError("You must provide at least email or access_token, refresh_token and cookie")
+        if self._already_logged:
+            await self._refresh_token()
+            return
+
+        status, body, _ = await self._post(AUTH_BY_EMAIL_ENDPOINT, {"device_type": self.device_type, "email": self.email})
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            raise TgtgAPIError(status, "Too many requests. Try again later.")
+        if status != HTTPStatus.OK:
+            raise TgtgLoginError(status, body)
+
+        first_login_response = json.loads(body)
+        if first_login_response["state"] == "TERMS":
+            raise TgtgPollingError(f"This email {self.email} is not linked to a tgtg account. "
+                                   "Please signup with this email first.")
+        if first_login_response["state"] != "WAIT":
+            raise TgtgLoginError(status, body)
+        await self.start_polling(first_login_response["polling_id"])
+
+    async def start_polling(self, polling_id):
+        """Wait for the user to confirm the login email, checking every few seconds."""
+        payload = {"device_type": self.device_type, "email": self.email, "request_polling_id": polling_id}
+        for _ in range(MAX_POLLING_TRIES):
+            status, body, headers = await self._post(AUTH_POLLING_ENDPOINT, payload)
+            if status == HTTPStatus.ACCEPTED:
+                await asyncio.sleep(POLLING_WAIT_TIME)
+                continue
+            if status == HTTPStatus.OK:
+                self._set_tokens(json.loads(body), headers)
+                return
+            if status == HTTPStatus.TOO_MANY_REQUESTS:
+                raise TgtgAPIError(status, "Too many requests. Try again later.")
+            raise TgtgLoginError(status, body)
+
+        raise TgtgPollingError(f"Max retries ({MAX_POLLING_TRIES * POLLING_WAIT_TIME} seconds) reached. Try again.")
+
+    async def get_items(self, *, latitude=0.0, longitude=0.0, radius=21, page_size=20, page=1, discover=False,
+                        favorites_only=True, item_categories=None, diet_categories=None, pickup_earliest=None,
+                        pickup_latest=None, search_phrase=None, with_stock_only=False, hidden_only=False,
+                        we_care_only=False):
+        await self.login()
+
+        # fields are sorted like in the app
+        data = {
+            "origin": {"latitude": latitude, "longitude": longitude},
+            "radius": radius,
+            "page_size": page_size,
+            "page": page,
+            "discover": discover,
+            "favorites_only": favorites_only,
+            "item_categories": item_categories or [],
+            "diet_categories": diet_categories or [],
+            "pickup_earliest": pickup_earliest,
+            "pickup_latest": pickup_latest,
+            "search_phrase": search_phrase or None,
+            "with_stock_only": with_stock_only,
+            "hidden_only": hidden_only,
+            "we_care_only": we_care_only,
+        }
+        status, body, _ = await self._post(API_ITEM_ENDPOINT, data)
+        if status != HTTPStatus.OK:
+            raise TgtgAPIError(status, body)
+        return json.loads(body)["items"]
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import metrics
+from rate_limit import error_kind
+
+
+class TokenRefresher:
+    """
+    Refreshes access tokens in the background before they expire, so a poll never
+    pays for a refresh round trip and users do not all refresh at once after an
+    outage. A session is refreshed once 70-80% of its token lifetime has passed
+    (the exact point is jittered per session), at most `concurrency` at a time and
+    within the poller's request budget. It also drops idle pooled sessions.
+    """
+
+    refresh_ratio = 0.8
+    jitter_ratio = 0.1
+
+    def __init__(self, tgtg, logger):
+        self.tgtg = tgtg
+        self.logger = logger
+        self.interval = float(os.getenv('TOKEN_REFRESH_CHECK_INTERVAL', 60))
+        self.concurrency = int(os.getenv('TOKEN_REFRESH_CONCURRENCY', 2))
+        self.refreshed = 0
+        self.failed = 0
+        self._stop = asyncio.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_due(self, session):
+        # Before its first call the client refreshes by itself
+        age = session.token_age()
+        if age is None:
+            return False
+        lifetime = session.client.access_token_lifetime
+        return age >= lifetime * (self.refresh_ratio - self.jitter_ratio * session.refresh_jitter)
+
+    async def run(self):
+        while not self._stop.is_set():
+            try:
+                evicted = self.tgtg.sessions.evict_idle()
+                if evicted:
+                    self.logger.info(f"Dropped {evicted} idle TGTG session(s), {len(self.tgtg.sessions)} left")
+                due = [session for session in self.tgtg.sessions.values() if self.is_due(session)]
+                if due:
+                    await self.refresh_all(due)
+            except Exception as err:
+                self.logger.error(f"Unexpected error in token refresh: {err}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refresh_all(self, sessions):
+        limit = asyncio.Semaphore(self.concurrency)
+        refreshed = self.refreshed
+
+        async def refresh(session):
+            async with limit:
+                if self._stop.is_set():
+                    return
+                await self.tgtg.poller.budget.acquire()
+                try:
+                    await self._refresh(session)
+                    self.tgtg.poller.budget.on_success()
+                    self.refreshed += 1
+                except Exception as e:
+                    metrics.TGTG_ERRORS.inc(kind=error_kind(e))
+                    self.tgtg.poller.budget.on_error(e)
+                    self.failed += 1
+                    self.logger.warning(f"Background token refresh failed for user {session.user_id}: {e}")
+
+        await asyncio.gather(*(refresh(session) for session in sessions))
+        self.logger.info(f"Refreshed {self.refreshed - refreshed} of {len(sessions)} access token(s) ahead of expiry")
+
+    async def _refresh(self, session):
+        """Refresh one session's access token and persist the rotated credentials."""
+        async with session.lock:
+            # Clearing the timestamp makes the client refresh on its next login
+            session.client.last_time_token_refreshed = None
+            await session.client.login()
+        self.tgtg.save_session_credentials(session)
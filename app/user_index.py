@@ -0,0 +1,55 @@
+SETTING_BITS = {
+    'sold_out': 1,
+    'new_stock': 2,
+    'stock_reduced': 4,
+    'stock_increased': 8,
+}
+
+
+def settings_mask(settings):
+    """Pack a settings dict like {'new_stock': 1, ...} into a bitmask."""
+    mask = 0
+    for key, bit in SETTING_BITS.items():
+        if settings and settings.get(key):
+            mask |= bit
+    return mask
+
+
+class UserIndex:
+    """
+    In-memory copy of each user's blacklisted store IDs and notification settings,
+    so the poller can filter favourites without database round trips. It is loaded
+    once at startup and updated in place by the code paths that change either.
+    """
+
+    def __init__(self):
+        self.blacklists = {}
+        self.settings = {}
+
+    def load(self, db, users_settings_data):
+        self.blacklists = {}
+        for user_id, store_id in db.get_all_blacklisted_stores():
+            self.blacklists.setdefault(user_id, set()).add(store_id)
+        self.settings = {user_id: settings_mask(settings) for user_id, settings in users_settings_data.items()}
+
+    def is_blacklisted(self, user_id, store_id):
+        blacklist = self.blacklists.get(user_id)
+        return blacklist is not None and store_id in blacklist
+
+    def add_blacklisted(self, user_id, store_id):
+        self.blacklists.setdefault(user_id, set()).add(store_id)
+
+    def remove_blacklisted(self, user_id, store_id):
+        blacklist = self.blacklists.get(user_id)
+        if blacklist is not None:
+            blacklist.discard(store_id)
+
+    def set_blacklist(self, user_id, store_ids):
+        self.blacklists[user_id] = set(store_ids)
+
+    def set_settings(self, user_id, settings):
+        self.settings[user_id] = settings_mask(settings)
+
+    def wants(self, user_id, status):
+        """True if the user has notifications for `status` enabled."""
+        return bool(self.settings.get(user_id, 0) & SETTING_BITS[status])
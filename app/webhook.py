@@ -0,0 +1,101 @@
+import asyncio
+import hmac
+import json
+import os
+import secrets
+from urllib.parse import urlparse
+from aiohttp import web
+from telebot import types
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Optional webhook mode (BOT_MODE=webhook). Telegram posts updates to a local
+    aiohttp server instead of the bot long polling for them, so updates are
+    handled as soon as they arrive and several instances can share one public
+    URL behind a load balancer.
+
+    Every request must carry the secret token registered with the webhook. At
+    most `concurrency` updates are handled at once; further requests wait for a
+    free slot before they are acknowledged, which holds Telegram back instead of
+    piling up tasks. Without WEBHOOK_URL the webhook is not registered, so the
+    server can be tried locally by posting update JSON to it.
+    """
+
+    def __init__(self, bot, logger):
+        self.bot = bot
+        self.logger = logger
+        self.url = os.getenv('WEBHOOK_URL', '')
+        self.host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+        self.port = int(os.getenv('WEBHOOK_PORT', 8080))
+        self.path = os.getenv('WEBHOOK_PATH') or urlparse(self.url).path or '/telegram'
+        # Instances behind one URL must share the secret, a random one only suits a single instance
+        self.secret = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+        self.concurrency = int(os.getenv('WEBHOOK_CONCURRENCY', 32))
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.handled = 0
+        self.rejected = 0
+        self.runner = None
+        self.tasks = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/healthz', self.health)
+        return app
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+        if self.url:
+            await self.bot.set_webhook(url=self.url, secret_token=self.secret, max_connections=self.concurrency)
+            self.logger.info(f"Registered webhook {self.url}")
+        else:
+            self.logger.warning("WEBHOOK_URL is not set, so the webhook is not registered with Telegram")
+
+    async def stop(self):
+        # The webhook stays registered: Telegram keeps updates until an instance is back
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def run(self):
+        """Serve updates until cancelled."""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def health(self, request):
+        return web.Response(text='ok')
+
+    async def handle_update(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.rejected += 1
+            self.logger.warning(f"Rejected webhook request from {request.remote} with a wrong secret token")
+            return web.Response(status=401)
+        try:
+            update = types.Update.de_json(await request.json())
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            self.logger.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+
+        await self.slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.bot.process_new_updates([update])
+            self.handled += 1
+        except Exception as e:
+            self.logger.error(f"Error handling update {update.update_id}: {e}", exc_info=True)
+        finally:
+            self.slots.release()
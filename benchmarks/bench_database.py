@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for the per-lookup cost of the SQLite layer.
+
+Usage: python benchmarks/bench_database.py [--lookups 20000] [--users 500]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from database import Database
+from snapshot import Snapshot
+
+
+def populate(db, users):
+    for i in range(users):
+        user_id = str(100000 + i)
+        db.add_user(user_id, {'access_token': 'a', 'refresh_token': 'r', 'cookie': 'c'})
+        db.add_user_settings(user_id, {'sold_out': 0, 'new_stock': 1, 'stock_reduced': 0, 'stock_increased': 0})
+        db.add_blacklisted_store(user_id, str(i), f"Store {i}")
+
+
+def bench(name, func, lookups):
+    started = time.perf_counter()
+    for i in range(lookups):
+        func(i)
+    elapsed = time.perf_counter() - started
+    return f"{name:<24} {lookups:>8} lookups  {elapsed * 1e6 / lookups:8.1f} us/lookup"
+
+
+def bench_under_write_load(db, users, lookups, items):
+    """Time lookups while another thread keeps flushing item snapshots."""
+    snapshot = [
+        (Snapshot(str(i), str(i % 50), i % 5, 399, 1700000000, 1700003600), (f"Store {i % 50}", 'Street 1', 'Surprise Bag'))
+        for i in range(items)
+    ]
+    stop = threading.Event()
+
+    def flush():
+        while not stop.is_set():
+            db.save_user_snapshots('bench', snapshot).result()
+
+    writer = threading.Thread(target=flush)
+    writer.start()
+    try:
+        latencies = []
+        for i in range(lookups):
+            started = time.perf_counter()
+            db.get_user_settings(str(100000 + i % users))
+            latencies.append(time.perf_counter() - started)
+    finally:
+        stop.set()
+        writer.join()
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1e6
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+    return f"{'lookup during flush':<24} {lookups:>8} lookups  p50 {p50:8.1f} us  p99 {p99:8.1f} us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--items', type=int, default=2000, help="item snapshots flushed concurrently")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        populate(db, args.users)
+
+        users = args.users
+        print(bench('is_store_blacklisted', lambda i: db.is_store_blacklisted(str(100000 + i % users), str(i % users)), args.lookups))
+        print(bench('get_user_settings', lambda i: db.get_user_settings(str(100000 + i % users)), args.lookups))
+        # is_admin prints a debug line per call, keep it out of the output
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = bench('is_admin', lambda i: db.is_admin(str(100000 + i % users)), args.lookups)
+        print(result)
+        print(bench_under_write_load(db, users, args.lookups, args.items))
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
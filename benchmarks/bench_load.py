@@ -0,0 +1,164 @@
+"""
+Load test of the whole bot against the local TGTG and Telegram stand-ins in
+fake_servers.py. Every size runs in its own process on a fresh database of
+simulated users with every alert enabled, and reports:
+
+- sweep: time until every user was polled once ("-" if some never were),
+  revisit: median time between two polls of the same user, and polls per second
+- alert latency (p50/p95) from a stock change in the fake TGTG to the alert
+  reaching the fake Telegram
+- database write jobs and transactions per poll
+- Telegram calls, the 429s the stand-in answered, and peak RSS
+
+Poll intervals are shortened so that a run of a minute or two sees several
+cycles; any POLL_* or other setting from the environment takes precedence.
+
+Usage: python benchmarks/bench_load.py [--users 10 100 1000] [--duration 60] [--latency 0.1]
+       [--captcha-rate 0.0] [--rate-limit-rate 0.0] [--changes-per-hour 6] [--replay favourites.jsonl]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_SETTINGS = {
+    'POLL_INTERVAL': '30',
+    'POLL_DENSE_INTERVAL': '10',
+    'POLL_SPARSE_INTERVAL': '120',
+    'POLL_WORKERS': '64',
+    'POLL_REQUESTS_PER_MINUTE': '60000',
+    'POLL_TICK': '1',
+    'POLL_JITTER': '0.05',
+}
+ALL_ALERTS = {'sold_out': 1, 'new_stock': 1, 'stock_reduced': 1, 'stock_increased': 1}
+
+
+def seed(db_path, users):
+    from database import Database
+    from fake_servers import token_for
+
+    db = Database(db_path)
+    now = time.time()
+    user_ids = [str(100000 + i) for i in range(users)]
+    db.save_users_login_data({user_id: {'access_token': token_for(user_id), 'refresh_token': f"refresh-{user_id}",
+                                        'cookie': 'datadome=bench', 'refreshed_at': now} for user_id in user_ids})
+    db.save_users_settings_data({user_id: dict(ALL_ALERTS) for user_id in user_ids})
+    db.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(args):
+    """Run the bot for one size and return its measurements."""
+    from fake_servers import FakeTelegram, FakeTgtg, RecordedWorld, World
+    from telebot import asyncio_helper
+
+    world = RecordedWorld(args.replay, args.speed) if args.replay else World(args.users, changes_per_hour=args.changes_per_hour)
+    tgtg_server = await FakeTgtg(world, args.latency, args.captcha_rate, args.rate_limit_rate).start()
+    telegram = await FakeTelegram(world).start()
+    asyncio_helper.API_URL = telegram.api_url
+    os.environ['TGTG_API_URL'] = tgtg_server.url
+
+    from TooGoodToGo import TooGoodToGo
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    bot = TooGoodToGo('123456:bench', logging.getLogger('bench'), [])
+    started = time.time()
+    await asyncio.sleep(args.duration)
+
+    polls = tgtg_server.polls
+    first_polls = [times[0] for times in polls.values()]
+    revisits = [later - earlier for times in polls.values() for earlier, later in zip(times, times[1:])]
+    polled = sum(len(times) for times in polls.values())
+    writer = bot.db._writer
+    result = {
+        'users': args.users,
+        'sweep': max(first_polls) - started if len(first_polls) == args.users else None,
+        'revisit': statistics.median(revisits) if revisits else None,
+        'polls_per_second': polled / args.duration,
+        'changes': world.changes,
+        'alerts': len(telegram.latencies),
+        'latency_p50': percentile(telegram.latencies, 0.5),
+        'latency_p95': percentile(telegram.latencies, 0.95),
+        'writes_per_poll': writer.writes / polled if polled else None,
+        'transactions_per_poll': writer.transactions / polled if polled else None,
+        'telegram_calls': telegram.counts['sendMessage'] + telegram.counts['editMessageText'],
+        'telegram_429': telegram.counts['rate_limited'],
+        'tgtg_errors': tgtg_server.counts['captcha'] + tgtg_server.counts['rate_limited'],
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    await bot.shutdown()
+    await asyncio_helper.session_manager.session.close()
+    await tgtg_server.stop()
+    await telegram.stop()
+    return result
+
+
+def run_size(args, users):
+    """Run one size in a child process so that its memory is measured on its own."""
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--users', str(users),
+               '--duration', str(args.duration), '--latency', str(args.latency),
+               '--captcha-rate', str(args.captcha_rate), '--rate-limit-rate', str(args.rate_limit_rate),
+               '--changes-per-hour', str(args.changes_per_hour), '--speed', str(args.speed)]
+    if args.replay:
+        command += ['--replay', args.replay]
+    if args.verbose:
+        command.append('--verbose')
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**BENCH_SETTINGS, **os.environ, 'DATABASE_PATH': os.path.join(tmp, 'bench.db')}
+        output = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def fmt(value, unit='', digits=1):
+    return '-' if value is None or value != value else f"{value:.{digits}f}{unit}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test against fake TGTG and Telegram servers")
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=60, help="seconds to run each size")
+    parser.add_argument('--latency', type=float, default=0.1, help="maximum TGTG response time in seconds")
+    parser.add_argument('--captcha-rate', type=float, default=0.0, help="share of TGTG requests answered with 403")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share of TGTG requests answered with 429")
+    parser.add_argument('--changes-per-hour', type=float, default=6.0, help="stock changes per store and hour")
+    parser.add_argument('--replay', help="serve favourites recorded with fake_servers.py record")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed-up")
+    parser.add_argument('--verbose', action='store_true', help="show the bot's log")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.users = args.users[0]
+        seed(os.environ['DATABASE_PATH'], args.users)
+        print(json.dumps(asyncio.run(run(args))))
+        return
+
+    print(f"{'users':>6} {'sweep':>8} {'revisit':>8} {'polls/s':>8} {'alerts':>7} {'p50':>7} {'p95':>7} "
+          f"{'writes':>7} {'txns':>6} {'tg calls':>8} {'tg 429':>7} {'errors':>7} {'rss':>8}")
+    for users in args.users:
+        r = run_size(args, users)
+        print(f"{r['users']:>6} {fmt(r['sweep'], 's'):>8} {fmt(r['revisit'], 's'):>8} {fmt(r['polls_per_second']):>8} "
+              f"{r['alerts']:>7} {fmt(r['latency_p50'], 's'):>7} {fmt(r['latency_p95'], 's'):>7} "
+              f"{fmt(r['writes_per_poll'], digits=2):>7} {fmt(r['transactions_per_poll'], digits=2):>6} "
+              f"{r['telegram_calls']:>8} {r['telegram_429']:>7} {r['tgtg_errors']:>7} {fmt(r['rss_mb'], ' MB'):>8}")
+    print("writes/txns are database write jobs and transactions per poll; latency is from a stock change to delivery")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Micro-benchmark for the cost of one poll scheduling decision (take the most
+overdue user, then reschedule them) as the number of users grows.
+
+Usage: python benchmarks/bench_scheduler.py [--decisions 100000] [--users 1000 10000 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from restock import RestockModel
+from scheduler import PollScheduler
+from user_index import UserIndex
+
+
+class FakeTgtg:
+    def __init__(self, users):
+        self.user_index = UserIndex()
+        self.restock_model = RestockModel()
+        for i in range(users):
+            user_id = str(i)
+            # One user in ten has every alert off
+            self.user_index.set_settings(user_id, {'new_stock': int(i % 10 != 0)})
+            self.restock_model.set_user_stores(user_id, {str(i % 500), str((i * 7) % 500)})
+
+
+def bench(users, decisions):
+    scheduler = PollScheduler(FakeTgtg(users))
+    now = time.time()
+    for i in range(users):
+        scheduler.schedule(str(i), now - random.uniform(0, 900))
+        scheduler.pickups[str(i)] = [(now + 3600, now + 7200)]
+
+    started = time.perf_counter()
+    for i in range(decisions):
+        user_id = scheduler.pop_due(float('inf'))
+        scheduler.observe(user_id, (), i % 3 == 0)
+        scheduler.reschedule(user_id)
+    elapsed = time.perf_counter() - started
+    return f"{users:>8} users  {decisions:>8} decisions  {elapsed * 1e6 / decisions:8.1f} us/decision  heap {len(scheduler.heap)}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--decisions', type=int, default=100000)
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    for users in args.users:
+        print(bench(users, args.decisions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Memory of the tracked items in each representation, at 100k items by default:
+
+- raw: the full TGTG item dicts, as the bot kept every item it had seen before
+  favourites were snapshotted per user
+- projected: the dicts of snapshot.project_item, as the item cache held them
+- snapshot: snapshot.Snapshot objects, as the item cache and the diff hold them now
+- cache: a full ItemCache, whose entries add a fingerprint and the formatted messages
+
+Items are decoded from JSON one at a time and projected straight away, so only the
+raw variant ever holds the decoded dicts. Each variant runs in its own process and
+reports the growth of its RSS, the bytes traced by tracemalloc per item, and how
+long decoding and projecting took.
+
+Usage: python benchmarks/bench_snapshots.py [--items 100000] [--variants raw projected snapshot cache]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+VARIANTS = ('raw', 'projected', 'snapshot', 'cache')
+
+
+def rss_bytes():
+    """Current resident set size, read from /proc."""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def encoded_items(count):
+    """JSON lines of `count` distinct items, like the pages of favourites TGTG returns."""
+    from fake_servers import make_item
+
+    now = time.time()
+    return [json.dumps(make_item(str(i), i % 5, now)) for i in range(count)]
+
+
+def build(variant, lines):
+    """Decode and keep `lines` as `variant`, one item at a time."""
+    if variant == 'raw':
+        return {item['item']['item_id']: item for item in map(json.loads, lines)}
+    if variant == 'projected':
+        from snapshot import project_item
+        return {projected['item_id']: projected for projected in map(project_item, map(json.loads, lines))}
+    if variant == 'snapshot':
+        from snapshot import project_snapshot
+        return {snapshot.item_id: snapshot for snapshot in map(project_snapshot, map(json.loads, lines))}
+    os.environ['ITEM_CACHE_SIZE'] = str(len(lines))
+    from item_cache import ItemCache
+    cache = ItemCache()
+    for line in lines:
+        cache.lookup(json.loads(line))
+    return cache
+
+
+def run(variant, count):
+    lines = encoded_items(count)
+    # Import everything first so module code does not count towards the items
+    build(variant, lines[:1])
+    before = rss_bytes()
+    started = time.perf_counter()
+    kept = build(variant, lines)
+    elapsed = time.perf_counter() - started
+    rss = rss_bytes() - before
+    del kept
+    # Traced separately, as tracing slows the build down several times
+    tracemalloc.start()
+    kept = build(variant, lines)
+    # Measured while `kept` is alive, per item it actually holds
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'variant': variant,
+        'items': count,
+        'rss_mb': rss / 2 ** 20,
+        'bytes_per_item': traced / len(kept),
+        'seconds': elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.child, args.items)))
+        return
+
+    print(f"{'variant':<10} {'items':>8} {'rss':>10} {'bytes/item':>11} {'build':>8}")
+    for variant in args.variants:
+        # A fresh process per variant, so that one variant's freed memory does not hide the next one's
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', variant, '--items', str(args.items)],
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print(f"{r['variant']:<10} {r['items']:>8} {r['rss_mb']:>7.1f} MB {r['bytes_per_item']:>11.0f} {r['seconds']:>7.2f}s")
+    print("rss is the growth of the process while building; bytes/item is traced by tracemalloc")
+
+
+if __name__ == '__main__':
+    main()
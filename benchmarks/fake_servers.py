@@ -0,0 +1,351 @@
+"""
+Local stand-ins for the TGTG API and the Telegram Bot API, used by the load
+benchmark. Both are small aiohttp servers that keep counters, so a benchmark
+can measure the bot from the outside.
+
+FakeTgtg serves the favourites of a World: synthetic stores whose stock changes
+at random, or a timeline recorded from the real API. Requests can be delayed and
+answered with CAPTCHA (403) or rate limit (429) errors at configurable rates.
+FakeTelegram answers sendMessage and editMessageText like the Bot API and
+enforces its limits of one message per second per chat and 30 per second
+overall with 429 and retry_after.
+
+Record real favourites by pointing TGTG_API_URL of a running bot at a recording
+proxy, then replay them with bench_load.py --replay:
+
+Usage: python benchmarks/fake_servers.py record --out favourites.jsonl [--port 8081]
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+from aiohttp import web
+
+TGTG_URL = 'https://apptoogoodtogo.com/api/'
+ITEM_ENDPOINT = 'item/v8/'
+REFRESH_ENDPOINT = 'token/v1/refresh'
+ITEM_LINK = re.compile(r'share\.toogoodtogo\.com/item/([^"/]+)')
+
+
+def token_for(user_id):
+    """The access token seeded for `user_id`, which FakeTgtg maps back to the user."""
+    return f"bench-{user_id}"
+
+
+def make_item(item_id, items_available, now):
+    store_id = f"s{item_id}"
+    pickup_start = datetime.fromtimestamp(now, timezone.utc).replace(minute=0, second=0) + timedelta(hours=1)
+    return {
+        'item': {'item_id': item_id, 'name': 'Surprise Bag',
+                 'price_including_taxes': {'code': 'EUR', 'minor_units': 399, 'decimals': 2}},
+        'store': {'store_id': store_id, 'store_name': f"Store {item_id}",
+                  'store_location': {'address': {'address_line': f"Street {item_id}"},
+                                     'location': {'latitude': 52.37, 'longitude': 4.89}}},
+        'items_available': items_available,
+        'pickup_interval': {'start': pickup_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                            'end': (pickup_start + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')},
+    }
+
+
+class World:
+    """
+    Synthetic favourites: every user follows `favourites` of `stores` stores, and
+    each store's stock changes `changes_per_hour` times an hour on average,
+    alternating between sold out and a few bags. `changed_at` keeps the time of
+    each item's last change so deliveries can be timed against it.
+    """
+
+    def __init__(self, users, stores=None, favourites=5, changes_per_hour=6.0, seed=1):
+        self.random = random.Random(seed)
+        self.stores = stores or max(20, users // 2)
+        self.favourites = min(favourites, self.stores)
+        self.changes_per_hour = changes_per_hour
+        self.stock = {str(i): self.random.choice((0, 0, self.random.randint(1, 5))) for i in range(self.stores)}
+        self.changed_at = {}
+        self.changes = 0
+        self.updated = time.time()
+
+    def favourites_of(self, user_id):
+        picker = random.Random(user_id)
+        return [str(i) for i in picker.sample(range(self.stores), self.favourites)]
+
+    def advance(self, now):
+        since, self.updated = self.updated, now
+        # Expected number of changes since the last request, spread over random stores and times
+        expected = self.stores * self.changes_per_hour * (now - since) / 3600
+        changes = int(expected) + (self.random.random() < expected % 1)
+        for changed_at in sorted(self.random.uniform(since, now) for _ in range(changes)):
+            item_id = str(self.random.randrange(self.stores))
+            self.stock[item_id] = 0 if self.stock[item_id] else self.random.randint(1, 5)
+            self.changed_at[item_id] = changed_at
+            self.changes += 1
+
+    def items_for(self, user_id, now):
+        self.advance(now)
+        return [make_item(item_id, self.stock[item_id], now) for item_id in self.favourites_of(user_id)]
+
+
+class RecordedWorld:
+    """
+    Replays favourites recorded by RecordingProxy. Every user sees the same
+    recorded timeline, played back at its original pace (or `speed` times
+    faster) and looped; items whose stock differs from the previous frame count
+    as changed when their frame starts.
+    """
+
+    def __init__(self, path, speed=1.0):
+        with open(path) as f:
+            self.frames = [json.loads(line) for line in f if line.strip()]
+        if not self.frames:
+            raise ValueError(f"No recorded responses in {path}")
+        first = self.frames[0]['time']
+        self.offsets = [(frame['time'] - first) / speed for frame in self.frames]
+        self.length = self.offsets[-1] + (self.offsets[-1] / len(self.frames) if len(self.frames) > 1 else 60)
+        self.started = time.time()
+        self.frame = 0
+        self.changed_at = {}
+        self.changes = 0
+
+    def advance(self, now):
+        position = (now - self.started) % self.length
+        frame = max(i for i, offset in enumerate(self.offsets) if offset <= position)
+        if frame != self.frame:
+            # Changes date from when their frame started, not from the request that first sees them
+            frame_started = now - (position - self.offsets[frame])
+            before = {item['item']['item_id']: item['items_available'] for item in self.frames[self.frame]['items']}
+            for item in self.frames[frame]['items']:
+                item_id = item['item']['item_id']
+                if before.get(item_id) != item['items_available']:
+                    self.changed_at[item_id] = frame_started
+                    self.changes += 1
+            self.frame = frame
+
+    def items_for(self, user_id, now):
+        self.advance(now)
+        return self.frames[self.frame]['items']
+
+
+class FakeServer:
+    """Runs an aiohttp application on a free local port."""
+
+    def __init__(self):
+        self.runner = None
+        self.port = None
+
+    def app(self):
+        raise NotImplementedError
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/"
+
+
+class FakeTgtg(FakeServer):
+    """
+    TGTG API stand-in serving `world`. Each item request waits `latency` seconds
+    (uniform between half and the full value) and fails with a CAPTCHA or rate
+    limit error at the given rates. `polls` keeps every user's poll times.
+    """
+
+    def __init__(self, world, latency=0.1, captcha_rate=0.0, rate_limit_rate=0.0, seed=1):
+        super().__init__()
+        self.world = world
+        self.latency = latency
+        self.captcha_rate = captcha_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.polls = defaultdict(list)
+        self.counts = defaultdict(int)
+
+    @property
+    def url(self):
+        return super().url + 'api/'
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/api/' + ITEM_ENDPOINT, self.items)
+        app.router.add_post('/api/' + REFRESH_ENDPOINT, self.refresh)
+        return app
+
+    async def items(self, request):
+        if self.latency:
+            await asyncio.sleep(self.random.uniform(self.latency / 2, self.latency))
+        roll = self.random.random()
+        if roll < self.captcha_rate:
+            self.counts['captcha'] += 1
+            return web.json_response({'url': 'https://geo.captcha-delivery.com/captcha/'}, status=403)
+        if roll < self.captcha_rate + self.rate_limit_rate:
+            self.counts['rate_limited'] += 1
+            return web.Response(status=429)
+
+        user_id = request.headers.get('authorization', '').removeprefix('Bearer bench-')
+        now = time.time()
+        self.counts['items'] += 1
+        self.polls[user_id].append(now)
+        return web.json_response({'items': self.world.items_for(user_id, now)})
+
+    async def refresh(self, request):
+        refresh_token = (await request.json())['refresh_token']
+        self.counts['refresh'] += 1
+        user_id = refresh_token.removeprefix('refresh-')
+        response = web.json_response({'access_token': token_for(user_id), 'refresh_token': refresh_token})
+        response.headers.add('Set-Cookie', 'datadome=bench; Path=/')
+        return response
+
+
+class RecordingProxy(FakeServer):
+    """
+    Forwards every request to the real TGTG API and appends the favourites of
+    each successful item request to `path` as one JSON line.
+    """
+
+    def __init__(self, path, upstream=TGTG_URL):
+        super().__init__()
+        self.path = path
+        self.upstream = upstream
+        self.session = None
+        self.recorded = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/api/{endpoint:.*}', self.forward)
+        return app
+
+    async def forward(self, request):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+        endpoint = request.match_info['endpoint']
+        headers = {key: value for key, value in request.headers.items() if key.lower() not in ('host', 'content-length')}
+        async with self.session.post(self.upstream + endpoint, data=await request.read(), headers=headers) as upstream:
+            body = await upstream.read()
+            status = upstream.status
+            cookies = upstream.headers.getall('Set-Cookie', [])
+        if endpoint == ITEM_ENDPOINT and status == 200:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'time': time.time(), 'items': json.loads(body)['items']}) + '\n')
+            self.recorded += 1
+        response = web.Response(body=body, status=status, content_type='application/json')
+        for cookie in cookies:
+            response.headers.add('Set-Cookie', cookie)
+        return response
+
+    async def stop(self):
+        if self.session:
+            await self.session.close()
+        await super().stop()
+
+
+class FakeTelegram(FakeServer):
+    """
+    Bot API stand-in. Point telebot at it by setting
+    telebot.asyncio_helper.API_URL to `api_url`. Messages over the per-chat or
+    global limit are refused with 429; delivered ones are timed against the
+    World's `changed_at` of every item they link to.
+    """
+
+    def __init__(self, world, per_chat=1.0, per_second=30):
+        super().__init__()
+        self.world = world
+        self.per_chat = per_chat
+        self.per_second = per_second
+        self.chat_sent = {}
+        self.window = (0, 0)
+        self.message_ids = defaultdict(int)
+        self.latencies = []
+        self.timed = set()
+        self.counts = defaultdict(int)
+
+    @property
+    def api_url(self):
+        return self.url + 'bot{0}/{1}'
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    def _rate_limited(self, chat_id, now):
+        second, sent = self.window
+        if int(now) != second:
+            second, sent = int(now), 0
+        if sent >= self.per_second or now - self.chat_sent.get(chat_id, 0) < 1 / self.per_chat:
+            return True
+        self.window = (second, sent + 1)
+        self.chat_sent[chat_id] = now
+        return False
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.counts[method] += 1
+        if method not in ('sendMessage', 'editMessageText'):
+            return web.json_response({'ok': True, 'result': True})
+
+        params = await request.post()
+        chat_id = int(params['chat_id'])
+        now = time.time()
+        if self._rate_limited(chat_id, now):
+            self.counts['rate_limited'] += 1
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                      'parameters': {'retry_after': 1}}, status=429)
+
+        if method == 'sendMessage':
+            self.message_ids[chat_id] += 1
+            message_id = self.message_ids[chat_id]
+        else:
+            message_id = int(params['message_id'])
+        for item_id in ITEM_LINK.findall(params.get('reply_markup', '')):
+            changed_at = self.world.changed_at.get(item_id)
+            # Alerts about the stock seen on the first poll have no change to time
+            if changed_at is not None and (chat_id, item_id, changed_at) not in self.timed:
+                self.timed.add((chat_id, item_id, changed_at))
+                self.latencies.append(now - changed_at)
+        return web.json_response({'ok': True, 'result': {
+            'message_id': message_id, 'date': int(now), 'text': params['text'],
+            'chat': {'id': chat_id, 'type': 'private'}}})
+
+
+async def record(args):
+    proxy = await RecordingProxy(args.out, args.upstream).start(port=args.port)
+    print(f"Recording favourites to {args.out}; start the bot with TGTG_API_URL={proxy.url}api/")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(f"Recorded {proxy.recorded} responses")
+        await proxy.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    recorder = commands.add_parser('record', help="proxy the TGTG API and record favourites")
+    recorder.add_argument('--out', required=True)
+    recorder.add_argument('--port', type=int, default=8081)
+    recorder.add_argument('--upstream', default=TGTG_URL)
+    args = parser.parse_args()
+    try:
+        asyncio.run(record(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import sys
+import unittest
+
+from tgtg.exceptions import TgtgAPIError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from rate_limit import AdaptiveRateLimiter
+from session import UserSession
+from TooGoodToGo import FetchCancelled, TooGoodToGo
+
+CREDENTIALS = {'access_token': 'a', 'refresh_token': 'r', 'cookie': 'c'}
+
+
+class FakeClient:
+    """Fails get_items with the queued errors, then returns one item."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+        self.access_token, self.refresh_token, self.cookie = 'a', 'r', 'c'
+        self.last_time_token_refreshed = None
+
+    async def get_items(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return [{'item': 'ok'}]
+
+
+def make_tgtg(client):
+    """A TooGoodToGo with only what the fetch path uses, around one session."""
+    tgtg = TooGoodToGo.__new__(TooGoodToGo)
+    tgtg.logger = logging.getLogger('test')
+    tgtg.session = UserSession('u1', dict(CREDENTIALS), client)
+    tgtg.refreshed = []
+    tgtg.request_budget = AdaptiveRateLimiter(max_rate=100, min_rate=1)
+    tgtg.shutdown_flag = asyncio.Event()
+
+    async def connect(user_id):
+        return tgtg.session
+
+    async def refresh_credentials(user_id):
+        tgtg.refreshed.append(user_id)
+        if tgtg.refresh_fails:
+            return None
+        tgtg.session.client.errors.clear()
+        return tgtg.session
+
+    tgtg.refresh_fails = False
+    tgtg.connect = connect
+    tgtg.refresh_credentials = refresh_credentials
+    tgtg.save_session_credentials = lambda session: None
+    return tgtg
+
+
+class FetchUserItemsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_rejected_token_is_refreshed_and_the_fetch_retried_once(self):
+        client = FakeClient(TgtgAPIError(401, b'unauthorized'))
+        tgtg = make_tgtg(client)
+
+        self.assertEqual(await tgtg.fetch_user_items('u1'), [{'item': 'ok'}])
+        self.assertEqual(tgtg.refreshed, ['u1'])
+        self.assertEqual(client.calls, 2)
+        self.assertEqual(tgtg.session.failures, 0)
+
+    async def test_failed_refresh_counts_as_a_failed_fetch(self):
+        tgtg = make_tgtg(FakeClient(TgtgAPIError(401, b'unauthorized')))
+        tgtg.refresh_fails = True
+
+        with self.assertRaises(TgtgAPIError):
+            await tgtg.fetch_user_items('u1')
+        self.assertEqual(tgtg.session.failures, 1)
+
+    async def test_other_errors_are_not_retried(self):
+        client = FakeClient(TgtgAPIError(403, b'captcha'))
+        tgtg = make_tgtg(client)
+
+        with self.assertRaises(TgtgAPIError):
+            await tgtg.fetch_user_items('u1')
+        self.assertEqual((tgtg.refreshed, client.calls), ([], 1))
+
+
+class FetchWithinBudgetTest(unittest.IsolatedAsyncioTestCase):
+    async def test_takes_a_token_from_the_request_budget(self):
+        tgtg = make_tgtg(FakeClient())
+        await tgtg.fetch_within_budget('u1')
+        self.assertGreater(tgtg.request_budget.wait_time(), 0)
+
+    async def test_pushback_lowers_the_request_rate(self):
+        tgtg = make_tgtg(FakeClient(TgtgAPIError(429, b'')))
+        with self.assertRaises(TgtgAPIError):
+            await tgtg.fetch_within_budget('u1')
+        self.assertEqual(tgtg.request_budget.rate, 50)
+
+    async def test_cancelled_while_waiting_for_the_budget(self):
+        tgtg = make_tgtg(FakeClient())
+        tgtg.request_budget.pause(60)
+        cancel_event = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.05, cancel_event.set)
+
+        with self.assertRaises(FetchCancelled):
+            await tgtg.fetch_within_budget('u1', cancel_event)
+        self.assertEqual(tgtg.session.client.calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
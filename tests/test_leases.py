@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from database import Database
+from leases import LeaseManager
+from shards import AREA_SCANS
+
+
+class LeaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmp, 'test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+
+class DatabaseLeaseTest(LeaseTestCase):
+    def test_unexpired_leases_of_other_nodes_cannot_be_claimed(self):
+        self.assertEqual(self.db.claim_leases('a', ['u1', 'u2'], 60, 10), ['u1', 'u2'])
+        self.assertEqual(self.db.claim_leases('b', ['u1', 'u2', 'u3'], 60, 10), ['u3'])
+
+    def test_expired_leases_can_be_claimed(self):
+        self.db.claim_leases('a', ['u1'], -1, 10)
+        self.assertEqual(self.db.claim_leases('b', ['u1'], 60, 10), ['u1'])
+        held, _, _ = self.db.renew_leases('a', 60)
+        self.assertEqual(held, [])
+
+    def test_claims_stop_at_the_limit(self):
+        self.assertEqual(self.db.claim_leases('a', ['u1', 'u2', 'u3'], 60, 2), ['u1', 'u2'])
+
+    def test_release_only_drops_the_nodes_own_leases(self):
+        self.db.claim_leases('a', ['u1'], 60, 10)
+        self.db.claim_leases('b', ['u2'], 60, 10)
+        self.db.release_leases('a', ['u1', 'u2'])
+        self.assertEqual(self.db.claim_leases('c', ['u1', 'u2'], 60, 10), ['u1'])
+
+    def test_heartbeat_reports_held_live_and_touched_users_once(self):
+        self.db.claim_leases('a', ['u1', 'u2'], 60, 10)
+        self.db.renew_leases('b', 60)
+        self.db.touch_lease('u2').result()
+
+        held, live, touched = self.db.renew_leases('a', 60)
+        self.assertEqual((sorted(held), sorted(live), touched), (['u1', 'u2'], ['a', 'b'], ['u2']))
+        self.assertEqual(self.db.renew_leases('a', 60)[2], [])
+
+    def test_removed_node_hands_its_users_back(self):
+        self.db.claim_leases('a', ['u1'], 60, 10)
+        self.db.renew_leases('a', 60)
+        self.db.remove_node('a')
+        self.assertEqual(self.db.renew_leases('b', 60)[1], ['b'])
+        self.assertEqual(self.db.claim_leases('b', ['u1'], 60, 10), ['u1'])
+
+
+class FakeTgtg:
+    def __init__(self, db):
+        self.db = db
+        self.outbox = SimpleNamespace(requeue=lambda rows: None)
+        self.changes = []
+
+    def leases_changed(self, gained, lost, touched):
+        self.changes.append((gained, lost, touched))
+
+
+class LeaseManagerTest(LeaseTestCase):
+    def manager(self, node):
+        os.environ['NODE_ID'] = node
+        try:
+            tgtg = FakeTgtg(self.db)
+            return LeaseManager(tgtg, logging.getLogger('test')), tgtg
+        finally:
+            del os.environ['NODE_ID']
+
+    def setUp(self):
+        super().setUp()
+        for user_id in ('u1', 'u2', 'u3'):
+            self.db.add_user(user_id, {})
+        self.db.barrier().result()
+
+    def run_beats(self, *managers):
+        async def beat():
+            for manager in managers:
+                await manager.beat()
+
+        asyncio.run(beat())
+
+    def test_single_instance_claims_every_user_and_the_area_scans(self):
+        a, tgtg = self.manager('a')
+        self.run_beats(a)
+
+        self.assertEqual(a.held, {'u1', 'u2', 'u3', AREA_SCANS})
+        self.assertTrue(a.owns('u1'))
+        gained, lost, _ = tgtg.changes[-1]
+        self.assertEqual((gained, lost), ({'u1', 'u2', 'u3', AREA_SCANS}, set()))
+
+    def test_instances_split_the_users_without_overlap(self):
+        a, tgtg = self.manager('a')
+        b, _ = self.manager('b')
+        self.run_beats(a, b, a, b)
+
+        self.assertEqual(a.held | b.held, {'u1', 'u2', 'u3', AREA_SCANS})
+        self.assertEqual(a.held & b.held, set())
+        self.assertEqual((len(a.held), len(b.held)), (2, 2))
+        # The users a handed back were reported as lost, not as gained again
+        gained, lost, _ = tgtg.changes[-1]
+        self.assertEqual((gained, len(lost)), (set(), 2))
+
+    def test_ownership_ends_before_the_lease_could_expire(self):
+        a, _ = self.manager('a')
+        self.run_beats(a)
+        a.valid_until = time.time() - 1
+        self.assertFalse(a.owns('u1'))
+
+    def test_users_of_a_lapsed_heartbeat_are_gained_again(self):
+        a, tgtg = self.manager('a')
+        self.run_beats(a)
+        a.valid_until = time.time() - 1
+        self.run_beats(a)
+
+        gained, _, _ = tgtg.changes[-1]
+        self.assertEqual(gained, {'u1', 'u2', 'u3', AREA_SCANS})
+
+
+if __name__ == '__main__':
+    unittest.main()
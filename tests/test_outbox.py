@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from outbox import Notification, Outbox
+
+
+class FakeDatabase:
+    """The outbox's side of the database, kept in memory."""
+
+    def __init__(self):
+        self.acks = []
+        self.sent_messages = []
+
+    def ack_notifications(self, acks):
+        self.acks.extend(acks)
+
+    def record_sent_message(self, chat_id, message_id, parts, sent_at):
+        self.sent_messages.append((chat_id, message_id, parts, sent_at))
+
+
+def notification(chat_id, item_id, expires_at=None):
+    key = Notification.make_key(chat_id, item_id, 'new_stock', 1)
+    return Notification(key, chat_id, f"Item {item_id}", item_id, 'store', 'Store', 'new_stock', expires_at)
+
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ['TELEGRAM_SEND_CONCURRENCY'] = '1'
+        self.sent = []
+        self.send_delay = 0
+        self.db = FakeDatabase()
+        self.outbox = Outbox(self.send, logging.getLogger('test'), self.db)
+        self.outbox.start()
+
+    async def asyncTearDown(self):
+        await self.outbox.stop()
+        del os.environ['TELEGRAM_SEND_CONCURRENCY']
+
+    async def send(self, chat_id, rows, message_id=None):
+        await asyncio.sleep(self.send_delay)
+        self.sent.append((chat_id, [row[0] for row in rows]))
+        return len(self.sent)
+
+    async def wait_for(self, condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return condition()
+
+    async def test_sender_survives_a_queue_that_only_held_expired_alerts(self):
+        self.outbox.put(notification(1, 'expired', expires_at=int(time.time()) - 1))
+        self.assertTrue(await self.wait_for(lambda: self.outbox.size() == 0))
+        self.outbox.flush_acks()
+        self.assertEqual(self.db.acks[0][1], 'expired')
+
+        # With a single sender, this only goes out if the expired batch did not kill it
+        self.outbox.put(notification(2, 'fresh'))
+        self.assertTrue(await self.wait_for(lambda: self.sent))
+        self.assertEqual(self.sent, [(2, ['fresh'])])
+
+    async def test_stop_lets_the_send_in_flight_finish(self):
+        self.send_delay = 0.2
+        self.outbox.put(notification(1, 'slow'))
+        self.assertTrue(await self.wait_for(lambda: self.outbox.delivering))
+
+        self.assertEqual(await self.outbox.stop(), 0)
+        self.assertEqual(self.sent, [(1, ['slow'])])
+        self.assertEqual([ack[1] for ack in self.db.acks], ['sent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import unittest
+
+from tgtg.exceptions import TgtgAPIError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from rate_limit import AdaptiveRateLimiter, TokenBucket, error_kind, request_budget
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_reserves_tokens_at_the_rate(self):
+        bucket = TokenBucket(rate=10)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_pause_hands_out_no_tokens(self):
+        bucket = TokenBucket(rate=10)
+        bucket.pause(5)
+        self.assertAlmostEqual(bucket.wait_time(), 5.1, places=1)
+
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+    def test_pushback_halves_the_rate_once_per_cooldown(self):
+        limiter = AdaptiveRateLimiter(max_rate=1.0, min_rate=0.1)
+        self.assertTrue(limiter.on_error(TgtgAPIError(429, b'')))
+        self.assertEqual(limiter.rate, 0.5)
+        # Errors of requests that were already in flight do not count again
+        self.assertFalse(limiter.on_error(TgtgAPIError(403, b'captcha')))
+        self.assertEqual(limiter.rate, 0.5)
+        self.assertEqual(limiter.pushbacks, 2)
+
+    def test_rate_never_drops_below_the_minimum(self):
+        limiter = AdaptiveRateLimiter(max_rate=1.0, min_rate=0.4)
+        limiter.cooldown = 0
+        for _ in range(5):
+            limiter.on_error(asyncio.TimeoutError())
+        self.assertEqual(limiter.rate, 0.4)
+
+    def test_other_errors_are_not_pushback(self):
+        limiter = AdaptiveRateLimiter(max_rate=1.0, min_rate=0.1)
+        self.assertFalse(limiter.on_error(TgtgAPIError(401, b'')))
+        self.assertFalse(limiter.on_error(ValueError()))
+        self.assertEqual(limiter.rate, 1.0)
+
+    def test_successes_recover_the_rate_additively(self):
+        limiter = AdaptiveRateLimiter(max_rate=1.0, min_rate=0.1)
+        limiter.on_error(TgtgAPIError(500, b''))
+        for _ in range(5):
+            limiter.on_success()
+        self.assertAlmostEqual(limiter.rate, 0.75)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 1.0)
+
+    def test_request_budget_is_split_into_shares(self):
+        os.environ['POLL_REQUESTS_PER_MINUTE'] = '60'
+        try:
+            self.assertEqual(request_budget().rate, 1.0)
+            self.assertEqual(request_budget(4).rate, 0.25)
+        finally:
+            del os.environ['POLL_REQUESTS_PER_MINUTE']
+
+
+class ErrorKindTest(unittest.TestCase):
+    def test_classifies_tgtg_errors(self):
+        self.assertEqual(error_kind(TgtgAPIError(403, b'')), 'captcha')
+        self.assertEqual(error_kind(TgtgAPIError(429, b'')), 'rate_limited')
+        self.assertEqual(error_kind(TgtgAPIError(502, b'')), 'server')
+        self.assertEqual(error_kind(TgtgAPIError(401, b'')), 'unauthorized')
+        self.assertEqual(error_kind(asyncio.TimeoutError()), 'timeout')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from restock import RestockModel
+
+
+def at(days_ago, hour, minute=0):
+    """Local timestamp of hour:minute, `days_ago` days before a fixed reference day."""
+    return time.mktime((2026, 6, 15 - days_ago, hour, minute, 0, 0, 0, -1))
+
+
+class FakeDatabase:
+    def __init__(self, restocks):
+        self.restocks = restocks
+
+    def get_restock_times(self, since):
+        return [row for row in self.restocks if row[1] >= since]
+
+    def get_user_stores(self):
+        return [('u1', 's1')]
+
+
+class RestockModelTest(unittest.TestCase):
+    def setUp(self):
+        self.model = RestockModel()
+        self.model.set_user_stores('u1', {'s1'})
+
+    def restock(self, days_ago, hour, pickup=None):
+        item_id = f'i{days_ago}'
+        pickup_start, pickup_end = (at(days_ago, *pickup[0]), at(days_ago, *pickup[1])) if pickup else (None, None)
+        self.model.observe(item_id, 's1', 'new_stock', pickup_start, pickup_end, now=at(days_ago, hour))
+        self.model.observe(item_id, 's1', 'sold_out', now=at(days_ago, hour + 1))
+
+    def test_learns_a_restock_window_after_min_days(self):
+        self.restock(2, 10)
+        self.assertEqual(self.model.poll_interval('u1', at(0, 10)), self.model.base_interval)
+        self.restock(1, 10)
+        self.assertEqual(self.model.poll_interval('u1', at(0, 10)), self.model.dense_interval)
+        self.assertEqual(self.model.poll_interval('u1', at(0, 14)), self.model.sparse_interval)
+
+    def test_learns_the_pickup_window_from_new_stock_events(self):
+        self.restock(3, 10, pickup=((17, 0), (18, 0)))
+        self.assertNotIn('s1', self.model.pickup_windows)
+        self.restock(2, 10, pickup=((17, 30), (18, 30)))
+        self.restock(1, 10, pickup=((17, 0), (18, 0)))
+        self.assertTrue(self.model.expects_pickup('u1', at(0, 15, 30), horizon=2 * 3600))
+        self.assertTrue(self.model.expects_pickup('u1', at(0, 17, 45), horizon=2 * 3600))
+        self.assertFalse(self.model.expects_pickup('u1', at(0, 14), horizon=2 * 3600))
+        self.assertFalse(self.model.expects_pickup('u1', at(0, 18, 30), horizon=2 * 3600))
+
+    def test_drops_without_a_pickup_window_teach_no_pickup_time(self):
+        self.restock(2, 10)
+        self.restock(1, 10)
+        self.assertNotIn('s1', self.model.pickup_windows)
+        self.assertFalse(self.model.expects_pickup('u1', at(0, 10), horizon=2 * 3600))
+
+    def test_load_restores_windows_from_the_database(self):
+        now = time.time()
+        rows = [('s1', now - days * 86400, now - days * 86400 + 3600, now - days * 86400 + 7200) for days in (1, 2)]
+        model = RestockModel()
+        model.load(FakeDatabase(rows))
+        self.assertEqual(model.poll_interval('u1', now), model.dense_interval)
+        self.assertTrue(model.expects_pickup('u1', now, horizon=2 * 3600))
+
+
+if __name__ == '__main__':
+    unittest.main()
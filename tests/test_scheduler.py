@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from scheduler import PollScheduler
+
+
+class FakeRestockModel:
+    dense_interval = 120
+
+    def poll_interval(self, user_id, now):
+        return 900
+
+    def expects_pickup(self, user_id, now, horizon):
+        return False
+
+
+def make_scheduler():
+    tgtg = SimpleNamespace(user_index=SimpleNamespace(settings={'u1': {'new_stock': 1}, 'u2': {'new_stock': 1}}),
+                           restock_model=FakeRestockModel())
+    return PollScheduler(tgtg)
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def test_pops_the_most_overdue_user_first(self):
+        scheduler = make_scheduler()
+        now = time.time()
+        scheduler.schedule('late', now - 10)
+        scheduler.schedule('later', now - 100)
+        scheduler.schedule('future', now + 100)
+
+        self.assertEqual(scheduler.pop_due(now), 'later')
+        self.assertEqual(scheduler.pop_due(now), 'late')
+        self.assertIsNone(scheduler.pop_due(now))
+        self.assertEqual(scheduler.next_deadline(), now + 100)
+
+    def test_rescheduling_replaces_the_old_deadline(self):
+        scheduler = make_scheduler()
+        now = time.time()
+        scheduler.schedule('u1', now - 10)
+        scheduler.schedule('u1', now + 50)
+
+        self.assertIsNone(scheduler.pop_due(now))
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.next_deadline(), now + 50)
+
+    def test_reschedule_uses_the_interval_with_jitter(self):
+        scheduler = make_scheduler()
+        scheduler.schedule('u1', 0)
+        scheduler.pop_due(time.time())
+        before = time.time()
+        scheduler.reschedule('u1')
+
+        self.assertGreaterEqual(scheduler.deadlines['u1'], before + 900 * 0.85)
+        self.assertLessEqual(scheduler.deadlines['u1'], time.time() + 900 * 1.15)
+
+    def test_user_with_every_alert_off_is_polled_at_the_idle_interval(self):
+        scheduler = make_scheduler()
+        self.assertEqual(scheduler.interval('nobody', time.time()), scheduler.idle_interval)
+
+    def test_upcoming_pickup_window_halves_the_interval(self):
+        scheduler = make_scheduler()
+        now = time.time()
+        scheduler.pickups['u1'] = [(now + 3600, now + 7200)]
+        self.assertEqual(scheduler.interval('u1', now), 450)
+
+    def test_waking_a_user_in_flight_polls_them_again_after_the_poll(self):
+        scheduler = make_scheduler()
+        now = time.time()
+        scheduler.schedule('u1', now - 1)
+        self.assertEqual(scheduler.pop_due(now), 'u1')
+        self.assertTrue(scheduler.is_scheduled('u1'))
+
+        scheduler.wake('u1', now)
+        # No second entry, so no other worker can pick the user up while the poll runs
+        self.assertIsNone(scheduler.pop_due(now))
+
+        scheduler.reschedule('u1')
+        scheduler.finish('u1')
+        self.assertEqual(scheduler.pop_due(time.time()), 'u1')
+
+    def test_finish_clears_a_user_that_was_not_rescheduled(self):
+        scheduler = make_scheduler()
+        scheduler.schedule('u1', 0)
+        scheduler.pop_due(time.time())
+        scheduler.wake('u1', time.time())
+        scheduler.finish('u1')
+
+        self.assertFalse(scheduler.is_scheduled('u1'))
+        self.assertEqual(scheduler.repoll, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from database import SCHEMA_VERSION, Database
+from item_cache import ItemCache
+from snapshot import Snapshot, parse_pickup_time, project_snapshot, snapshot_changed
+from TooGoodToGo import TooGoodToGo
+from user_index import UserIndex
+
+ALL_ALERTS = {'sold_out': 1, 'new_stock': 1, 'stock_reduced': 1, 'stock_increased': 1}
+
+
+def make_item(item_id, available, store_id='s1', price=399):
+    return {
+        'item': {'item_id': item_id, 'name': f"Bag {item_id}", 'price_including_taxes': {'minor_units': price}},
+        'store': {'store_id': store_id, 'store_name': f"Store {store_id}",
+                  'store_location': {'address': {'address_line': 'Street 1'}}},
+        'items_available': available,
+        'pickup_interval': {'start': '2030-05-01T16:00:00Z', 'end': '2030-05-01T17:00:00Z'},
+    }
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_projects_the_fields_the_diff_needs(self):
+        snapshot = project_snapshot(make_item('i1', 3))
+        self.assertEqual((snapshot.item_id, snapshot.store_id, snapshot.items_available, snapshot.price_minor),
+                         ('i1', 's1', 3, 399))
+        self.assertEqual(snapshot.pickup_start, parse_pickup_time('2030-05-01T16:00:00Z'))
+        self.assertEqual(snapshot.pickup_end - snapshot.pickup_start, 3600)
+
+    def test_only_stock_price_and_pickup_window_count_as_changes(self):
+        old = project_snapshot(make_item('i1', 3))
+        self.assertFalse(snapshot_changed(old, project_snapshot(make_item('i1', 3))))
+        self.assertTrue(snapshot_changed(old, project_snapshot(make_item('i1', 2))))
+        self.assertTrue(snapshot_changed(old, project_snapshot(make_item('i1', 3, price=299))))
+        self.assertTrue(snapshot_changed(None, old))
+
+    def test_versions_increase_and_never_restart(self):
+        first = project_snapshot(make_item('i1', 3)).next_version(None)
+        second = project_snapshot(make_item('i1', 2)).next_version(first)
+        self.assertGreater(second.version, first.version)
+        # A version far ahead of the clock is still bumped by one
+        ahead = Snapshot('i1', 's1', 1, 399, None, None, version=first.version + 10 ** 9)
+        self.assertEqual(project_snapshot(make_item('i1', 1)).next_version(ahead).version, ahead.version + 1)
+        # An item seen again in a later poll, after its row was deleted, starts past its earlier versions
+        time.sleep(0.01)
+        self.assertGreater(project_snapshot(make_item('i1', 3)).next_version(None).version, second.version)
+
+
+def make_tgtg():
+    """A TooGoodToGo with only what process_user_items uses."""
+    tgtg = TooGoodToGo.__new__(TooGoodToGo)
+    tgtg.logger = logging.getLogger('test')
+    tgtg.shutdown_flag = SimpleNamespace(is_set=lambda: False)
+    tgtg.item_cache = ItemCache()
+    tgtg.user_index = UserIndex()
+    tgtg.user_index.set_settings('u1', ALL_ALERTS)
+    tgtg.restock_model = SimpleNamespace(observe=lambda *args: None, set_user_stores=lambda *args: None)
+    return tgtg
+
+
+class DiffTest(unittest.TestCase):
+    def diff(self, tgtg, items, snapshots):
+        changed, removed, notifications, seen = tgtg.process_user_items('u1', items, snapshots)
+        return {snapshot.item_id: snapshot for snapshot, _ in changed}, removed, notifications, seen
+
+    def test_statuses_follow_the_stock(self):
+        tgtg = make_tgtg()
+        changed, _, notifications, _ = self.diff(tgtg, [make_item('i1', 2), make_item('i2', 0)], {})
+        self.assertEqual([n.status for n in notifications], ['new_stock'])
+        self.assertEqual(changed.keys(), {'i1', 'i2'})
+
+        cases = [(2, 0, 'sold_out'), (0, 3, 'new_stock'), (3, 1, 'stock_reduced'), (1, 4, 'stock_increased')]
+        for before, after, status in cases:
+            old = project_snapshot(make_item('i1', before)).next_version(None)
+            _, _, notifications, _ = self.diff(tgtg, [make_item('i1', after)], {'i1': old})
+            self.assertEqual([n.status for n in notifications], [status])
+
+    def test_unchanged_items_are_neither_saved_nor_alerted(self):
+        tgtg = make_tgtg()
+        old = project_snapshot(make_item('i1', 2)).next_version(None)
+        changed, removed, notifications, seen = self.diff(tgtg, [make_item('i1', 2)], {'i1': old})
+        self.assertEqual((changed, removed, notifications), ({}, [], []))
+        self.assertEqual([snapshot.item_id for snapshot in seen], ['i1'])
+
+    def test_alert_keys_carry_the_new_version(self):
+        tgtg = make_tgtg()
+        old = project_snapshot(make_item('i1', 0)).next_version(None)
+        changed, _, notifications, _ = self.diff(tgtg, [make_item('i1', 1)], {'i1': old})
+        self.assertGreater(changed['i1'].version, old.version)
+        self.assertEqual(notifications[0].key, f"u1:i1:new_stock:{changed['i1'].version}")
+
+    def test_items_no_longer_in_the_favourites_are_removed(self):
+        tgtg = make_tgtg()
+        old = project_snapshot(make_item('gone', 1)).next_version(None)
+        _, removed, _, _ = self.diff(tgtg, [make_item('i1', 1)], {'gone': old})
+        self.assertEqual(removed, ['gone'])
+
+    def test_blacklisted_stores_are_skipped(self):
+        tgtg = make_tgtg()
+        tgtg.user_index.add_blacklisted('u1', 's2')
+        changed, _, notifications, seen = self.diff(tgtg, [make_item('i1', 1, store_id='s2')], {})
+        self.assertEqual((changed, notifications, seen), ({}, [], []))
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class SnapshotStorageTest(DatabaseTestCase):
+    def test_saved_snapshots_are_read_back_with_their_store(self):
+        db = Database(self.path)
+        try:
+            snapshot = project_snapshot(make_item('i1', 2)).next_version(None)
+            db.save_user_snapshots('u1', [(snapshot, ('Store s1', 'Street 1', 'Bag i1'))]).result()
+            stored = db.get_user_snapshots('u1')['i1']
+            self.assertEqual((stored.store_id, stored.items_available, stored.version), ('s1', 2, snapshot.version))
+            self.assertFalse(snapshot_changed(stored, snapshot))
+
+            db.save_user_snapshots('u1', [], ['i1']).result()
+            self.assertEqual(db.get_user_snapshots('u1'), {})
+        finally:
+            db.close()
+
+    def test_an_alert_key_is_only_queued_once(self):
+        db = Database(self.path)
+        try:
+            snapshot = project_snapshot(make_item('i1', 2)).next_version(None)
+            notification = make_tgtg().process_user_items('u1', [make_item('i1', 2)], {})[2][0]
+            pair = [(snapshot, ('Store s1', 'Street 1', 'Bag i1'))]
+            self.assertEqual(db.save_user_snapshots('u1', pair, (), [notification]).result(), {notification.key})
+            self.assertEqual(db.save_user_snapshots('u1', pair, (), [notification]).result(), set())
+        finally:
+            db.close()
+
+
+class MigrationTest(DatabaseTestCase):
+    def create_v1_database(self):
+        """The schema before versioning, with the shared available_items_favorites blobs."""
+        conn = sqlite3.connect(self.path)
+        conn.executescript('''
+        CREATE TABLE users_login_data (user_id TEXT PRIMARY KEY, credentials TEXT);
+        CREATE TABLE users_settings_data (user_id TEXT PRIMARY KEY, settings TEXT);
+        CREATE TABLE available_items_favorites (item_id TEXT PRIMARY KEY, item_data TEXT);
+        CREATE TABLE blacklisted_stores (user_id TEXT, store_id TEXT, store_name TEXT, PRIMARY KEY (user_id, store_id));
+        CREATE TABLE private_access (token TEXT PRIMARY KEY, user_id TEXT UNIQUE, first_name TEXT);
+        CREATE TABLE admin_users (user_id TEXT PRIMARY KEY);
+        ''')
+        conn.executemany('INSERT INTO users_login_data VALUES (?, ?)',
+                         [('u1', json.dumps({'access_token': 'a'})), ('u2', json.dumps({'access_token': 'b'}))])
+        conn.executemany('INSERT INTO available_items_favorites VALUES (?, ?)',
+                         [('i1', json.dumps(make_item('i1', 2))), ('broken', '{}')])
+        conn.commit()
+        conn.close()
+
+    def test_v1_database_is_migrated_to_the_current_schema(self):
+        self.create_v1_database()
+        db = Database(self.path)
+        try:
+            self.assertEqual(db.get_users_login_data()['u1'], {'access_token': 'a'})
+            # Every user is seeded with the old shared snapshot, so the first poll stays quiet
+            for user_id in ('u1', 'u2'):
+                snapshot = db.get_user_snapshots(user_id)['i1']
+                self.assertEqual((snapshot.store_id, snapshot.items_available, snapshot.version), ('s1', 2, 0))
+            self.assertEqual(db.get_user_snapshots('u1').keys(), {'i1'})
+        finally:
+            db.close()
+
+        conn = sqlite3.connect(self.path)
+        try:
+            self.assertEqual(conn.execute('SELECT version FROM schema_version').fetchone()[0], SCHEMA_VERSION)
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            self.assertNotIn('available_items_favorites', tables)
+            self.assertTrue({'stores', 'items', 'outbox', 'sent_messages', 'leases', 'nodes'} <= tables)
+            self.assertIn('node', [row[1] for row in conn.execute('PRAGMA table_info(outbox)')])
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
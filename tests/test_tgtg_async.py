@@ -0,0 +1,80 @@
+import asyncio
+import os
+import sys
+import unittest
+from json import dumps
+
+from multidict import CIMultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from tgtg import REFRESH_ENDPOINT
+from tgtg_async import AsyncTgtgClient
+
+
+class FakeResponse:
+    def __init__(self, status, body, headers):
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def read(self):
+        return self.body
+
+
+class FakeHttp:
+    """Answers every POST with the next queued (status, data, headers) and records the paths."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.paths = []
+
+    def post(self, url, json=None, headers=None):
+        self.paths.append(url.rsplit('/api/', 1)[-1])
+        status, data, headers = self.responses.pop(0)
+        return FakeResponse(status, dumps(data).encode(), CIMultiDict(headers))
+
+
+TOKENS = {'access_token': 'new-access', 'refresh_token': 'new-refresh'}
+
+
+def make_client(http):
+    return AsyncTgtgClient(http, url='https://tgtg.test/api/', access_token='old-access', refresh_token='old-refresh',
+                           cookie='datadome=old')
+
+
+class TokenRefreshTest(unittest.TestCase):
+    def test_refresh_without_set_cookie_keeps_the_cookie(self):
+        http = FakeHttp((200, TOKENS, {}))
+        client = make_client(http)
+        credentials = asyncio.run(client.get_credentials())
+
+        self.assertEqual(http.paths, [REFRESH_ENDPOINT])
+        self.assertEqual(credentials, {'access_token': 'new-access', 'refresh_token': 'new-refresh',
+                                       'cookie': 'datadome=old'})
+
+    def test_refresh_with_set_cookie_replaces_the_cookie(self):
+        http = FakeHttp((200, TOKENS, [('Set-Cookie', 'datadome=new'), ('Set-Cookie', 'session=1')]))
+        client = make_client(http)
+        asyncio.run(client.login())
+
+        self.assertEqual(client.cookie, 'datadome=new, session=1')
+
+    def test_refreshed_credentials_can_log_in_again(self):
+        http = FakeHttp((200, TOKENS, {}), (200, {'items': [{'item': 1}]}, {}))
+        client = make_client(http)
+        credentials = asyncio.run(client.get_credentials())
+
+        again = AsyncTgtgClient(http, url='https://tgtg.test/api/', last_time_token_refreshed=client.last_time_token_refreshed,
+                                **credentials)
+        self.assertEqual(asyncio.run(again.get_items()), [{'item': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()